@@ -0,0 +1,274 @@
+'''
+Benchmark of coverage_on_new_code on synthetic JaCoCo reports and diffs.
+
+Generates a JaCoCo HTML report, the matching jacoco.xml and a git diff of
+a configurable shape, then times each stage of the tool separately and
+reports its throughput and peak memory.  With the same arguments (and
+seed) the generated input is identical, so results can be compared
+across versions.
+'''
+from __future__ import unicode_literals
+import os
+import sys
+import argparse
+import contextlib
+import glob
+import json
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import coverage_on_new_code as cc
+
+PAGE_HEAD = '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" ' \
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd"><html xmlns="http://www.w3.org/1999/xhtml" lang="en">' \
+    '<head><meta http-equiv="Content-Type" content="text/html;charset=UTF-8"/><title>{name}</title></head>' \
+    '<body onload="window[\'PR_TAB_WIDTH\']=4;prettyPrint()"><div class="breadcrumb" id="breadcrumb">' \
+    '<a href="../index.html" class="el_report">benchmark</a></div><h1>{name}</h1>' \
+    '<pre class="source lang-java linenums">'
+PAGE_FOOT = '</pre><div class="footer"><span class="right">Created with JaCoCo</span></div></body></html>'
+
+XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' \
+    '<!DOCTYPE report PUBLIC "-//JACOCO//DTD Report 1.1//EN" "report.dtd"><report name="benchmark">' \
+    '<sessioninfo id="benchmark" start="0" dump="0"/>'
+
+# (HTML classes, title, mi, ci, mb, cb) of the executable lines
+LINE_KINDS = [
+    ('fc', None, 0, 3, 0, 0),
+    ('nc', None, 3, 0, 0, 0),
+    ('pc', None, 1, 2, 0, 0),
+    ('fc bfc', 'All 2 branches covered.', 0, 4, 0, 2),
+    ('pc bpc', '1 of 2 branches missed.', 0, 4, 1, 1),
+    ('nc bnc', 'All 2 branches missed.', 4, 0, 2, 0),
+]
+
+# Pages read ahead in the `report_prefetch` stage
+PREFETCH = 8
+
+def generate(workdir, files, lines, hunks, hunk_size, renames, seed):
+    """
+    Write `<workdir>/jacoco/` (HTML pages and jacoco.xml) and
+    `<workdir>/gitdiff.txt` and return the number of changed lines.
+    """
+    rnd = random.Random(seed)
+    report_dir = os.path.join(workdir, 'jacoco')
+    os.makedirs(report_dir)
+
+    changed = 0
+    packages = max(1, files // 20)
+
+    with open(os.path.join(report_dir, 'jacoco.xml'), 'w') as xml, \
+            open(os.path.join(workdir, 'gitdiff.txt'), 'w') as diff:
+        xml.write(XML_HEAD)
+
+        for p in range(packages):
+            package = 'org/bench/p{0}'.format(p)
+            package_dir = os.path.join(report_dir, package.replace('/', '.'))
+            os.makedirs(package_dir)
+            xml.write('<package name="{0}">'.format(package))
+
+            for f in range(p, files, packages):
+                name = 'Generated{0}.java'.format(f)
+
+                # One page per source file, about a third of the lines are not executable
+                page = [PAGE_HEAD.format(name=name)]
+                xml.write('<sourcefile name="{0}">'.format(name))
+                for line in range(1, lines + 1):
+                    if rnd.random() < 0.33:
+                        page.append('    // line {0}\n'.format(line))
+                        continue
+                    classes, title, mi, ci, mb, cb = rnd.choice(LINE_KINDS)
+                    page.append('<span class="{0}" id="L{1}"{2}>    call({1});</span>\n'.format(
+                        classes, line, ' title="{0}"'.format(title) if title else ''))
+                    xml.write('<line nr="{0}" mi="{1}" ci="{2}" mb="{3}" cb="{4}"/>'.format(
+                        line, mi, ci, mb, cb))
+                page.append(PAGE_FOOT)
+                xml.write('</sourcefile>')
+                with open(os.path.join(package_dir, name + '.html'), 'w') as page_file:
+                    page_file.write(''.join(page))
+
+                # Diff section, optionally as a rename
+                new_path = 'module/src/main/java/{0}/{1}'.format(package, name)
+                if rnd.random() < renames:
+                    old_path = 'module/src/main/java/{0}/Old{1}'.format(package, name)
+                    diff.write('diff --git a/{0} b/{1}\nsimilarity index 90%\n'
+                               'rename from {0}\nrename to {1}\n'.format(old_path, new_path))
+                else:
+                    old_path = new_path
+                    diff.write('diff --git a/{0} b/{0}\nindex 0000000..1111111 100644\n'.format(new_path))
+                diff.write('--- a/{0}\n+++ b/{1}\n'.format(old_path, new_path))
+
+                # Evenly spread hunks, each replacing half of its lines
+                step = max(hunk_size + 3, lines // max(1, hunks))
+                for start in range(1, lines - hunk_size, step)[:hunks]:
+                    removed = hunk_size // 2
+                    diff.write('@@ -{0},{1} +{0},{2} @@ class {3}\n'.format(
+                        start, removed + 2, hunk_size + 2, name[:-5]))
+                    diff.write(' context\n')
+                    diff.write('-removed\n' * removed)
+                    diff.write('+added\n' * hunk_size)
+                    diff.write(' context\n')
+                    changed += hunk_size
+
+            xml.write('</package>')
+        xml.write('</report>')
+
+    return changed
+
+def run_stages(workdir):
+    """
+    Run every stage once and return `{STAGE: (SECONDS, RESULT)}`.
+    """
+    report_dir = os.path.join(workdir, 'jacoco')
+    gitdiff_file = os.path.join(workdir, 'gitdiff.txt')
+    timings = dict()
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    # The tool prints a line per file, keep it out of the measurements
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        diff_report = timed('diff', lambda: cc.GitDiffReporter(gitdiff_file)._git_diff())
+        html_report = timed('report_html', cc.report, diff_report, report_dir)
+        timed('report_prefetch', lambda: cc.report(diff_report, report_dir, prefetch=PREFETCH))
+        timed('report_xml', cc.report_from_xml, diff_report, os.path.join(report_dir, 'jacoco.xml'))
+        timed('render', cc.generateHtml, html_report, workdir)
+
+    return timings
+
+def peak_memory(workdir):
+    """
+    Run every stage once under tracemalloc and return the peak
+    memory of each, in bytes.
+    """
+    peaks = dict()
+    report_dir = os.path.join(workdir, 'jacoco')
+    gitdiff_file = os.path.join(workdir, 'gitdiff.txt')
+
+    def traced(stage, func, *args):
+        tracemalloc.start()
+        try:
+            return func(*args)
+        finally:
+            peaks[stage] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        diff_report = traced('diff', lambda: cc.GitDiffReporter(gitdiff_file)._git_diff())
+        html_report = traced('report_html', cc.report, diff_report, report_dir)
+        traced('report_prefetch', lambda: cc.report(diff_report, report_dir, prefetch=PREFETCH))
+        traced('report_xml', cc.report_from_xml, diff_report, os.path.join(report_dir, 'jacoco.xml'))
+        traced('render', cc.generateHtml, html_report, workdir)
+
+    return peaks
+
+def time_parsers(workdir):
+    """
+    Read every page of the report with each available parser backend
+    and return `{BACKEND: SECONDS}`.
+    """
+    pages = sorted(glob.glob(os.path.join(workdir, 'jacoco', '*', '*.java.html')))
+    timings = dict()
+    for (backend, iter_page) in cc.PARSER_BACKENDS.items():
+        start = time.perf_counter()
+        for page in pages:
+            for _ in iter_page(page):
+                pass
+        timings[backend] = time.perf_counter() - start
+    return timings
+
+def _revision():
+    """
+    Return the git revision of the benchmarked code, if available.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(cc.__file__)), stderr=subprocess.STDOUT
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(files, lines, hunks, hunk_size, renames, seed, repeat, workdir=None):
+    """
+    Generate the input, run the stages `repeat` times and return the
+    results as a JSON-serializable dictionary.  The best time of each
+    stage is kept.
+    """
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix='jacoco-bench-')
+
+    try:
+        changed = generate(workdir, files, lines, hunks, hunk_size, renames, seed)
+
+        best = dict()
+        parsers = dict()
+        for _ in range(repeat):
+            for (stage, seconds) in run_stages(workdir).items():
+                best[stage] = min(seconds, best.get(stage, seconds))
+            for (backend, seconds) in time_parsers(workdir).items():
+                parsers[backend] = min(seconds, parsers.get(backend, seconds))
+        peaks = peak_memory(workdir)
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir)
+
+    stages = dict()
+    for (stage, seconds) in best.items():
+        stages[stage] = {
+            'seconds': seconds,
+            'changed_lines_per_second': changed / seconds if seconds else None,
+            'files_per_second': files / seconds if seconds else None,
+            'peak_memory_bytes': peaks[stage],
+        }
+
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'shape': {'files': files, 'lines': lines, 'hunks': hunks, 'hunk_size': hunk_size,
+                  'renames': renames, 'seed': seed, 'repeat': repeat},
+        'changed_lines': changed,
+        'stages': stages,
+        'parsers': {'seconds': parsers},
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark coverage_on_new_code on synthetic input.')
+    parser.add_argument('--files', type=int, default=200, help='number of changed source files (default: 200)')
+    parser.add_argument('--lines', type=int, default=2000, help='lines per source file (default: 2000)')
+    parser.add_argument('--hunks', type=int, default=10, help='hunks per file (default: 10)')
+    parser.add_argument('--hunk-size', type=int, default=20, help='added lines per hunk (default: 20)')
+    parser.add_argument('--renames', type=float, default=0.0,
+                        help='fraction of files changed through a rename (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generated input (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best is kept (default: 3)')
+    parser.add_argument('--workdir', help='keep the generated input in this (new) directory')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    arguments = parser.parse_args()
+
+    results = benchmark(arguments.files, arguments.lines, arguments.hunks, arguments.hunk_size,
+                        arguments.renames, arguments.seed, arguments.repeat, arguments.workdir)
+
+    print('{0} files, {1} changed lines'.format(arguments.files, results['changed_lines']))
+    print('{0:<16} {1:>10} {2:>14} {3:>10} {4:>12}'.format('stage', 'seconds', 'lines/s', 'files/s', 'peak MB'))
+    for stage in ('diff', 'report_html', 'report_prefetch', 'report_xml', 'render'):
+        result = results['stages'][stage]
+        print('{0:<16} {1:>10.4f} {2:>14.0f} {3:>10.1f} {4:>12.2f}'.format(
+            stage, result['seconds'], result['changed_lines_per_second'] or 0,
+            result['files_per_second'] or 0, result['peak_memory_bytes'] / 1024.0 / 1024.0))
+
+    print('parsers: {0}'.format(
+        ', '.join('{0} {1:.4f}s'.format(backend, seconds) for (backend, seconds) in sorted(
+            results['parsers']['seconds'].items(), key=lambda item: item[1]))))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
@@ -4,10 +4,37 @@ Created on Aug 2, 2016
 @author: ming.li
 '''
 from __future__ import unicode_literals
+import os
 import sys
 import re
+import array
+import bisect
+import heapq
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import mmap
+import multiprocessing
+import queue
+import struct
+import subprocess
+import threading
+import time
+import tracemalloc
 import xml.etree.ElementTree as ET
-# from diff_cover.git_diff import GitDiffTool
+import xml.parsers.expat as expat
+from html.entities import name2codepoint
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
 
 class GitDiffError(Exception):
@@ -16,27 +43,454 @@ class GitDiffError(Exception):
     """
     pass
 
+class _StageTiming(object):
+    """
+    Seconds (and allocated bytes, if traced) of one pass through a stage.
+    """
+    __slots__ = ('seconds', 'allocated')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.allocated = None
+
+class Profiler(object):
+    """
+    Collect the wall time and allocations of the stages of a run
+    (diff reading and parsing, page resolution, page parsing, line
+    lookup, HTML rendering) and the time spent on every file.
+
+    The seconds of a stage do not include the stages nested in it, so
+    e.g. reading the diff is not counted again as parsing it.  With
+    `trace_allocations`, the net bytes allocated during each stage
+    (as seen by tracemalloc) are collected as well.  A disabled
+    profiler only costs a function call per stage.
+    """
+
+    def __init__(self, enabled=False, trace_allocations=False):
+        self.enabled = enabled
+        self.trace_allocations = trace_allocations
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # stage -> {'seconds', 'calls', 'allocated_bytes'}
+        self.stages = dict()
+        # file -> {stage: seconds}
+        self.files = dict()
+        # Stages can be timed from several threads (see `PagePrefetcher`)
+        self._local = threading.local()
+
+    @property
+    def _nested(self):
+        """
+        Seconds spent in nested stages, one entry per open stage of the
+        current thread.
+        """
+        nested = getattr(self._local, 'nested', None)
+        if nested is None:
+            nested = self._local.nested = []
+        return nested
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        """
+        Time the enclosed block as stage `name`, optionally on behalf
+        of `file`.  Yields a `_StageTiming` filled in when it ends.
+        """
+        timing = _StageTiming()
+        if not self.enabled:
+            yield timing
+            return
+
+        tracing = self.trace_allocations and tracemalloc.is_tracing()
+        allocated = tracemalloc.get_traced_memory()[0] if tracing else None
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            elapsed = time.perf_counter() - start
+            timing.seconds = elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            if tracing:
+                timing.allocated = tracemalloc.get_traced_memory()[0] - allocated
+            self.add(name, timing.seconds, timing.allocated, file=file)
+
+    def iter_timed(self, name, iterable):
+        """
+        Return `iterable`, timing the production of every item as
+        stage `name` when enabled.
+        """
+        if not self.enabled:
+            return iterable
+        return self._iter_timed(name, iterable)
+
+    def _iter_timed(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds, allocated=None, calls=1, file=None):
+        """
+        Account `seconds` (and `allocated` bytes) to stage `name`.
+        """
+        with self._lock:
+            totals = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'allocated_bytes': None})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+            if allocated is not None:
+                totals['allocated_bytes'] = (totals['allocated_bytes'] or 0) + allocated
+            if file is not None:
+                timings = self.files.setdefault(file, dict())
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    def snapshot(self):
+        """
+        Return the collected data, to be passed to `merge` (e.g. from
+        a worker process to the main one).
+        """
+        return {'stages': self.stages, 'files': self.files}
+
+    def merge(self, snapshot):
+        for (name, totals) in snapshot['stages'].items():
+            self.add(name, totals['seconds'], totals['allocated_bytes'], totals['calls'])
+        for (file, timings) in snapshot['files'].items():
+            for (name, seconds) in timings.items():
+                merged = self.files.setdefault(file, dict())
+                merged[name] = merged.get(name, 0.0) + seconds
+
+    def to_dict(self):
+        """
+        Return the collected data with the files slowest first.
+        """
+        files = []
+        for (file, timings) in self.files.items():
+            entry = {'file': file, 'seconds': sum(timings.values())}
+            entry.update(timings)
+            files.append(entry)
+        files.sort(key=lambda entry: (-entry['seconds'], entry['file']))
+        return {'stages': self.stages, 'files': files}
+
+    def write(self, path):
+        """
+        Write the collected data to `path` as JSON.
+        """
+        with open(path, 'w') as output:
+            json.dump(self.to_dict(), output, indent=2, sort_keys=True)
+
+# The profiler of the current run, disabled unless `start_profiling` was called
+PROFILER = Profiler()
+
+def start_profiling(trace_allocations=True):
+    """
+    Enable the module profiler (see `Profiler`) and return it.
+    """
+    global PROFILER
+    PROFILER = Profiler(True, trace_allocations)
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return PROFILER
+
+class LineRanges(object):
+    """
+    A set of line numbers stored as sorted, non-overlapping
+    `(START, END)` ranges (both ends included).
+
+    Big hunks cost one range instead of one list entry per line,
+    merging and subtracting are a single linear sweep and membership
+    is a binary search.  Iterating yields the line numbers in
+    ascending order, so it can be used wherever a sorted list of line
+    numbers was used before.
+    """
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for (start, end) in ranges:
+            self.add_range(start, end)
+
+    @classmethod
+    def from_lines(cls, line_numbers):
+        """
+        Build the ranges from any iterable of line numbers.
+        """
+        result = cls()
+        for line in line_numbers:
+            result.add(line)
+        return result
+
+    def add(self, line):
+        """
+        Add a single line number.
+        """
+        self.add_range(line, line)
+
+    def add_range(self, start, end):
+        """
+        Add the lines `start` to `end` (both included).  Adding after
+        the last range, as a diff parser does, takes constant time.
+        """
+        starts, ends = self._starts, self._ends
+
+        # Fast paths: past the last range, or touching it
+        if not ends or start > ends[-1] + 1:
+            starts.append(start)
+            ends.append(end)
+            return
+        if start >= starts[-1]:
+            ends[-1] = max(ends[-1], end)
+            return
+
+        # Ranges [i, j) overlap or touch the new one and are merged into it
+        i = bisect.bisect_left(ends, start - 1)
+        j = bisect.bisect_right(starts, end + 1)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def ranges(self):
+        """
+        Return the `(START, END)` ranges in ascending order.
+        """
+        return list(zip(self._starts, self._ends))
+
+    def last(self):
+        """
+        Return the highest line number, or None if there are no lines.
+        """
+        return self._ends[-1] if self._ends else None
+
+    def union(self, other):
+        """
+        Return a new `LineRanges` with the lines of both.
+        """
+        # Both are sorted, so merging them keeps every add on a fast path
+        return LineRanges(heapq.merge(self.ranges(), other.ranges()))
+
+    def subtract(self, other):
+        """
+        Return a new `LineRanges` with the lines of `other` removed.
+        """
+        result = LineRanges()
+        removed = other.ranges()
+        k = 0
+
+        for (start, end) in self.ranges():
+
+            # Skip removed ranges that end before this one
+            while k < len(removed) and removed[k][1] < start:
+                k += 1
+
+            # Cut out every removed range that overlaps this one
+            m = k
+            while m < len(removed) and removed[m][0] <= end:
+                if removed[m][0] > start:
+                    result.add_range(start, removed[m][0] - 1)
+                start = max(start, removed[m][1] + 1)
+                m += 1
+
+            if start <= end:
+                result.add_range(start, end)
+
+        return result
+
+    def __contains__(self, line):
+        i = bisect.bisect_right(self._starts, line) - 1
+        return i >= 0 and self._ends[i] >= line
+
+    def __iter__(self):
+        for (start, end) in zip(self._starts, self._ends):
+            for line in range(start, end + 1):
+                yield line
+
+    def __len__(self):
+        return sum(end - start + 1 for (start, end) in zip(self._starts, self._ends))
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return isinstance(other, LineRanges) and self.ranges() == other.ranges()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LineRanges({0!r})'.format(self.ranges())
+
+class _GitDiffOutput(object):
+    """
+    The output of a running `git diff`, as an iterable over its lines.
+
+    A thread reads the output as soon as git writes it, so several
+    `git diff` can run at the same time while the output of one of them
+    is being parsed.  No more than `MAX_QUEUED_LINES` lines are held
+    waiting to be parsed: beyond that, the reader waits and git blocks
+    on a full pipe, however large the diff.
+
+    If the lines are not all read, because the caller stops early or
+    raises, `close()` kills git and reaps it.
+    """
+
+    MAX_QUEUED_LINES = 4096
+
+    def __init__(self, command, cwd=None):
+        self._command = command
+        self._lines = queue.Queue(maxsize=self.MAX_QUEUED_LINES)
+        self._stderr = []
+        self._closed = False
+        self._finished = False
+
+        try:
+            self._process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as err:
+            raise GitDiffError("Could not run '{0}': {1}".format(' '.join(command), err))
+
+        self._threads = [
+            threading.Thread(target=self._read, args=(self._process.stdout, self._lines.put)),
+            threading.Thread(target=self._read, args=(self._process.stderr, self._stderr.append)),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, pipe, put):
+        with pipe:
+            for line in iter(pipe.readline, b''):
+                if self._closed:
+                    break
+                put(line)
+        put(None)
+
+    def __iter__(self):
+        """
+        Yield the lines of the output as they are written.
+
+        Raises a GitDiffError if `git diff` fails.
+        """
+        try:
+            while True:
+                line = self._lines.get()
+                if line is None:
+                    self._finished = True
+                    break
+                yield line.decode('utf-8', 'replace')
+        finally:
+            if not self._finished:
+                self.close()
+
+        returncode = self._process.wait()
+        for thread in self._threads:
+            thread.join()
+        if returncode != 0:
+            stderr = b''.join(line for line in self._stderr if line is not None)
+            raise GitDiffError("'{0}' failed: {1}".format(
+                ' '.join(self._command), stderr.decode('utf-8', 'replace').strip()))
+
+    def close(self):
+        """
+        Kill `git diff` if it is still running, and wait for it and for
+        the reader threads to end.  The lines not read yet are dropped.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._process.poll() is None:
+            self._process.kill()
+
+        # Unblock the reader until it has put its end marker
+        while not self._finished:
+            if self._lines.get() is None:
+                self._finished = True
+        self._process.wait()
+        for thread in self._threads:
+            thread.join()
+
+def _close_all(iterables):
+    """
+    Close each of `iterables` that can be closed, such as the output of
+    a running `git diff` or a generator reading it.
+    """
+    for iterable in iterables:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+class GitDiffTool(object):
+    """
+    Run `git diff` in a local repository, with the interface of
+    diff-cover's `git_diff.GitDiffTool`.
+
+    Each method starts its `git diff` right away and returns an
+    iterable over the lines of its output (see `_GitDiffOutput`).
+    """
+
+    def __init__(self, repo_dir=None, git='git'):
+        self._repo_dir = repo_dir
+        self._git = git
+
+    def diff_committed(self, compare_branch='origin/master'):
+        """
+        Changes committed since the branch forked from `compare_branch`.
+        """
+        return self._diff('{branch}...HEAD'.format(branch=compare_branch))
+
+    def diff_staged(self):
+        """
+        Changes staged for the next commit.
+        """
+        return self._diff('--cached')
+
+    def diff_unstaged(self):
+        """
+        Changes in the working tree that are not staged.
+        """
+        return self._diff()
+
+    def _diff(self, *args):
+        # Fixed prefixes and no external tools, whatever the user's git config
+        command = [self._git, 'diff', '--no-color', '--no-ext-diff', '--src-prefix=a/', '--dst-prefix=b/']
+        return _GitDiffOutput(command + list(args), self._repo_dir)
+
 class GitDiffReporter():
     """
     Query information from a Git diff between branches.
     """
 
-    def __init__(self, diff_filepath=None):
+    def __init__(self, diff_filepath=None, diff_lines=None, compare_branch=None, git_diff=None,
+                 staged=False, unstaged=False):
         """
         Configure the reporter to use `git_diff` as the wrapper
         for the `git diff` tool.  (Should have same interface
         as `git_diff.GitDiffTool`)
-        """
-#         name = "{branch}...HEAD, staged, and unstaged changes".format(branch=compare_branch)
-#         super(GitDiffReporter, self).__init__(name)
 
-#         self._compare_branch = compare_branch
-#         self._git_diff_tool = diff_filepath
-#         self._ignore_unstaged = ignore_unstaged
+        `diff_lines` is an iterable over the lines of an already
+        available diff, used instead of reading `diff_filepath`.
+
+        With `compare_branch`, `git diff` is run instead (by default in
+        the current directory) for the changes since that branch, plus
+        the `staged` and `unstaged` changes if asked for.
+        """
         self._diff_filepath=diff_filepath
+        self._diff_lines=diff_lines
+
+        self._compare_branch = compare_branch
+        self._git_diff_tool = git_diff if git_diff is not None else GitDiffTool()
+        self._staged = staged
+        self._unstaged = unstaged
 
         # Cache diff information as a dictionary
-        # with file path keys and line number list values
+        # with file path keys and `LineRanges` values
         self._diff_dict = None
 
     def clear_cache(self):
@@ -66,28 +520,94 @@ class GitDiffReporter():
         diff_dict = self._git_diff()
 
         # Look up the modified lines for the source file
-        # If no lines modified, return an empty list
-        return diff_dict.get(src_path, [])
+        # If no lines modified, return an empty `LineRanges`
+        return diff_dict.get(src_path, LineRanges())
+
+    def iter_changes(self):
+        """
+        Yield `(SRC_PATH, ADDED_LINES, DELETED_LINES)` for each source
+        file section of each included stage, as soon as the section
+        has been read.  This does not use or fill the cache, so the
+        caller can start working on a file before the whole diff has
+        been read.
+        """
+        with self._included_diff_results() as included:
+            for diff_lines in included:
+                for change in self._iter_diff_lines(diff_lines):
+                    yield change
+
+    def iter_lines_changed(self):
+        """
+        Yield `(SRC_PATH, LINE_RANGES)` for every changed file, with the
+        same lines as `_git_diff()`, and fill its cache once done.
 
-    def _get_included_diff_results(self):
+        With a single stage (a diff file, or the committed changes
+        only), a file is yielded as soon as its section has been read,
+        so that its coverage can be looked up while the rest of the
+        diff is read; a file showing up in several sections is yielded
+        again with all of its lines so far.  Stages change each other's
+        lines, so with several of them the whole diff is read first.
         """
-        Return a list of stages to be included in the diff results.
+        if self._diff_dict is not None or self._staged or self._unstaged:
+            for item in self._git_diff().items():
+                yield item
+            return
+
+        result_dict = dict()
+        with contextlib.closing(self.iter_changes()) as changes:
+            for (src_path, added_lines, _) in changes:
+                if src_path in result_dict:
+                    added_lines = result_dict[src_path].union(added_lines)
+                result_dict[src_path] = added_lines
+                yield src_path, added_lines
+        self._diff_dict = result_dict
+
+    @contextlib.contextmanager
+    def _included_diff_results(self):
+        """
+        Give a list of stages to be included in the diff results.
+        Each stage is an iterable over the lines of its `git diff` output.
+
+        The `git diff` still running when the block is left, early or
+        on an error, are stopped.
         """
-#         included = [self._git_diff_tool.diff_committed(self._compare_branch),
-#                     self._git_diff_tool.diff_staged()]
-#         if not self._ignore_unstaged:
-#             included.append(self._git_diff_tool.diff_unstaged())
+        running = []
+        if self._compare_branch is not None:
+            # Every stage is started before any is read, so the
+            # `git diff` processes run concurrently
+            try:
+                running.append(self._git_diff_tool.diff_committed(self._compare_branch))
+                if self._staged:
+                    running.append(self._git_diff_tool.diff_staged())
+                if self._unstaged:
+                    running.append(self._git_diff_tool.diff_unstaged())
+            except Exception:
+                _close_all(running)
+                raise
+            included = [PROFILER.iter_timed('diff_reading', stage) for stage in running]
+        elif self._diff_lines is not None:
+            included=[self._diff_lines]
+        else:
+            included=[PROFILER.iter_timed('diff_reading', self._read_diff_file())]
 
-        
-        included=[open(self._diff_filepath).read()]
-#         print(included)
-        return included
+        try:
+            yield included
+        finally:
+            _close_all(running)
+
+    def _read_diff_file(self):
+        """
+        Read the diff file one line at a time.
+        """
+        with open(self._diff_filepath) as diff_file:
+            for line in diff_file:
+                yield line
 
     def _git_diff(self):
         """
         Run `git diff` and returns a dict in which the keys
-        are changed file paths and the values are lists of
-        line numbers.
+        are changed file paths and the values are `LineRanges`
+        of line numbers.
 
         Guarantees that each line number within a file
         is unique (no repeats) and in ascending order.
@@ -100,25 +620,23 @@ class GitDiffReporter():
         # If we do not have a cached result, execute `git diff`
         if self._diff_dict is None:
 
-            result_dict = dict()
-
-            for diff_str in self._get_included_diff_results():
-                # Parse the output of the diff string
-                diff_dict = self._parse_diff_str(diff_str)
+            # Time spent reading the diff is accounted separately
+            with PROFILER.stage('diff_parsing'):
+                result_dict = dict()
 
-                for src_path in diff_dict.keys():
-                    added_lines, deleted_lines = diff_dict[src_path]
+                with self._included_diff_results() as included:
+                    for diff_lines in included:
+                        # Parse the output of the diff
+                        diff_dict = self._parse_diff_lines(diff_lines)
 
-                    # Remove any lines from the dict that have been deleted
-                    # Include any lines that have been added
-                    result_dict[src_path] = [
-                        line for line in result_dict.get(src_path, [])
-                        if not line in deleted_lines
-                    ] + added_lines
+                        for src_path in diff_dict.keys():
+                            added_lines, deleted_lines = diff_dict[src_path]
 
-            # Eliminate repeats and order line numbers
-            for (src_path, lines) in result_dict.items():
-                result_dict[src_path] = self._unique_ordered_lines(lines)
+                            # Remove any lines from the dict that have been deleted
+                            # Include any lines that have been added
+                            result_dict[src_path] = result_dict.get(
+                                src_path, LineRanges()
+                            ).subtract(deleted_lines).union(added_lines)
 
             # Store the resulting dict
             self._diff_dict = result_dict
@@ -137,156 +655,122 @@ class GitDiffReporter():
 
             { SRC_PATH: (ADDED_LINES, DELETED_LINES) }
 
-        where `ADDED_LINES` and `DELETED_LINES` are lists of line
-        numbers added/deleted respectively.
+        where `ADDED_LINES` and `DELETED_LINES` are `LineRanges` of
+        line numbers added/deleted respectively.
 
         If the output could not be parsed, raises a GitDiffError.
         """
+        return self._parse_diff_lines(diff_str.split('\n'))
+
+    def _parse_diff_lines(self, diff_lines):
+        """
+        Same as `_parse_diff_str`, but for `git diff` output given as
+        an iterable of lines (such as an open file).
+        """
 
         # Create a dict to hold results
         diff_dict = dict()
 
-        # Parse the diff string into sections by source file
-        sections_dict = self._parse_source_sections(diff_str)
-        for (src_path, diff_lines) in sections_dict.items():
-
-            # Parse the hunk information for the source file
-            # to determine lines changed for the source file
-            diff_dict[src_path] = self._parse_lines(diff_lines)
+        # A source file may show up in more than one section
+        # (e.g. merge conflicts), collect the lines of all of them
+        for (src_path, added_lines, deleted_lines) in self._iter_diff_lines(diff_lines):
+            if src_path in diff_dict:
+                diff_dict[src_path] = (
+                    diff_dict[src_path][0].union(added_lines),
+                    diff_dict[src_path][1].union(deleted_lines),
+                )
+            else:
+                diff_dict[src_path] = (added_lines, deleted_lines)
 
         return diff_dict
 
-    def _parse_source_sections(self, diff_str):
+    def _iter_diff_lines(self, diff_lines):
         """
-        Given the output of `git diff`, return a dictionary
-        with keys that are source file paths.
+        Given the output of `git diff` as an iterable of lines, yield
+        a tuple of `(SRC_PATH, ADDED_LINES, DELETED_LINES)` for each
+        source file section as soon as the section ends.
 
-        Each value is a list of lines from the `git diff` output
-        related to the source file.
+        `ADDED_LINES` and `DELETED_LINES` are `LineRanges` of line
+        numbers added/deleted respectively.  Hunk lines are consumed as
+        they are read, so only the line ranges of the current section
+        are held in memory.
 
-        Raises a `GitDiffError` if `diff_str` is in an invalid format.
+        Raises a `GitDiffError` if the diff is in an invalid format.
         """
 
-        # Create a dict to map source files to lines in the diff output
-        source_dict = dict()
-
         # Keep track of the current source file
         src_path = None
+        added_lines = LineRanges()
+        deleted_lines = LineRanges()
 
         # Signal that we've found a hunk (after starting a source file)
         found_hunk = False
 
-        # Parse the diff string into sections by source file
-        for line in diff_str.split('\n'):
+        current_line_new = None
+        current_line_old = None
+
+        for line in diff_lines:
+            line = line.rstrip('\n')
 
             # If the line starts with "diff --git"
             # or "diff --cc" (in the case of a merge conflict)
             # then it is the start of a new source file
             if line.startswith('diff --git') or line.startswith('diff --cc'):
 
+                # The previous source file section is complete
+                if src_path is not None:
+                    yield src_path, added_lines, deleted_lines
+
                 # Retrieve the name of the source file
                 src_path = self._parse_source_line(line)
-
-                # Create an entry for the source file, if we don't
-                # already have one.
-                if src_path not in source_dict:
-                    source_dict[src_path] = []
+                added_lines = LineRanges()
+                deleted_lines = LineRanges()
 
                 # Signal that we're waiting for a hunk for this source file
                 found_hunk = False
+                current_line_new = None
+                current_line_old = None
 
-            # Every other line is stored in the dictionary for this source file
-            # once we find a hunk section
-            else:
-
-                # Only add lines if we're in a hunk section
-                # (ignore index and files changed lines)
-                if found_hunk or line.startswith('@@'):
-
-                    # Remember that we found a hunk
-                    found_hunk = True
-
-                    if src_path is not None:
-                        source_dict[src_path].append(line)
-
-                    else:
-                        # We tolerate other information before we have
-                        # a source file defined, unless it's a hunk line
-                        if line.startswith("@@"):
-                            msg = "Hunk has no source file: '{0}'".format(line)
-                            raise GitDiffError(msg)
-
-        return source_dict
-
-    def _parse_lines(self, diff_lines):
-        """
-        Given the diff lines output from `git diff` for a particular
-        source file, return a tuple of `(ADDED_LINES, DELETED_LINES)`
-
-        where `ADDED_LINES` and `DELETED_LINES` are lists of line
-        numbers added/deleted respectively.
+            # Only look at lines once we're in a hunk section
+            # (ignore index and files changed lines)
+            elif found_hunk or line.startswith('@@'):
 
-        Raises a `GitDiffError` if the diff lines are in an invalid format.
-        """
-
-        added_lines = []
-        deleted_lines = []
-
-        current_line_new = None
-        current_line_old = None
-
-        for line in diff_lines:
-
-            # If this is the start of the hunk definition, retrieve
-            # the starting line number
-            if line.startswith('@@'):
-                line_num = self._parse_hunk_line(line)
-                current_line_new, current_line_old = line_num, line_num
+                # Remember that we found a hunk
+                found_hunk = True
 
-            # This is an added/modified line, so store the line number
-            elif line.startswith('+'):
+                if src_path is None:
+                    # We tolerate other information before we have
+                    # a source file defined, unless it's a hunk line
+                    if line.startswith("@@"):
+                        msg = "Hunk has no source file: '{0}'".format(line)
+                        raise GitDiffError(msg)
 
-                # Since we parse for source file sections before
-                # calling this method, we're guaranteed to have a source
-                # file specified.  We check anyway just to be safe.
-                if current_line_new is not None:
+                # If this is the start of the hunk definition, retrieve
+                # the starting line number
+                elif line.startswith('@@'):
+                    line_num = self._parse_hunk_line(line)
+                    current_line_new, current_line_old = line_num, line_num
 
-                    # Store the added line
-                    added_lines.append(current_line_new)
-
-                    # Increment the line number in the file
+                # This is an added/modified line, so store the line number
+                elif line.startswith('+'):
+                    added_lines.add(current_line_new)
                     current_line_new += 1
 
-            # This is a deleted line that does not exist in the final
-            # version, so skip it
-            elif line.startswith('-'):
-
-                # Since we parse for source file sections before
-                # calling this method, we're guaranteed to have a source
-                # file specified.  We check anyway just to be safe.
-                if current_line_old is not None:
-
-                    # Store the deleted line
-                    deleted_lines.append(current_line_old)
-
-                    # Increment the line number in the file
+                # This is a deleted line that does not exist in the final
+                # version, so skip it
+                elif line.startswith('-'):
+                    deleted_lines.add(current_line_old)
                     current_line_old += 1
 
-            # This is a line in the final version that was not modified.
-            # Increment the line number, but do not store this as a changed
-            # line.
-            else:
-                if current_line_old is not None:
+                # This is a line in the final version that was not modified.
+                # Increment the line number, but do not store this as a changed
+                # line.
+                else:
                     current_line_old += 1
-
-                if current_line_new is not None:
                     current_line_new += 1
 
-                # If we are not in a hunk, then ignore the line
-                else:
-                    pass
-
-        return added_lines, deleted_lines
+        if src_path is not None:
+            yield src_path, added_lines, deleted_lines
 
     def _parse_source_line(self, line):
         """
@@ -356,182 +840,3187 @@ class GitDiffReporter():
             msg = "Could not parse hunk in line '{0}'".format(line)
             raise GitDiffError(msg)
 
-    @staticmethod
-    def _unique_ordered_lines(line_numbers):
+class StaleReportMap(object):
+    """
+    Translate line numbers of the current sources into line numbers of
+    the older sources a coverage report was built from, using the diff
+    between the two (`git diff <report commit> <current commit>`).
+
+    Each file gets an offset table: sorted line numbers where a run of
+    lines starts, with the offset to add to get the old line number, or
+    None for lines that changed since the report (their coverage is
+    unknown).  Files that are not in the diff did not move.
+    """
+
+    HUNK_RE = re.compile(r'^@@ -([0-9]+)(?:,([0-9]+))? \+([0-9]+)(?:,([0-9]+))? @@')
+
+    def __init__(self, diff_filepath=None, diff_lines=None):
+        # current path -> (path in the report, run starts, run offsets)
+        self._files = dict()
+
+        if diff_lines is None:
+            with open(diff_filepath) as diff_file:
+                self._parse(diff_file)
+        else:
+            self._parse(diff_lines)
+
+    def _parse(self, diff_lines):
         """
-        Given a list of line numbers, return a list in which each line
-        number is included once and the lines are ordered sequentially.
+        Build the offset tables from the lines of the diff.
         """
+        old_path = new_path = None
+        starts = offsets = None
+        old_line = new_line = None
 
-        if len(line_numbers) == 0:
-            return []
+        def run(start, offset):
+            # Start a run at `start`, replacing a run starting at the same
+            # line and skipping runs that would not change the offset
+            if starts and starts[-1] == start:
+                starts.pop()
+                offsets.pop()
+            if not offsets or offsets[-1] != offset:
+                starts.append(start)
+                offsets.append(offset)
 
-        # Ensure lines are unique by putting them in a set
-        line_set = set(line_numbers)
+        for line in diff_lines:
+            line = line.rstrip('\n')
 
-        # Retrieve the list from the set, sort it, and return
-        return sorted([line for line in line_set])
+            if line.startswith('diff --'):
+                old_path = new_path = None
+                starts = offsets = None
+                old_line = new_line = None
 
-"""
-compare the git diff and jacoco result
-generate the report of which java file changed, and how many lines be covered on new code.
-"""
-def report(diff_report, jacoco_html_report_path):
-    report={}
-    for key in diff_report.keys():
-        print("In parsing...->"+key)
-        if key.endswith(".java"):
-            javaname=re.search("(\w*)\.java",key).group();
-            path=re.search("com/(.*)/", key).group();
-            path=path.replace("/",".")[:-1]
-            link=path+"/"+javaname+".html"
-            jacoco_file_path=jacoco_html_report_path+link
-#             print(javaname, jacoco_file_path)
-            try:
-                tree = ET.parse(jacoco_file_path)
-            except ET.ParseError as err:
-                print(err)
-                report[path+javaname]={'link':0,'nc':0,'pc':0,'fc':0,'new':0}
-                continue
-                
-            xmlns = {'html': '{http://www.w3.org/1999/xhtml}'}
-            root = tree.getroot()
-            nc=0
-            fc=0
-            pc=0
-            new=0
-            for line_num in diff_report[key]:
-                find=".//{html}span[@id=\"L"+str(line_num)+"\"]"
-                find=find.format(**xmlns)
-#                 print(find)
-                line=root.find(find)
-                if line is None:
-#                     print('can not find'+find)
-                    pass
-                if line is not None:
-                    new+=1
-                    covered=line.get("class")
-                    if covered == 'nc':
-                        nc+=1
-                    if covered == 'pc':
-                        pc+=1
-                    if covered == 'fc':
-                        fc+=1
-#                     print(line.get('id'),covered)
-            report[path+javaname]={'link':link,'nc':nc,'pc':pc,'fc':fc,'new':new}
-#     print(report)        
-    return report
+            elif old_line is None and line.startswith(('rename from ', 'copy from ')):
+                old_path = line.split(' from ', 1)[1]
 
-"""
-covert the report to a html file, more friendly to user than a pain txt
-"""
-def generateHtml(report, jacoco_html_path):
+            elif old_line is None and line.startswith(('rename to ', 'copy to ')):
+                # A pure rename or copy has no `---`/`+++` lines nor hunks
+                new_path = line.split(' to ', 1)[1]
+                starts, offsets = [1], [0]
+                self._files[new_path] = (old_path, starts, offsets)
+
+            elif old_line is None and line.startswith('--- '):
+                old_path = None if line[4:] == '/dev/null' else line[4:].split('a/', 1)[-1]
+
+            elif old_line is None and line.startswith('+++ '):
+                new_path = None if line[4:] == '/dev/null' else line[4:].split('b/', 1)[-1]
+                if new_path is not None:
+                    starts, offsets = [1], [0]
+                    self._files[new_path] = (old_path, starts, offsets)
+
+            elif line.startswith('@@') and starts is not None:
+                match = self.HUNK_RE.match(line)
+                if match is None:
+                    raise GitDiffError("Could not parse hunk in line '{0}'".format(line))
+                old_start, old_count, new_start, new_count = match.groups()
+
+                # An empty side gives the line before the hunk
+                old_line = int(old_start) + (1 if old_count == '0' else 0)
+                new_line = int(new_start) + (1 if new_count == '0' else 0)
+                run(new_line, old_line - new_line)
+
+            elif new_line is not None:
+                if line.startswith('+'):
+                    run(new_line, None)
+                    new_line += 1
+                elif line.startswith('-'):
+                    old_line += 1
+                elif line.startswith('\\'):
+                    # "No newline at end of file"
+                    continue
+                else:
+                    old_line += 1
+                    new_line += 1
+
+                # Lines after this one did not change, until told otherwise
+                run(new_line, old_line - new_line)
+
+    def old_path(self, src_path):
+        """
+        Return the path of `src_path` in the report's sources.
+        """
+        entry = self._files.get(src_path)
+        if entry is None or entry[0] is None:
+            return src_path
+        return entry[0]
+
+    def old_line(self, src_path, line_num):
+        """
+        Return the line number of `line_num` of `src_path` in the
+        report's sources, or None if the line changed since.
+        """
+        entry = self._files.get(src_path)
+        if entry is None:
+            return line_num
+
+        _, starts, offsets = entry
+        offset = offsets[bisect.bisect_right(starts, line_num) - 1]
+        return None if offset is None else line_num + offset
+
+    def translate(self, diff_report):
+        """
+        Return `(DIFF_REPORT, UNKNOWN)` where `DIFF_REPORT` is
+        `diff_report` with paths and line numbers of the report's
+        sources, and `UNKNOWN` maps those paths to the number of changed
+        lines that changed again since the report was built.
+        """
+        translated = dict()
+        unknown = dict()
+
+        for (src_path, lines) in diff_report.items():
+            old_path = self.old_path(src_path)
+            old_lines = LineRanges()
+            missing = 0
+            for line_num in lines:
+                old_line = self.old_line(src_path, line_num)
+                if old_line is None:
+                    missing += 1
+                else:
+                    old_lines.add(old_line)
+            translated[old_path] = old_lines
+            unknown[old_path] = missing
+
+        return translated, unknown
+
+XHTML_NS = '{http://www.w3.org/1999/xhtml}'
+LINE_ID_RE = re.compile(r'^L([0-9]+)$')
+
+def index_source_page(source, max_line=None):
     """
-    Prepare the data for generate HTML.
+    Stream a JaCoCo source page and return a dictionary of the form:
+
+        { LINE_NUMBER: (STATUS, TITLE) }
+
+    where `STATUS` is one of 'nc', 'pc' or 'fc' and `TITLE` is the
+    branch summary JaCoCo puts on lines with branches (or None).
+
+    JaCoCo marks lines with branches with a second class such as
+    "pc bpc", so only the first class name is kept as the status.
+
+    The page is read incrementally: every element is dropped as soon
+    as it is closed, so memory does not grow with the page size.  If
+    `max_line` is given, reading stops at the first line after it.
+
+    Raises an `ET.ParseError` if the page is not well-formed.
     """
-    global id_a,id_b,id_c,id_d,id_e,id_f,id_g,id_h,id_i,id_j    
-    id_a = []
-    id_b = []
-    id_c = []
-    id_d = []
-    id_e = []
-    id_f = []
-    id_g = []
-    id_h = []
-    id_i = []
-    id_j = []
-    global total_new,total_nc,total_pc,total_fc
-    total_new=0
-    total_nc=0
-    total_pc=0
-    total_fc=0
-    for key in report:
-        total_new+=report[key]['new']
-        total_nc+=report[key]['nc']
-        total_pc+=report[key]['pc']
-        total_fc+=report[key]['fc']
-    for key in report:
-        id_a.append(key)
-        id_b.append(report[key]['new'])
-        id_c.append(report[key]['new']-report[key]['nc'])
-        id_d.append((report[key]['new']-report[key]['nc'])/float(report[key]['new']) if report[key]['new'] else 0)
-        id_e.append(report[key]['nc'])
-        id_f.append(report[key]['nc']/float(report[key]['new']) if report[key]['new'] else 0)
-        id_g.append(report[key]['pc'])
-        id_h.append(report[key]['pc']/float(report[key]['new']) if report[key]['new'] else 0)
-        id_i.append(report[key]['fc'])
-        id_j.append(report[key]['fc']/float(report[key]['new']) if report[key]['new'] else 0)
-
-    id_a.sort()
-    id_b.sort()
-    id_c.sort()
-    id_d.sort()
-    id_e.sort()
-    id_f.sort()
-    id_g.sort()
-    id_h.sort()
-    id_i.sort()
-    id_j.sort()
-
-    html='<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
-    html=html+'<html><head><meta http-equiv="Content-Type" content="text/html;charset=UTF-8" />\
-        <link rel="stylesheet" href=".resources/report.css" type="text/css" />\
-        <link rel="shortcut icon" href=".resources/report.gif" type="image/gif" />\
-        <title>code coverage</title><script type="text/javascript" src=".resources/sort.js"></script>\
-        </head><body onload="initialSort([{0}])">'.format("'coveragetable'")+\
-        '<div class="breadcrumb" id="breadcrumb"><span class="el_report">code coverage report</span></div><h1>Code Coverage on New Code Report</h1>'
-    table='<table class="coverage" cellspacing="0" id="coveragetable">'
-    table=table+'<thead><tr><td class="sortable" id="a" onclick="toggleSort(this)">File Name</td>\
-                 <td class="sortable" id="b" onclick="toggleSort(this)">New Lines</td>\
-                 <td class="sortable ctr1" id="c" onclick="toggleSort(this)">Covered</td>\
-                 <td class="sortable ctr2" id="d" onclick="toggleSort(this)">Cov.</td>\
-                 <td class="sortable ctr1" id="e" onclick="toggleSort(this)">No Covered</td>\
-                 <td class="sortable ctr2" id="f" onclick="toggleSort(this)">Cov.</td>\
-                 <td class="sortable ctr1" id="g" onclick="toggleSort(this)">Partical Covered</td>\
-                 <td class="sortable ctr2" id="h" onclick="toggleSort(this)">Cov.</td>\
-                 <td class="sortable ctr1" id="i" onclick="toggleSort(this)">Full Covered</td>\
-                 <td class="sortable ctr2" id="j" onclick="toggleSort(this)">Cov.</td></tr></thead>'            
- 
-    for key in report:            
-        table=table+'<tr><td id="a{0}">'.format(id_a.index(key))+\
-        '<a href="'+str(report[key]['link'])+'"class="el_package">'+key+\
-        '</a></td><td id="b{0}">'.format(id_b.index(report[key]['new']))+str(report[key]['new'])+\
-        '</td><td class="bar" id="c{0}">'.format(id_c.index(report[key]['new']-report[key]['nc']))+'<img src=".resources/greenbar.gif" width="'+str((report[key]['fc']+report[key]['pc'])/float(report[key]['new'])*100 if report[key]['new'] else 0)+\
-        '" height="10" title="'+str(report[key]['new']-report[key]['nc'])+'" alt="'+str(report[key]['new']-report[key]['nc'])+\
-        '"/><img src=".resources/redbar.gif" width="'+str((report[key]['nc'])/float(report[key]['new'])*100 if report[key]['new'] else 0)+\
-        '" height="10" title="'+str(report[key]['nc'])+'" alt="'+str(report[key]['nc'])+'"/>'\
-        '</td><td class="ctr2" id="d{0}">'.format(id_d.index((report[key]['new']-report[key]['nc'])/float(report[key]['new']) if report[key]['new'] else 0))+'{percent:.2%}'.format(percent=(report[key]['new']-report[key]['nc'])/float(report[key]['new']) if report[key]['new'] else 0)+\
-        '</td><td class="ctr1" id="e{0}">'.format(id_e.index(report[key]['nc']))+str(report[key]['nc'])+\
-        '</td><td class="ctr2" id="f{0}">'.format(id_f.index(report[key]['nc']/float(report[key]['new']) if report[key]['new'] else 0))+'{percent:.2%}'.format(percent=report[key]['nc']/float(report[key]['new']) if report[key]['new'] else 0)+\
-        '</td><td class="ctr1" id="g{0}">'.format(id_g.index(report[key]['pc']))+str(report[key]['pc'])+\
-        '</td><td class="ctr2" id="h{0}">'.format(id_h.index(report[key]['pc']/float(report[key]['new'])) if report[key]['new'] else 0)+'{percent:.2%}'.format(percent=report[key]['pc']/float(report[key]['new']) if report[key]['new'] else 0)+\
-        '</td><td class="ctr1" id="i{0}">'.format(id_i.index(report[key]['fc']))+str(report[key]['fc'])+\
-        '</td><td class="ctr2" id="j{0}">'.format(id_j.index(report[key]['fc']/float(report[key]['new']) if report[key]['new'] else 0))+\
-        '{percent:.2%}'.format(percent=report[key]['fc']/float(report[key]['new']) if report[key]['new'] else 0)+\
-        '</td></tr>'
-    table=table+'<tfoot><tr><td>'+' Total'+'</td><td>'+str(total_new)+\
-    '</td><td class="bar"><img  src=".resources/greenbar.gif" width="'+str(float(total_fc+total_pc)/float(total_new)*100 if total_new else 0)+\
-    '" height="10" title="'+str(total_fc+total_pc)+'" alt="'+str(total_fc+total_pc)+\
-    '"/><img src=".resources/redbar.gif" width="'+str(float(total_nc)/float(total_new)*100 if total_new else 0)+\
-    '" height="10" title="'+str(total_nc)+'" alt="'+str(total_nc)+'"/>'\
-    '</td><td class="ctr2">'+'{percent:.2%}'.format(percent=((total_fc+total_pc)/float(total_new) if total_new else 0))+\
-    '</td><td class="ctr1">'+str(total_nc)+'</td><td class="ctr2">'+'{percent:.2%}'.format(percent=total_nc/float(total_new) if total_new else 0)+\
-    '</td><td class="ctr1">'+str(total_pc)+'</td><td class="ctr2">'+'{percent:.2%}'.format(percent=total_pc/float(total_new) if total_new else 0)+\
-    '</td><td class="ctr1">'+str(total_fc)+'</td><td class="ctr2">'+'{percent:.2%}'.format(percent=total_fc/float(total_new) if total_new else 0)+\
-    '</td></tr></tfoot></table>'            
-    html=html+table
-    html=html+'<div class="footer"><span class="right">Code Coverage on new code Report</span></div>'
-    html=html+'</body></html>'   
-    with open(jacoco_html_path+"/coverageOnNewCode.html", 'w') as file:
-       file.write(html)
-    if total_new > 0 :   
-        return '{percent:.2%}'.format(percent=(total_new-total_nc)/float(total_new))
-    else:
-        return '100%'
+    return dict(iter_source_page(source, max_line))
 
-def toHtml(report, jacoco_html_path):
-    html='<html><body><table>'
-    table='<tr><th>file name</th><th>new lines</th><th>no covered</th><th>partical covered</th><th>full covered</th><th>link</th></tr>'
+def iter_source_page(source, max_line=None):
+    """
+    Same as `index_source_page`, but yield the
+    `(LINE_NUMBER, (STATUS, TITLE))` entries in line order while the
+    page is being read.
+
+    The page is read by the parser backend chosen with
+    `set_parser_backend` (see `PARSER_BACKENDS`); all of them give the
+    same entries, in the order of the start tags, and raise an
+    `ET.ParseError` on malformed pages.  The page's DTD is not read, so
+    the XHTML entities it declares, such as `&nbsp;`, are left out of
+    the titles.
+    """
+    return PARSER_BACKENDS[_parser_backend](source, max_line)
+
+def _span_entry(get):
+    """
+    Return the `(LINE_NUMBER, (STATUS, TITLE))` entry of a `<span>`
+    element whose attributes are read with `get`, or None if the span
+    is not a source line.
+    """
+    match = LINE_ID_RE.match(get('id') or '')
+    if match is None:
+        return None
+
+    classes = (get('class') or '').split()
+    status = classes[0] if classes else None
+    return int(match.group(1)), (status, get('title'))
+
+def _iter_page_etree(source, max_line=None):
+    """
+    `iter_source_page` with ElementTree's `iterparse`.  Unlike the
+    other backends, it fails on an entity in text that XHTML does not
+    declare either, which JaCoCo never writes.
+    """
+    # Elements that are still open; closed ones are detached from
+    # their parent right away so the tree never builds up
+    parents = []
+
+    # ElementTree fails on the XHTML entities in text, as it does not
+    # read the DTD declaring them (in attributes, expat skips them)
+    parser = ET.XMLParser(target=ET.TreeBuilder())
+    parser.entity.update((name, chr(code)) for (name, code) in name2codepoint.items())
+
+    with open(source, 'rb') as page:
+        for event, elem in ET.iterparse(page, events=('start', 'end'), parser=parser):
+
+            if event == 'end':
+                parents.pop()
+                if parents:
+                    parents[-1].remove(elem)
+                continue
+
+            parents.append(elem)
+
+            if elem.tag != XHTML_NS + 'span':
+                continue
+
+            entry = _span_entry(elem.get)
+            if entry is None:
+                continue
+
+            # Lines are in document order, nothing after this is needed
+            if max_line is not None and entry[0] > max_line:
+                break
+
+            yield entry
+
+class _StopParsing(Exception):
+    """
+    Raised from an expat handler to stop reading a page.
+    """
+
+# How much of a page expat is given at a time
+EXPAT_CHUNK_SIZE = 64 * 1024
+
+def _iter_page_expat(source, max_line=None):
+    """
+    `iter_source_page` with a bare expat parser: only start tags are
+    reported, and only `<span>` ones are looked at.  No element objects
+    are built at all.
+    """
+    span = XHTML_NS[1:-1] + ' span'
+    entries = []
+
+    def start_element(name, attributes):
+        if name != span:
+            return
+        entry = _span_entry(attributes.get)
+        if entry is None:
+            return
+        if max_line is not None and entry[0] > max_line:
+            raise _StopParsing()
+        entries.append(entry)
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.StartElementHandler = start_element
+
+    with open(source, 'rb') as page:
+        while True:
+            chunk = page.read(EXPAT_CHUNK_SIZE)
+            try:
+                parser.Parse(chunk, not chunk)
+            except _StopParsing:
+                chunk = None
+            except expat.ExpatError as err:
+                raise ET.ParseError(str(err))
+            finally:
+                # Entries found before a stop or an error are still valid
+                for entry in entries:
+                    yield entry
+                del entries[:]
+
+            if not chunk:
+                break
+
+def _iter_page_lxml(source, max_line=None):
+    """
+    `iter_source_page` with lxml's `iterparse`, filtered on `<span>`
+    elements by libxml2 itself.
+    """
+    try:
+        # Entities are left unresolved, as expat skips undeclared ones
+        for event, elem in lxml_etree.iterparse(source, events=('start', 'end'), tag=XHTML_NS + 'span',
+                                                resolve_entities=False):
+            if event == 'end':
+                # Drop the span and the ones before it
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                continue
+
+            entry = _span_entry(elem.get)
+            if entry is None:
+                continue
+            if max_line is not None and entry[0] > max_line:
+                break
+            yield entry
+    except lxml_etree.XMLSyntaxError as err:
+        raise ET.ParseError(str(err))
+
+# Page parser backends, fastest first as timed by benchmark.py: expat,
+# etree (expat behind ElementTree events), then lxml, which is only there
+# when installed ('auto' picks the first)
+PARSER_BACKENDS = collections.OrderedDict([('expat', _iter_page_expat), ('etree', _iter_page_etree)])
+if lxml_etree is not None:
+    PARSER_BACKENDS['lxml'] = _iter_page_lxml
+
+_parser_backend = next(iter(PARSER_BACKENDS))
+
+def set_parser_backend(name='auto'):
+    """
+    Choose the backend reading the report pages: one of
+    `PARSER_BACKENDS`, or 'auto' for the fastest available one.
+    Raises a ValueError for a backend that is not available.
+    """
+    global _parser_backend
+
+    if name == 'auto':
+        name = next(iter(PARSER_BACKENDS))
+    if name not in PARSER_BACKENDS:
+        raise ValueError("Parser backend '{0}' is not available (available: {1})".format(
+            name, ', '.join(PARSER_BACKENDS)))
+    _parser_backend = name
+
+# Which status wins when shards of a report disagree about a line
+STATUS_RANK = {'nc': 1, 'pc': 2, 'fc': 3}
+
+def merge_line_entries(streams):
+    """
+    Merge several streams of `(LINE_NUMBER, ENTRY)` tuples, each in line
+    order (such as `iter_source_page` of the pages of the same file in
+    the reports of several test shards), into one stream in line order.
+
+    A line covered in any shard is covered: of the entries of the same
+    line, the one with the best status is kept (fc, then pc, then nc).
+    """
+    current = None
+    for item in heapq.merge(*streams, key=lambda item: item[0]):
+        if current is not None and current[0] == item[0]:
+            if STATUS_RANK.get(item[1][0], 0) > STATUS_RANK.get(current[1][0], 0):
+                current = item
+            continue
+
+        if current is not None:
+            yield current
+        current = item
+
+    if current is not None:
+        yield current
+
+def count_lines(index, line_numbers):
+    """
+    Count the changed lines found in a page `index` (as returned by
+    `index_source_page`) by coverage status.
+
+    Entries that also carry JaCoCo counters (from `jacoco.xml`) add
+    their missed/covered instruction and branch totals as well.
+    """
+    counts = {'nc': 0, 'pc': 0, 'fc': 0, 'new': 0}
+    for line_num in line_numbers:
+        line = index.get(line_num)
+        if line is not None:
+            counts['new'] += 1
+            if line[0] in ('nc', 'pc', 'fc'):
+                counts[line[0]] += 1
+            for (name, value) in zip(XML_COUNTERS, line[2:]):
+                counts[name] = counts.get(name, 0) + value
+    return counts
+
+# Java types of the descriptor characters of primitives
+DESCRIPTOR_TYPES = {'B': 'byte', 'C': 'char', 'D': 'double', 'F': 'float', 'I': 'int',
+                    'J': 'long', 'S': 'short', 'Z': 'boolean', 'V': 'void'}
+
+def method_label(class_name, name, descriptor):
+    """
+    Return how JaCoCo's HTML report names a method, such as
+    `bar(int, String[])`, from the internal name of its class and its
+    name and descriptor in the class file.
+    """
+    simple_name = class_name.split('/')[-1]
+    if name == '<clinit>':
+        return 'static {...}'
+    if name == '<init>':
+        name = simple_name.split('$')[-1]
+
+    types = []
+    params = descriptor[1:descriptor.index(')')]
+    pos = 0
+    while pos < len(params):
+        dimensions = 0
+        while params[pos] == '[':
+            dimensions += 1
+            pos += 1
+        if params[pos] == 'L':
+            end = params.index(';', pos)
+            java_type = params[pos + 1:end].split('/')[-1].replace('$', '.')
+            pos = end + 1
+        else:
+            java_type = DESCRIPTOR_TYPES.get(params[pos], params[pos])
+            pos += 1
+        types.append(java_type + '[]' * dimensions)
+    return '{0}({1})'.format(name, ', '.join(types))
+
+class MethodIndex(object):
+    """
+    Sorted interval index of the methods of a source file: `lookup`
+    finds the method a line belongs to with one bisection.
+
+    Method line ranges may nest (local and anonymous classes inside a
+    method), so they are flattened once into disjoint runs of lines,
+    each owned by the innermost method.  An owner is a
+    `(CLASS, METHOD, FIRST_LINE)` tuple, or None between methods.
+    """
+
+    def __init__(self, ranges):
+        """
+        `ranges` are `(FIRST_LINE, LAST_LINE, CLASS, METHOD)` tuples,
+        in any order.
+        """
+        self.starts = []
+        self.owners = []
+
+        # Methods containing the current line, innermost last
+        open_ranges = []
+        for (first, last, class_name, method) in sorted(ranges, key=lambda r: (r[0], -r[1])):
+            while open_ranges and open_ranges[-1][0] < first:
+                self._close(open_ranges)
+            open_ranges.append((last, (class_name, method, first)))
+            self._add_run(first, (class_name, method, first))
+        while open_ranges:
+            self._close(open_ranges)
+
+    @classmethod
+    def from_first_lines(cls, methods):
+        """
+        Build the index from `(FIRST_LINE, CLASS, METHOD)` tuples only,
+        as `jacoco.xml` gives them: a method then runs until the next
+        one starts.
+        """
+        methods = sorted(methods, key=lambda m: m[0])
+        ends = [m[0] - 1 for m in methods[1:]] + [sys.maxsize]
+        return cls((first, max(first, last), class_name, method)
+                   for ((first, class_name, method), last) in zip(methods, ends))
+
+    def _close(self, open_ranges):
+        """
+        Close the innermost open method: the lines after it belong to
+        the method around it, if it is still open.
+        """
+        last = open_ranges.pop()[0]
+        # Methods overlapping it without containing it end with it
+        while open_ranges and open_ranges[-1][0] <= last:
+            open_ranges.pop()
+        self._add_run(last + 1, open_ranges[-1][1] if open_ranges else None)
+
+    def _add_run(self, start, owner):
+        if self.starts and self.starts[-1] == start:
+            self.starts.pop()
+            self.owners.pop()
+        if not self.owners or self.owners[-1] != owner:
+            self.starts.append(start)
+            self.owners.append(owner)
+
+    def lookup(self, line_num):
+        """
+        Return the `(CLASS, METHOD, FIRST_LINE)` owning `line_num`, or
+        None if no method does.
+        """
+        position = bisect.bisect_right(self.starts, line_num) - 1
+        return self.owners[position] if position >= 0 else None
+
+def rollup_lines(index, line_numbers, methods):
+    """
+    Count the changed lines found in a page `index` by class and method
+    of the `MethodIndex` `methods`, like `count_lines` does by file.
+
+    Returns a list of `{'class', 'new', 'nc', 'pc', 'fc', 'methods'}`
+    dictionaries, where `methods` is a list of `{'method', 'line',
+    'new', 'nc', 'pc', 'fc'}` ones, both in the order of their first
+    changed line.  Changed lines outside of any method only count for
+    the file.
+    """
+    classes = collections.OrderedDict()
+    for line_num in line_numbers:
+        line = index.get(line_num)
+        owner = methods.lookup(line_num) if line is not None else None
+        if owner is None:
+            continue
+
+        class_name, method, first_line = owner
+        class_counts = classes.get(class_name)
+        if class_counts is None:
+            class_counts = classes[class_name] = {'class': class_name, 'nc': 0, 'pc': 0, 'fc': 0, 'new': 0,
+                                                  'methods': collections.OrderedDict()}
+        method_counts = class_counts['methods'].get((method, first_line))
+        if method_counts is None:
+            method_counts = class_counts['methods'][(method, first_line)] = {
+                'method': method, 'line': first_line, 'nc': 0, 'pc': 0, 'fc': 0, 'new': 0}
+
+        for counts in (class_counts, method_counts):
+            counts['new'] += 1
+            if line[0] in ('nc', 'pc', 'fc'):
+                counts[line[0]] += 1
+
+    for class_counts in classes.values():
+        class_counts['methods'] = list(class_counts['methods'].values())
+    return list(classes.values())
+
+class CoverageGate(object):
+    """
+    Decide whether the new-code coverage reaches `min_coverage` (in
+    percent), possibly before every changed file has been evaluated.
+
+    Evaluation can stop as soon as the changed lines left to evaluate
+    cannot change the outcome: even if all of them turned out to be
+    uncovered (or all covered), the result would stay on the same side.
+
+    Changed lines whose coverage is unknown (the `unknown` counts of a
+    stale report, see `StaleReportMap`) are never evaluated, so they are
+    always taken in the worst case: uncovered for passing, covered for
+    failing.  If they could tip the outcome, it stays undecided.
+    """
+
+    def __init__(self, min_coverage):
+        self.min_coverage = min_coverage
+        self.new = 0
+        self.nc = 0
+        self.unknown = 0
+
+        # Changed lines announced with `expect` and not evaluated yet
+        self.remaining = 0
+
+        # Set when evaluation stopped before the end of the report
+        self.stopped_early = False
+
+    def expect(self, lines):
+        """
+        Announce `lines` changed lines that are going to be evaluated.
+        """
+        self.remaining += lines
+
+    def add(self, counts, lines=0):
+        """
+        Account the `counts` of a file with `lines` changed lines and
+        return True if the outcome is now certain although lines are
+        left, i.e. evaluation can stop.
+        """
+        self.new += counts['new']
+        self.nc += counts['nc']
+        self.unknown += counts.get('unknown', 0)
+        self.remaining -= lines
+        return self.remaining > 0 and self.decided() is not None
+
+    def decided(self):
+        """
+        Return True (pass) or False (fail) if the outcome is certain,
+        otherwise None.  Once no lines are left it is certain, unless
+        lines of unknown coverage could tip it either way.
+        """
+        covered = self.new - self.nc
+        open_lines = self.remaining + self.unknown
+
+        # Worst case: every open line is executable and not covered
+        worst_total = self.new + open_lines
+        if worst_total == 0 or covered * 100 >= self.min_coverage * worst_total:
+            return True
+
+        # Best case: every open line is covered (no new lines at all
+        # are reported as 100%)
+        if self.new > 0 and (covered + open_lines) * 100 < self.min_coverage * worst_total:
+            return False
+
+        return None
+
+# Attributes of a `<line>` record in jacoco.xml: missed/covered
+# instructions and missed/covered branches
+XML_COUNTERS = ('mi', 'ci', 'mb', 'cb')
+
+# JaCoCo computes a line status by OR-ing the status of its instruction
+# and branch counters (missed -> 1, covered -> 2)
+XML_LINE_STATUS = {1: 'nc', 2: 'fc', 3: 'pc'}
+
+def _xml_line_entry(elem):
+    """
+    Turn a jacoco.xml `<line nr mi ci mb cb>` element into a
+    `(LINE_NUMBER, (STATUS, TITLE, MI, CI, MB, CB))` pair, using the
+    same status and branch title the HTML report would show.
+    """
+    mi, ci, mb, cb = [int(elem.get(name, 0)) for name in XML_COUNTERS]
+    return int(elem.get('nr')), _counters_entry(mi, ci, mb, cb)
+
+def _counters_entry(mi, ci, mb, cb):
+    """
+    Return the `(STATUS, TITLE, MI, CI, MB, CB)` index entry of a line
+    with these missed/covered instruction and branch counts.
+    """
+    status = 0
+    for (missed, covered) in ((mi, ci), (mb, cb)):
+        status |= (1 if missed else 0) | (2 if covered else 0)
+
+    title = None
+    if mb + cb > 0:
+        if cb == 0:
+            title = "All {0} branches missed.".format(mb)
+        elif mb == 0:
+            title = "All {0} branches covered.".format(cb)
+        else:
+            title = "{0} of {1} branches missed.".format(mb, mb + cb)
+
+    return (XML_LINE_STATUS.get(status), title, mi, ci, mb, cb)
+
+def _suffix_index(src_paths):
+    """
+    Map every trailing part of the given source paths to the path,
+    so that a report-relative path such as `com/foo/Bar.java` finds
+    `module/src/main/java/com/foo/Bar.java` with a single lookup.
+    """
+    suffixes = dict()
+    for src_path in src_paths:
+        parts = src_path.split('/')
+        for i in range(len(parts)):
+            suffixes.setdefault('/'.join(parts[i:]), src_path)
+    return suffixes
+
+# Directories of test sources, whose classes JaCoCo reports leave out
+TEST_SOURCE_DIRS = ('src/test/', 'src/androidTest/', 'src/testFixtures/')
+
+def _report_source(src_path):
+    """
+    Tell whether a changed file can show up in a JaCoCo report: a Java
+    or Kotlin file outside of the test source directories.
+    """
+    if not src_path.endswith(('.java', '.kt')):
+        return False
+    path = '/' + src_path
+    return not any('/' + test_dir in path for test_dir in TEST_SOURCE_DIRS)
+
+def iter_xml_sourcefiles(jacoco_xml_path, src_paths):
+    """
+    Read a `jacoco.xml` in one streaming pass and yield a tuple of
+    `(SRC_PATH, REPORT_KEY, LINK, INDEX, METHODS)` for each changed file
+    in `src_paths` as soon as its `<sourcefile>` element is closed.
+
+    `INDEX` maps line numbers to `(STATUS, TITLE, MI, CI, MB, CB)` and
+    `METHODS` is the `MethodIndex` of the `<method>` elements of the
+    classes compiled from the file (which come before it in their
+    `<package>`), or None if there are none.
+    Only `<sourcefile>` elements of changed files are looked at,
+    everything else is dropped as soon as it is closed, and reading
+    stops once every changed file that can be in the report (see
+    `_report_source`) has been seen.  With `src_paths` None, every
+    source file is yielded with its path in the report
+    (`com/foo/Bar.java`) as `SRC_PATH`.
+    """
+    wanted = None
+    if src_paths is not None:
+        wanted = _suffix_index(src_paths)
+        remaining = set(src_path for src_path in wanted.values() if _report_source(src_path))
+        if not remaining:
+            return
+
+    package = None
+    class_name = None
+    src_path = None
+    index = None
+    parents = []
+
+    # (FIRST_LINE, CLASS, METHOD) of the methods by source file of the package
+    methods = dict()
+
+    with open(jacoco_xml_path, 'rb') as xml_file:
+        for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag == 'package':
+                    package = elem.get('name')
+                    methods.clear()
+                elif elem.tag == 'class':
+                    class_name = elem.get('name')
+                    class_source = '/'.join(p for p in (package, elem.get('sourcefilename')) if p)
+                elif elem.tag == 'method' and class_name is not None:
+                    # Lambda bodies count for the method they are written in
+                    line = int(elem.get('line', 0))
+                    if line > 0 and not elem.get('name').startswith('lambda$') \
+                            and (wanted is None or class_source in wanted):
+                        methods.setdefault(class_source, []).append(
+                            (line, class_name.replace('/', '.'),
+                             method_label(class_name, elem.get('name'), elem.get('desc'))))
+                elif elem.tag == 'sourcefile':
+                    rel_path = '/'.join(p for p in (package, elem.get('name')) if p)
+                    src_path = rel_path if wanted is None else wanted.get(rel_path)
+                    index = dict() if src_path is not None else None
+                continue
+
+            parents.pop()
+            if parents:
+                parents[-1].remove(elem)
+
+            if elem.tag == 'class':
+                class_name = None
+            if index is None:
+                continue
+
+            if elem.tag == 'line':
+                line_num, entry = _xml_line_entry(elem)
+                index[line_num] = entry
+
+            elif elem.tag == 'sourcefile':
+                path = package.replace('/', '.') if package else 'default'
+                javaname = elem.get('name')
+                first_lines = methods.pop('/'.join(p for p in (package, javaname) if p), None)
+                yield (src_path, path+javaname, path+"/"+javaname+".html", index,
+                       MethodIndex.from_first_lines(first_lines) if first_lines else None)
+
+                index = None
+                if wanted is not None:
+                    remaining.discard(src_path)
+                    if not remaining:
+                        break
+
+def report_from_xml(diff_report, jacoco_xml_path, gate=None, unknown=None):
+    """
+    Same as `report`, but read a single `jacoco.xml` instead of one
+    HTML page per changed file (see `iter_xml_sourcefiles`).  Report
+    entries also get the exact missed/covered instruction and branch
+    counts of the changed lines and, as `classes`, the same counts by
+    class and method (see `rollup_lines`).
+    """
+    report = {}
+
+    if gate is not None:
+        # Only source files can show up in the report
+        gate.expect(sum(len(diff_report[src_path]) for src_path in diff_report
+                        if src_path.endswith(('.java', '.kt'))))
+
+    sourcefiles = iter_xml_sourcefiles(jacoco_xml_path, diff_report.keys())
+    for (src_path, key, link, index, methods) in PROFILER.iter_timed('page_parsing', sourcefiles):
+        print("In parsing...->"+src_path)
+        with PROFILER.stage('line_lookup', src_path):
+            counts = count_lines(index, diff_report[src_path])
+            if methods is not None:
+                counts['classes'] = rollup_lines(index, diff_report[src_path], methods)
+        counts['link'] = link
+        if unknown is not None:
+            counts['unknown'] = unknown.get(src_path, 0)
+        report[key] = counts
+
+        if gate is not None and gate.add(counts, len(diff_report[src_path])):
+            gate.stopped_early = True
+            break
+
+    # Closing the generator stops reading the file
+    sourcefiles.close()
+
+    # Changed files the report does not know have no new lines to wait for
+    if gate is not None and not gate.stopped_early:
+        gate.remaining = 0
+    return report
+
+class IndexCache(object):
+    """
+    On-disk cache of page indexes (as returned by `index_source_page`),
+    so that checking many diffs against the same JaCoCo report only
+    parses each page once.
+
+    Entries are keyed by the page path, size and modification time, so
+    a regenerated page is parsed again.  Reading an entry refreshes its
+    modification time and `prune` drops the least recently used
+    entries once the directory grows past `max_bytes`.
+
+    The directory may be shared between CI runs, so entries are plain
+    JSON (a `[LINE_NUMBER, STATUS, TITLE, ...]` list per line) and an
+    entry that does not have that shape is ignored.
+    """
+
+    # Bump when the format of the cached indexes changes
+    VERSION = 2
+
+    SUFFIX = '.idx'
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, page_path):
+        """
+        Return the cache file for the current version of `page_path`.
+        """
+        stat = os.stat(page_path)
+        key = '{0}|{1}|{2}|{3}'.format(
+            self.VERSION, os.path.abspath(page_path), stat.st_size, stat.st_mtime_ns
+        )
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + self.SUFFIX)
+
+    def get(self, page_path):
+        """
+        Return the cached index of `page_path`, or None.
+        """
+        entry_path = self._entry_path(page_path)
+        try:
+            with open(entry_path) as entry:
+                index = self._load_index(json.load(entry))
+        except (IOError, OSError, ValueError, TypeError, IndexError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return index
+
+    def put(self, page_path, index):
+        """
+        Store the index of `page_path`.
+        """
+        entry_path = self._entry_path(page_path)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Write to a private file first, so that concurrent readers
+        # never see a partial entry
+        tmp_path = '{0}.{1}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'w') as entry:
+            json.dump([[line_num] + list(index[line_num]) for line_num in sorted(index)], entry,
+                      separators=(',', ':'))
+        os.replace(tmp_path, entry_path)
+
+    @staticmethod
+    def _load_index(rows):
+        """
+        Turn the rows of an entry back into an index, raising a
+        ValueError (or TypeError) if they are not what `put` writes.
+        """
+        if not isinstance(rows, list):
+            raise ValueError("Not a cache entry")
+        index = dict()
+        for row in rows:
+            if not isinstance(row[0], int) or not all(
+                    value is None or isinstance(value, (int, str)) for value in row[1:]):
+                raise ValueError("Not a cache entry")
+            index[row[0]] = tuple(row[1:])
+        return index
+
+    def prune(self):
+        """
+        Delete the least recently used entries until the cache fits
+        in `max_bytes`.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class ResultStore(object):
+    """
+    Per-file results of the previous run on a pull request, so that
+    after a push only the files whose changed lines or coverage page
+    changed are evaluated again.
+
+    Each result is stored with a fingerprint of the changed lines and
+    of the content of the page(s) it was computed from.  Pages are only
+    hashed again when their size or modification time changed, so an
+    unchanged file costs a `stat` per page.  Only the files of the last
+    run are kept.
+    """
+
+    # Bump when the format of the stored results changes
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.reused = 0
+
+        try:
+            with open(path) as store_file:
+                stored = json.load(store_file)
+        except (IOError, OSError, ValueError):
+            stored = None
+        if not isinstance(stored, dict) or stored.get('version') != self.VERSION:
+            stored = {'files': {}}
+
+        self._previous = stored['files']
+        self._current = dict()
+
+    @staticmethod
+    def _lines_digest(lines):
+        ranges = ','.join('{0}-{1}'.format(start, end) for (start, end) in LineRanges.from_lines(lines).ranges())
+        return hashlib.sha1(ranges.encode('utf-8')).hexdigest()
+
+    def _pages_fingerprint(self, page_path, previous):
+        """
+        Return `[[PAGE_PATH, SIZE, MTIME, DIGEST], ...]` for the page(s)
+        of a file, reusing the digests of `previous` for pages whose
+        size and modification time did not change.
+        """
+        known = dict((page[0], page) for page in (previous or {}).get('pages', []))
+        pages = []
+        for path in (page_path if isinstance(page_path, tuple) else (page_path,)):
+            stamp = _page_stamp(path)
+            if stamp is None:
+                return None
+            page = known.get(path)
+            if page is None or page[1:3] != list(stamp):
+                with open(path, 'rb') as page_file:
+                    page = [path, stamp[0], stamp[1], hashlib.sha1(page_file.read()).hexdigest()]
+            pages.append(page)
+        return pages
+
+    def get(self, src_path, lines, page_path):
+        """
+        Return `(RESULT, FINGERPRINT)`: the stored `(REPORT_KEY, COUNTS)`
+        result of `src_path` if neither its changed `lines` nor its
+        page(s) changed, or None, and the fingerprint of the file to
+        `put` its result with otherwise.
+        """
+        previous = self._previous.get(src_path)
+        fingerprint = (self._lines_digest(lines), self._pages_fingerprint(page_path, previous))
+
+        if previous is None or fingerprint[1] is None:
+            return None, fingerprint
+        if previous['lines'] != fingerprint[0]:
+            return None, fingerprint
+        if [page[3] for page in previous['pages']] != [page[3] for page in fingerprint[1]]:
+            return None, fingerprint
+
+        self._current[src_path] = dict(previous, pages=fingerprint[1])
+        self.reused += 1
+        return (previous['key'], dict(previous['counts'])), fingerprint
+
+    def put(self, src_path, fingerprint, key, counts):
+        """
+        Store the result of `src_path`, with the `fingerprint` given by
+        the `get` that missed.
+        """
+        lines_digest, pages = fingerprint
+        if pages is None:
+            return
+        counts = dict((name, value) for (name, value) in counts.items() if name != 'unknown')
+        self._current[src_path] = {'lines': lines_digest, 'pages': pages, 'key': key, 'counts': counts}
+
+    def save(self):
+        """
+        Write the results of this run, replacing the previous ones.
+        """
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as store_file:
+            json.dump({'version': self.VERSION, 'files': self._current}, store_file, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def _page_stamp(page_path):
+    """
+    Return the size and modification time of a page, or None if it is gone.
+    """
+    try:
+        stat = os.stat(page_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def _index_size(index):
+    """
+    Estimate the memory used by a page index, in bytes.
+    """
+    size = sys.getsizeof(index)
+    for (line_num, entry) in index.items():
+        size += sys.getsizeof(line_num) + sys.getsizeof(entry)
+    return size
+
+class MemoryIndexCache(object):
+    """
+    In-memory cache of page indexes with the interface of `IndexCache`,
+    for evaluating several diffs in one process.  Misses fall through
+    to the optional on-disk `backing` cache.
+
+    Entries remember the size and modification time of their page and
+    are dropped once the page changes.  With `max_bytes`, the least
+    recently used entries are evicted when the estimated size of the
+    cached indexes goes over it.  The cache can be shared by threads.
+
+    Only the backing cache is passed on to worker processes, sending
+    every loaded index along with each task would cost more than
+    parsing the pages again.
+    """
+
+    def __init__(self, backing=None, max_bytes=None):
+        self.backing = backing
+        self.max_bytes = max_bytes
+
+        # page path -> (page stamp, estimated size, index), oldest first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, page_path):
+        stamp = _page_stamp(page_path)
+        with self._lock:
+            entry = self._entries.get(page_path)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self._entries.move_to_end(page_path)
+                    return entry[2]
+                self._drop(page_path)
+
+        if self.backing is None or stamp is None:
+            return None
+        index = self.backing.get(page_path)
+        if index is not None:
+            self._add(page_path, stamp, index)
+        return index
+
+    def put(self, page_path, index):
+        self._add(page_path, _page_stamp(page_path), index)
+        if self.backing is not None:
+            self.backing.put(page_path, index)
+
+    def prune(self):
+        if self.backing is not None:
+            self.backing.prune()
+
+    def _add(self, page_path, stamp, index):
+        size = _index_size(index) if self.max_bytes is not None else 0
+        with self._lock:
+            if page_path in self._entries:
+                self._drop(page_path)
+            self._entries[page_path] = (stamp, size, index)
+            self._bytes += size
+
+            # Evict the least recently used entries, but keep the new one
+            while self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, page_path):
+        entry = self._entries.pop(page_path)
+        self._bytes -= entry[1]
+
+    def __getstate__(self):
+        return {'backing': self.backing, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['backing'], state['max_bytes'])
+
+def _last_line(lines):
+    """
+    Return the highest of the changed `lines`, a `LineRanges` or any
+    collection of line numbers, or 0 if there are none.
+    """
+    if isinstance(lines, LineRanges):
+        return lines.last() or 0
+    return max(lines) if lines else 0
+
+def load_page_index(page_path, lines, cache=None):
+    """
+    Return the index of the JaCoCo page at `page_path` for looking up
+    the changed `lines`.
+
+    Without a cache the page is only read up to the last changed line.
+    With one, a cached index is used when the page has not changed,
+    otherwise the whole page is indexed and stored for later runs.
+
+    `page_path` can also be a tuple of the pages of the same file in
+    several shards of a report, which are merged line by line (see
+    `merge_line_entries`).  Pages are not cached merged, so a shard
+    that is regenerated only invalidates its own pages.
+    """
+    if isinstance(page_path, tuple):
+        if cache is None:
+            max_line = _last_line(lines)
+            streams = [iter_source_page(path, max_line) for path in page_path]
+        else:
+            streams = [sorted(load_page_index(path, lines, cache).items()) for path in page_path]
+        return dict(merge_line_entries(streams))
+
+    if cache is None:
+        return index_source_page(page_path, _last_line(lines))
+
+    index = cache.get(page_path)
+    if index is None:
+        index = index_source_page(page_path)
+        cache.put(page_path, index)
+    return index
+
+class ReportIndex(object):
+    """
+    Index of the source pages of one or more JaCoCo HTML reports
+    (e.g. one `target/site/jacoco` per Maven module), built with one
+    scan of each report directory.
+
+    Pages are keyed by their path relative to the source root, such
+    as `com/foo/Bar.java`, so resolving a changed file is a dictionary
+    lookup per trailing part of its path rather than a guess based on
+    the path with regular expressions.
+
+    With `shards`, the report directories are the reports of parallel
+    test shards rather than modules: the pages of a file in all of them
+    are merged instead of picking one.
+    """
+
+    # JaCoCo writes one `<package>/<Source>.<ext>.html` page per source file
+    SOURCE_PAGE_RE = re.compile(r'^(.+\.(?:java|kt))\.html$')
+
+    def __init__(self, roots, shards=False):
+        if isinstance(roots, str):
+            roots = [roots]
+        self.roots = list(roots)
+        self.shards = shards
+
+        # Relative source path -> list of (root, page path, package) tuples
+        self._pages = dict()
+
+        # Report directory -> stamp of its index.html when it was scanned
+        self._stamps = dict()
+
+        for root in self.roots:
+            self._scan(root, self._pages)
+
+    @staticmethod
+    def _root_stamp(root):
+        """
+        JaCoCo rewrites the index.html of a report directory every time
+        it generates the report, so its stamp tells if the report changed.
+        """
+        return _page_stamp(os.path.join(root, 'index.html'))
+
+    def refresh(self, force=False):
+        """
+        Scan again the report directories that were regenerated since
+        they were scanned (or all of them, with `force`), and return the
+        list of them.
+        """
+        changed = [root for root in self.roots if force or self._root_stamp(root) != self._stamps.get(root)]
+        if not changed:
+            return changed
+
+        # Build a new index and swap it in, so that lookups running
+        # meanwhile still see a complete one
+        pages = dict()
+        for (rel_path, entries) in self._pages.items():
+            kept = [page for page in entries if page[0] not in changed]
+            if kept:
+                pages[rel_path] = kept
+        for root in changed:
+            self._scan(root, pages)
+
+        self._pages = pages
+        return changed
+
+    def _scan(self, root, pages):
+        """
+        Add the source pages found under the report directory `root`
+        to `pages`.
+        """
+        self._stamps[root] = self._root_stamp(root)
+
+        for (dirpath, dirnames, filenames) in os.walk(root):
+
+            # Skip .resources, .sessions.html and the like
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+
+            package = os.path.basename(dirpath)
+            for name in sorted(filenames):
+                match = self.SOURCE_PAGE_RE.match(name)
+                if match is None:
+                    continue
+
+                source_name = match.group(1)
+                if package == 'default':
+                    rel_path = source_name
+                else:
+                    rel_path = package.replace('.', '/') + '/' + source_name
+
+                page = (root, os.path.join(dirpath, name), package)
+                pages.setdefault(rel_path, []).append(page)
+
+    def resolve(self, src_path):
+        """
+        Return a `(REPORT_KEY, PAGE_PATH)` tuple for the changed file
+        `src_path`, or None if no report has a page for it.  With shards,
+        `PAGE_PATH` is a tuple of the pages of the file in every shard
+        that has one.
+        """
+        parts = src_path.split('/')
+
+        # The longest matching suffix is the real package path
+        for i in range(len(parts)):
+            rel_path = '/'.join(parts[i:])
+            pages = self._pages.get(rel_path)
+            if pages and self.shards:
+                if len(pages) == 1:
+                    return pages[0][2] + parts[-1], pages[0][1]
+                return pages[0][2] + parts[-1], tuple(page[1] for page in pages)
+            if pages:
+                root, page_path, package = self._closest(parts[:i], pages)
+                key = package + parts[-1]
+
+                # The same class in several modules, keep their keys apart
+                if len(pages) > 1:
+                    key = '/'.join(parts[:i] + [key])
+                return key, page_path
+
+        return None
+
+    def iter_pages(self):
+        """
+        Yield a `(REL_PATH, PAGE_PATH)` tuple for every source file of
+        the reports, by path.  Of several pages of the same file, the
+        first report's is used, or with shards all of them (as a tuple).
+        """
+        for rel_path in sorted(self._pages):
+            pages = self._pages[rel_path]
+            if self.shards and len(pages) > 1:
+                yield rel_path, tuple(page[1] for page in pages)
+            else:
+                yield rel_path, pages[0][1]
+
+    @staticmethod
+    def _closest(prefix_parts, pages):
+        """
+        Pick the page whose report directory shares the most path
+        components with the part of the changed path in front of the
+        package (e.g. the module directory in a multi-module build).
+        """
+        if len(pages) == 1:
+            return pages[0]
+
+        prefix = set(prefix_parts)
+
+        def score(page):
+            root_parts = os.path.abspath(page[0]).split(os.sep)
+            return len(prefix.intersection(root_parts))
+
+        return max(pages, key=score)
+
+    def link(self, page_path):
+        """
+        Return the link to `page_path` from the first report directory,
+        where the new-code report is written.  Merged shard pages link to
+        the page of the first shard.
+        """
+        if isinstance(page_path, tuple):
+            page_path = page_path[0]
+        return os.path.relpath(page_path, self.roots[0]).replace(os.sep, '/')
+
+def _report_file(key, page_path, link, lines, cache=None, src_path=None):
+    """
+    Evaluate the changed `lines` of one file against its JaCoCo page
+    and return a `(REPORT_KEY, COUNTS)` tuple.  The stages are profiled
+    on behalf of `src_path`, the file's path in the diff, if given.
+    """
+    file = src_path or key
+    try:
+        # One pass over the page (or none, if cached), then every
+        # changed line is a dict lookup
+        with PROFILER.stage('page_parsing', file):
+            index = load_page_index(page_path, lines, cache)
+    except ET.ParseError as err:
+        print(err)
+        return key, {'link':0,'nc':0,'pc':0,'fc':0,'new':0}
+
+    with PROFILER.stage('line_lookup', file):
+        counts = count_lines(index, lines)
+    counts['link'] = link
+    return key, counts
+
+def _report_file_task(task):
+    """
+    Evaluate a task of `report`, possibly in a worker process: a
+    `(SRC_PATH, ARGUMENTS, STORED, FINGERPRINT, PROFILING)` tuple, where
+    `ARGUMENTS` are the arguments of `_report_file`, `STORED` is the
+    result of a stored run that still holds, if any, and `FINGERPRINT`
+    what to store a new result with (see `ResultStore.get`).
+
+    Returns `(SRC_PATH, LINES, RESULT, REUSED, FINGERPRINT, PROFILE)`,
+    where `LINES` is the number of changed lines and `PROFILE` what the worker's
+    profiler collected for this file, when `PROFILING` (only in a pool
+    worker: in the main process, the stages are timed by its profiler
+    as they run).
+    """
+    src_path, arguments, stored, fingerprint, profiling = task
+    if stored is not None:
+        return src_path, len(arguments[3]), stored, True, fingerprint, None
+    if not profiling:
+        return src_path, len(arguments[3]), _report_file(*arguments), False, fingerprint, None
+
+    if not PROFILER.enabled:
+        start_profiling()
+    PROFILER.reset()
+    return src_path, len(arguments[3]), _report_file(*arguments), False, fingerprint, PROFILER.snapshot()
+
+class PagePrefetcher(object):
+    """
+    Evaluate the tasks of `report` (see `_report_file_task`) on
+    `readers` threads, up to `readers` files ahead of the one being
+    consumed, and yield the results in the order of the tasks.
+
+    While the main thread merges one result, the next pages are being
+    read (and parsed) from slow storage, so waiting on I/O overlaps.
+    Only the counts leave a reader: each page index is dropped as soon
+    as its lines are counted, so no more than `readers` pages are held
+    in memory, however many files the diff has.
+    """
+
+    def __init__(self, tasks, readers):
+        self._tasks = iter(tasks)
+        self._work = queue.Queue()
+        # (done event, result slot) of the files in flight, in task order
+        self._pending = collections.deque()
+
+        self._threads = [threading.Thread(target=self._read) for _ in range(readers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        for _ in range(readers):
+            self._submit()
+
+    def _submit(self):
+        arguments = next(self._tasks, None)
+        if arguments is None:
+            return
+        done = threading.Event()
+        slot = []
+        self._pending.append((done, slot))
+        self._work.put((arguments, done, slot))
+
+    def _read(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                break
+            arguments, done, slot = item
+            try:
+                slot.append((True, _report_file_task(arguments)))
+            except Exception as err:
+                slot.append((False, err))
+            done.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._pending:
+            raise StopIteration
+        done, slot = self._pending.popleft()
+        done.wait()
+        # A free reader starts on the next file right away
+        self._submit()
+        succeeded, result = slot[0]
+        if not succeeded:
+            raise result
+        return result
+
+    next = __next__
+
+    def close(self):
+        """
+        Stop the readers once their current file is done, leaving the
+        files not started yet unread.
+        """
+        self._tasks = iter(())
+        while True:
+            try:
+                self._work.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self._threads:
+            self._work.put(None)
+
+def _iter_report_tasks(changes, report_index, cache, store):
+    """
+    Yield a task of `_report_file_task` for each of the `(SRC_PATH,
+    LINES)` `changes` that has a page in `report_index`, with the stored
+    result of a `ResultStore` if it still holds.
+    """
+    for (key, lines) in changes:
+        with PROFILER.stage('page_resolution', key):
+            resolved = report_index.resolve(key)
+        if resolved is None:
+            if key.endswith(".java"):
+                print("No coverage page for->"+key)
+            continue
+        report_key, page_path = resolved
+
+        stored = fingerprint = None
+        if store is not None:
+            with PROFILER.stage('result_reuse', key):
+                stored, fingerprint = store.get(key, lines, page_path)
+        arguments = (report_key, page_path, report_index.link(page_path), lines, cache, key)
+        yield key, arguments, stored, fingerprint, False
+
+def _profiled_tasks(tasks):
+    """
+    Return the tasks of `report` for pool workers, which send back what
+    their own profiler collected when profiling.
+    """
+    for (src_path, arguments, stored, fingerprint, _) in tasks:
+        yield src_path, arguments, stored, fingerprint, PROFILER.enabled
+
+"""
+compare the git diff and jacoco result
+generate the report of which java file changed, and how many lines be covered on new code.
+"""
+def report(diff_report, jacoco_html_report_path, jobs=1, cache=None, gate=None, unknown=None, shards=False, store=None,
+           prefetch=0):
+    """
+    `jacoco_html_report_path` is a JaCoCo HTML report directory, a list
+    of them (e.g. one per module) or an already built `ReportIndex`.
+    With `shards`, a list of report directories are the reports of test
+    shards, merged line by line as they are read (see `ReportIndex`).
+
+    With `jobs` > 1 the files are evaluated by a pool of that many
+    processes (0 means one per CPU).  Results are merged in the order
+    of `diff_report`, so the report is the same as with a single job.
+    A single job can instead `prefetch` that many files ahead on
+    threads, for reports on slow storage (see `PagePrefetcher`).
+
+    `cache` is an optional `IndexCache` of parsed pages.
+
+    With a `CoverageGate`, evaluation stops as soon as the remaining
+    files cannot change its outcome, leaving them out of the report.
+
+    `unknown` optionally maps changed paths to their number of lines
+    without coverage information (see `StaleReportMap`), kept in the
+    report entries as `unknown`.
+
+    A snapshot written by `export_snapshot` can be given instead of
+    report directories (see `report_from_snapshot`).
+
+    With a `ResultStore`, files whose changed lines and page did not
+    change since the stored run are not evaluated again, and the
+    results of this run are stored (the caller saves them).
+
+    `diff_report` can also be an iterable of `(SRC_PATH, LINES)` pairs,
+    such as `GitDiffReporter.iter_lines_changed()`: files are then
+    resolved and evaluated while the rest of the diff is being read
+    (unless there is a gate, which needs every changed line up front).
+    A file given again replaces its earlier result.
+    """
+    snapshot = _snapshot_report(jacoco_html_report_path)
+    if snapshot is not None:
+        if not isinstance(diff_report, dict):
+            diff_report = dict(diff_report)
+        return report_from_snapshot(diff_report, snapshot, gate, unknown)
+
+    report={}
+
+    with PROFILER.stage('page_resolution'):
+        if isinstance(jacoco_html_report_path, ReportIndex):
+            report_index = jacoco_html_report_path
+        else:
+            report_index = ReportIndex(jacoco_html_report_path, shards)
+
+    changes = diff_report.items() if isinstance(diff_report, dict) else diff_report
+    tasks = _iter_report_tasks(changes, report_index, cache, store)
+    if isinstance(diff_report, dict) or gate is not None:
+        tasks = list(tasks)
+        if gate is not None:
+            gate.expect(sum(len(task[1][3]) for task in tasks))
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+
+    # A pool or readers are not worth starting for a single file
+    several = not isinstance(tasks, list) or len(tasks) > 1
+
+    pool = None
+    if jobs > 1 and several:
+        pool = multiprocessing.Pool(jobs if not isinstance(tasks, list) else min(jobs, len(tasks)))
+        # Hand out several files at a time to keep the IPC overhead
+        # low, but one at a time while the diff is still being read
+        chunksize = max(1, len(tasks) // (jobs * 4)) if isinstance(tasks, list) else 1
+        results = pool.imap(_report_file_task, _profiled_tasks(tasks), chunksize)
+    elif prefetch > 0 and several:
+        results = PagePrefetcher(tasks, prefetch if not isinstance(tasks, list) else min(prefetch, len(tasks)))
+    else:
+        results = (_report_file_task(task) for task in tasks)
+
+    try:
+        for (src_path, lines, result, reused, fingerprint, profile) in results:
+            if reused:
+                print("Unchanged->"+src_path)
+            else:
+                print("In parsing...->"+src_path)
+                if store is not None:
+                    store.put(src_path, fingerprint, result[0], result[1])
+
+            if unknown is not None:
+                result[1]['unknown'] = unknown.get(src_path, 0)
+            report[result[0]] = result[1]
+            if profile is not None:
+                PROFILER.merge(profile)
+
+            if gate is not None and gate.add(result[1], lines):
+                gate.stopped_early = True
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if isinstance(results, PagePrefetcher):
+            results.close()
+        # A diff still being read is not read any further
+        if not isinstance(diff_report, dict):
+            _close_all([changes])
+
+    if cache is not None:
+        cache.prune()
+    return report
+
+# Line status codes of a snapshot, the same as the jacoco.xml ones
+SNAPSHOT_STATUS = dict((name, code) for (code, name) in XML_LINE_STATUS.items())
+
+BRANCHES_RE = re.compile(r'^(?:All ([0-9]+) branches (missed|covered)|([0-9]+) of ([0-9]+) branches missed)\.$')
+
+def _title_branches(title):
+    """
+    Return the `(MISSED, COVERED)` branch counts of a JaCoCo HTML branch
+    title such as "1 of 2 branches missed.", or `(0, 0)`.
+    """
+    match = BRANCHES_RE.match(title or '')
+    if match is None:
+        return 0, 0
+    if match.group(1) is not None:
+        total = int(match.group(1))
+        return (total, 0) if match.group(2) == 'missed' else (0, total)
+    missed = int(match.group(3))
+    return missed, int(match.group(4)) - missed
+
+class CoverageSnapshot(object):
+    """
+    Compact binary copy of the line coverage of a JaCoCo report, read
+    through `mmap`: looking up a changed line reads a byte from the
+    mapped file, nothing is parsed or loaded up front.
+
+    Layout (little-endian):
+
+        header      magic, number of files, number of lines, size of the path table
+        files       (path offset, path length, first line, line count) per file, by path
+        paths       UTF-8 paths relative to the source root, like `com/foo/Bar.java`
+        branches    (missed, covered) uint16 branch counts per line
+        status      one byte per line: 0 (no code), 1 (nc), 2 (fc) or 3 (pc)
+
+    The lines of a file are stored from line 1 to its last line with
+    code, so a line is found by its number alone.
+    """
+
+    MAGIC = b'JCNCSNP1'
+    HEADER = struct.Struct('<8sIII')
+    FILE = struct.Struct('<IIII')
+    BRANCHES = struct.Struct('<HH')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self._buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.files, lines, paths_size = self.HEADER.unpack_from(self._buffer, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError("Not a coverage snapshot: '{0}'".format(path))
+
+        self._paths_offset = self.HEADER.size + self.files * self.FILE.size
+        self._branches_offset = _align(self._paths_offset + paths_size, 4)
+        self._status_offset = self._branches_offset + lines * self.BRANCHES.size
+
+    @classmethod
+    def is_snapshot(cls, path):
+        """
+        Tell whether `path` is a snapshot file.
+        """
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as snapshot_file:
+            return snapshot_file.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def close(self):
+        self._buffer.close()
+
+    def _file(self, file_no):
+        return self.FILE.unpack_from(self._buffer, self.HEADER.size + file_no * self.FILE.size)
+
+    def _path(self, file_no):
+        offset, length, _, _ = self._file(file_no)
+        start = self._paths_offset + offset
+        return self._buffer[start:start + length]
+
+    def find(self, rel_path):
+        """
+        Return the number of the file `rel_path`, or None.  Paths are
+        sorted, so this is a binary search over the mapped path table.
+        """
+        wanted = rel_path.encode('utf-8')
+        low, high = 0, self.files
+        while low < high:
+            middle = (low + high) // 2
+            if self._path(middle) < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.files and self._path(low) == wanted:
+            return low
+        return None
+
+    def resolve(self, src_path):
+        """
+        Return a `(REPORT_KEY, LINK, FILE_NUMBER)` tuple for the changed
+        file `src_path`, or None if the snapshot has no such file.  The
+        longest trailing part of the path that matches wins, as in
+        `ReportIndex.resolve`.
+        """
+        parts = src_path.split('/')
+        for i in range(len(parts)):
+            file_no = self.find('/'.join(parts[i:]))
+            if file_no is not None:
+                package = '.'.join(parts[i:-1]) or 'default'
+                return package+parts[-1], package+"/"+parts[-1]+".html", file_no
+        return None
+
+    def count_lines(self, file_no, line_numbers):
+        """
+        Same as `count_lines` for a file of the snapshot, with the
+        missed/covered branch totals of the changed lines.
+        """
+        counts = {'nc': 0, 'pc': 0, 'fc': 0, 'new': 0, 'mb': 0, 'cb': 0}
+        _, _, first, count = self._file(file_no)
+        status_offset = self._status_offset + first
+        branches_offset = self._branches_offset + first * self.BRANCHES.size
+
+        for line_num in line_numbers:
+            if not 0 < line_num <= count:
+                continue
+            status = XML_LINE_STATUS.get(self._buffer[status_offset + line_num - 1])
+            if status is None:
+                continue
+            counts['new'] += 1
+            counts[status] += 1
+
+            missed, covered = self.BRANCHES.unpack_from(
+                self._buffer, branches_offset + (line_num - 1) * self.BRANCHES.size)
+            counts['mb'] += missed
+            counts['cb'] += covered
+        return counts
+
+def _align(offset, size):
+    return (offset + size - 1) // size * size
+
+def write_snapshot(snapshot_path, sources):
+    """
+    Write a `CoverageSnapshot` of `sources`, an iterable of
+    `(REL_PATH, INDEX)` tuples with page or jacoco.xml indexes, and
+    return the number of files written.
+    """
+    files = []
+    status = bytearray()
+    branches = array.array('H')
+
+    for (rel_path, index) in sources:
+        if not index:
+            continue
+        first = len(status)
+        count = max(index)
+        status.extend(bytes(count))
+        branches.extend([0] * (count * 2))
+
+        for (line_num, entry) in index.items():
+            status[first + line_num - 1] = SNAPSHOT_STATUS.get(entry[0], 0)
+            if len(entry) > 2:
+                missed, covered = entry[4], entry[5]
+            else:
+                missed, covered = _title_branches(entry[1])
+            branches[(first + line_num - 1) * 2] = min(missed, 0xffff)
+            branches[(first + line_num - 1) * 2 + 1] = min(covered, 0xffff)
+
+        files.append((rel_path.encode('utf-8'), first, count))
+
+    files.sort()
+    if sys.byteorder != 'little':
+        branches.byteswap()
+
+    paths = bytearray()
+    table = bytearray()
+    for (path, first, count) in files:
+        table.extend(CoverageSnapshot.FILE.pack(len(paths), len(path), first, count))
+        paths.extend(path)
+
+    header_size = CoverageSnapshot.HEADER.size + len(table)
+    padding = _align(header_size + len(paths), 4) - header_size - len(paths)
+
+    with open(snapshot_path, 'wb') as snapshot_file:
+        snapshot_file.write(CoverageSnapshot.HEADER.pack(CoverageSnapshot.MAGIC, len(files), len(status), len(paths)))
+        snapshot_file.write(table)
+        snapshot_file.write(paths)
+        snapshot_file.write(bytes(padding))
+        snapshot_file.write(branches.tobytes())
+        snapshot_file.write(status)
+    return len(files)
+
+def export_snapshot(jacoco_html_path, snapshot_path, shards=False):
+    """
+    Convert a JaCoCo report (HTML report directories or a jacoco.xml)
+    into a `CoverageSnapshot` file and return its number of files.
+
+    Of the same source file in several report directories, only the
+    first one is kept, unless they are `shards` which are merged.
+    """
+    jacoco_html_paths, _ = _split_report_paths(jacoco_html_path)
+    if _is_xml_report(jacoco_html_paths[0]):
+        sources = ((src_path, index) for (src_path, _, _, index, _)
+                   in iter_xml_sourcefiles(jacoco_html_paths[0], None))
+    else:
+        sources = _iter_report_pages(ReportIndex(jacoco_html_paths, shards))
+    return write_snapshot(snapshot_path, sources)
+
+def _iter_report_pages(report_index):
+    """
+    Yield the `(REL_PATH, INDEX)` tuple of every page of a report.
+    """
+    for (rel_path, page_path) in report_index.iter_pages():
+        try:
+            if isinstance(page_path, tuple):
+                index = dict(merge_line_entries([iter_source_page(path) for path in page_path]))
+            else:
+                index = index_source_page(page_path)
+        except ET.ParseError as err:
+            print(err)
+            continue
+        yield rel_path, index
+
+def _is_xml_report(path):
+    """
+    A report given as a file is a jacoco.xml, unless it is a snapshot
+    or a jacoco.exec.
+    """
+    return os.path.isfile(path) and not CoverageSnapshot.is_snapshot(path) and not ExecutionData.is_exec(path)
+
+def _snapshot_report(jacoco_html_report_path):
+    """
+    Return the snapshot file or `CoverageSnapshot` a report is given
+    as (alone or in a list), or None.
+    """
+    path = jacoco_html_report_path
+    if isinstance(path, (list, tuple)) and len(path) == 1:
+        path = path[0]
+    if isinstance(path, CoverageSnapshot) or CoverageSnapshot.is_snapshot(path):
+        return path
+    return None
+
+def report_from_snapshot(diff_report, snapshot, gate=None, unknown=None):
+    """
+    Same as `report`, but look the changed lines up in a
+    `CoverageSnapshot` (or snapshot file).  Report entries also get
+    the missed/covered branch totals of the changed lines.
+    """
+    report = {}
+
+    own_snapshot = not isinstance(snapshot, CoverageSnapshot)
+    if own_snapshot:
+        snapshot = CoverageSnapshot(snapshot)
+
+    try:
+        with PROFILER.stage('page_resolution'):
+            resolved = []
+            for src_path in diff_report:
+                entry = snapshot.resolve(src_path)
+                if entry is None:
+                    if src_path.endswith(".java"):
+                        print("No coverage page for->"+src_path)
+                    continue
+                resolved.append((src_path, entry))
+
+        if gate is not None:
+            gate.expect(sum(len(diff_report[src_path]) for (src_path, _) in resolved))
+
+        for (src_path, (key, link, file_no)) in resolved:
+            print("In parsing...->"+src_path)
+            with PROFILER.stage('line_lookup', src_path):
+                counts = snapshot.count_lines(file_no, diff_report[src_path])
+            counts['link'] = link
+            if unknown is not None:
+                counts['unknown'] = unknown.get(src_path, 0)
+            report[key] = counts
+
+            if gate is not None and gate.add(counts, len(diff_report[src_path])):
+                gate.stopped_early = True
+                break
+    finally:
+        if own_snapshot:
+            snapshot.close()
+    return report
+
+"""
+read the coverage straight from jacoco.exec and the compiled classes
+"""
+# Block types of a jacoco.exec file
+EXEC_BLOCK_HEADER = 0x01
+EXEC_BLOCK_SESSIONINFO = 0x10
+EXEC_BLOCK_EXECUTIONDATA = 0x11
+EXEC_MAGIC = 0xC0C0
+
+def _read_exec_utf(data, pos):
+    """
+    Read a Java `DataOutput.writeUTF` string, return it and the new position.
+    """
+    length, = struct.unpack_from('>H', data, pos)
+    return data[pos + 2:pos + 2 + length].decode('utf-8', 'replace'), pos + 2 + length
+
+def _read_exec_length(data, pos):
+    """
+    Read the var-int length of a JaCoCo boolean array, return it and the
+    position of its values (8 per byte, lowest bit first).
+    """
+    length = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return length, pos
+
+# The 8 values of every byte of a JaCoCo boolean array, as 0/1 bytes
+EXEC_PROBE_BYTES = [bytes((byte >> bit) & 1 for bit in range(8)) for byte in range(256)]
+
+def _read_exec_probes(data, pos, length):
+    """
+    Return the `length` values of a JaCoCo boolean array at `pos` as a
+    bytearray of 0/1.
+    """
+    values = data[pos:pos + (length + 7) // 8]
+    return bytearray(b''.join(EXEC_PROBE_BYTES[byte] for byte in values)[:length])
+
+class ExecutionData(object):
+    """
+    The probes recorded in one or more `jacoco.exec` files (e.g. one per
+    test shard), by class id.  Probes of the same class in several
+    sessions or files are merged: a probe hit in any of them is hit.
+
+    Reading the files only finds where the probes of every class are,
+    they are decoded when the class is analyzed (see `get`), so the
+    cost follows the number of changed classes rather than the size of
+    the project.
+    """
+
+    def __init__(self, exec_paths):
+        if isinstance(exec_paths, str):
+            exec_paths = [exec_paths]
+
+        # Class id -> list of (file data, position, length) of its probes
+        self._blocks = dict()
+        # Class id -> decoded probes, as a bytearray of 0/1
+        self._probes = dict()
+
+        for exec_path in exec_paths:
+            with open(exec_path, 'rb') as exec_file:
+                self._read(exec_file.read(), exec_path)
+
+    def get(self, class_id):
+        """
+        Return the probes of class `class_id` as a bytearray of 0/1, or
+        None if it has none.  Of probes of different lengths (of another
+        build of the class), the last ones read are kept.
+        """
+        probes = self._probes.get(class_id)
+        if probes is not None or class_id not in self._blocks:
+            return probes
+
+        for (data, pos, length) in self._blocks[class_id]:
+            if probes is None or len(probes) != length:
+                probes = _read_exec_probes(data, pos, length)
+            else:
+                for (i, probe) in enumerate(_read_exec_probes(data, pos, length)):
+                    if probe:
+                        probes[i] = 1
+        self._probes[class_id] = probes
+        return probes
+
+    @staticmethod
+    def is_exec(path):
+        """
+        Tell whether `path` is a jacoco.exec file.
+        """
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as exec_file:
+            return exec_file.read(3) == struct.pack('>BH', EXEC_BLOCK_HEADER, EXEC_MAGIC)
+
+    def _read(self, data, exec_path):
+        pos = 0
+        while pos < len(data):
+            block = data[pos]
+            pos += 1
+
+            if block == EXEC_BLOCK_HEADER:
+                magic, _ = struct.unpack_from('>HH', data, pos)
+                if magic != EXEC_MAGIC:
+                    raise ValueError("Not a jacoco.exec file: '{0}'".format(exec_path))
+                pos += 4
+
+            elif block == EXEC_BLOCK_SESSIONINFO:
+                # Session id, start and dump times
+                _, pos = _read_exec_utf(data, pos)
+                pos += 16
+
+            elif block == EXEC_BLOCK_EXECUTIONDATA:
+                class_id, name_length = struct.unpack_from('>QH', data, pos)
+                length, pos = _read_exec_length(data, pos + 10 + name_length)
+                self._blocks.setdefault(class_id, []).append((data, pos, length))
+                pos += (length + 7) // 8
+
+            else:
+                raise ValueError("Unknown block type {0:#x} in '{1}'".format(block, exec_path))
+
+def _crc64_table():
+    table = []
+    for i in range(256):
+        value = i
+        for _ in range(8):
+            value = (value >> 1) ^ 0xd800000000000000 if value & 1 else value >> 1
+        table.append(value)
+    return table
+
+CRC64_TABLE = _crc64_table()
+
+def class_id(data):
+    """
+    Return the id JaCoCo gives a class: the CRC-64 of its class file.
+    """
+    # JaCoCo computes the id of Java 9 (major version 53) class files
+    # as if they were Java 8 ones
+    if len(data) > 7 and data[6] == 0 and data[7] == 53:
+        data = data[:7] + b'\x34' + data[8:]
+
+    crc = 0
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ CRC64_TABLE[(crc ^ byte) & 0xff]
+    return crc
+
+# Sizes of the constant pool entries after their tag (other than Utf8)
+CONSTANT_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4, 12: 4,
+                  15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+
+ACC_PRIVATE = 0x0002
+ACC_BRIDGE = 0x0040
+ACC_SYNTHETIC = 0x1000
+ACC_ENUM = 0x4000
+ACC_MODULE = 0x8000
+
+def _skip_attributes(data, pos):
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        length, = struct.unpack_from('>I', data, pos + 2)
+        pos += 6 + length
+    return pos
+
+def read_class(data):
+    """
+    Parse what the coverage analysis needs from a class file and return
+    `(ACCESS, NAME, SUPER_NAME, SOURCE_FILE, METHODS, ANNOTATIONS)`,
+    where `NAME` and `SUPER_NAME` are internal names of classes
+    (`com/foo/Bar$Inner`), `ANNOTATIONS` the type descriptors of the
+    annotations of the class and `METHODS` a list of `(ACCESS, NAME,
+    DESCRIPTOR, CODE, ANNOTATIONS)` tuples in class file order.
+
+    `CODE` is None or `(BYTECODE, EXCEPTION_TABLE, LINE_NUMBERS, REFS)`:
+    the entries of `EXCEPTION_TABLE` are `(START, END, HANDLER,
+    CATCH_TYPE)` with the internal name of the caught class (or None for
+    any), and `REFS` maps the constant pool index of the fields and
+    methods the class refers to to their `(OWNER, NAME, DESCRIPTOR)`.
+
+    Raises a ValueError if `data` is not a class file.
+    """
+    if len(data) < 10 or struct.unpack_from('>I', data, 0)[0] != 0xCAFEBABE:
+        raise ValueError("Not a class file")
+
+    # Constant pool, keeping the Utf8, Class, field and method entries only
+    utf8 = dict()
+    classes = dict()
+    members = dict()
+    name_and_types = dict()
+    count, = struct.unpack_from('>H', data, 8)
+    pos = 10
+    i = 1
+    while i < count:
+        tag = data[pos]
+        if tag == 1:
+            length, = struct.unpack_from('>H', data, pos + 1)
+            utf8[i] = data[pos + 3:pos + 3 + length].decode('utf-8', 'replace')
+            pos += 3 + length
+        elif tag == 7:
+            classes[i], = struct.unpack_from('>H', data, pos + 1)
+            pos += 3
+        elif tag in CONSTANT_SIZES:
+            if tag in (9, 10, 11):
+                members[i] = struct.unpack_from('>HH', data, pos + 1)
+            elif tag == 12:
+                name_and_types[i] = struct.unpack_from('>HH', data, pos + 1)
+            pos += 1 + CONSTANT_SIZES[tag]
+        else:
+            raise ValueError("Unknown constant pool tag {0}".format(tag))
+        # Long and Double entries take two slots
+        i += 2 if tag in (5, 6) else 1
+
+    refs = dict()
+    for (i, (owner, name_and_type)) in members.items():
+        name, descriptor = name_and_types.get(name_and_type, (None, None))
+        refs[i] = (utf8.get(classes.get(owner)), utf8.get(name), utf8.get(descriptor))
+    catch_types = dict((i, utf8.get(name)) for (i, name) in classes.items())
+
+    access, this_class, super_class, interfaces = struct.unpack_from('>HHHH', data, pos)
+    pos += 8 + 2 * interfaces
+
+    fields, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(fields):
+        pos = _skip_attributes(data, pos + 6)
+
+    methods = []
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        method_access, name, descriptor, attributes = struct.unpack_from('>HHHH', data, pos)
+        pos += 8
+        code = None
+        annotations = []
+        for _ in range(attributes):
+            attribute, length = struct.unpack_from('>HI', data, pos)
+            if utf8.get(attribute) == 'Code':
+                code = _read_code(data, pos + 6, utf8, catch_types, refs)
+            elif utf8.get(attribute) in ANNOTATION_ATTRIBUTES:
+                annotations.extend(_read_annotations(data, pos + 6, utf8))
+            pos += 6 + length
+        methods.append((method_access, utf8.get(name), utf8.get(descriptor), code, annotations))
+
+    source_file = None
+    annotations = []
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        attribute, length = struct.unpack_from('>HI', data, pos)
+        if utf8.get(attribute) == 'SourceFile':
+            source_file = utf8.get(struct.unpack_from('>H', data, pos + 6)[0])
+        elif utf8.get(attribute) in ANNOTATION_ATTRIBUTES:
+            annotations.extend(_read_annotations(data, pos + 6, utf8))
+        pos += 6 + length
+
+    return (access, utf8.get(classes.get(this_class)), utf8.get(classes.get(super_class)), source_file,
+            methods, annotations)
+
+# The annotation the Kotlin compiler puts on every class
+KOTLIN_METADATA = 'Lkotlin/Metadata;'
+
+# Annotations of CLASS and RUNTIME retention
+ANNOTATION_ATTRIBUTES = frozenset(['RuntimeVisibleAnnotations', 'RuntimeInvisibleAnnotations'])
+
+def _read_annotations(data, pos, utf8):
+    """
+    Return the type descriptors of the annotations of an annotations
+    attribute.
+    """
+    types = []
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        annotation_type, = struct.unpack_from('>H', data, pos)
+        types.append(utf8.get(annotation_type))
+        pos = _skip_annotation(data, pos)
+    return types
+
+def _skip_annotation(data, pos):
+    pairs, = struct.unpack_from('>H', data, pos + 2)
+    pos += 4
+    for _ in range(pairs):
+        pos = _skip_element_value(data, pos + 2)
+    return pos
+
+def _skip_element_value(data, pos):
+    tag = data[pos:pos + 1]
+    if tag == b'e':
+        return pos + 5
+    if tag == b'@':
+        return _skip_annotation(data, pos + 1)
+    if tag == b'[':
+        values, = struct.unpack_from('>H', data, pos + 1)
+        pos += 3
+        for _ in range(values):
+            pos = _skip_element_value(data, pos)
+        return pos
+    # A constant or a class
+    return pos + 3
+
+def _read_code(data, pos, utf8, catch_types, refs):
+    """
+    Read a Code attribute, see `read_class`.
+    """
+    code_length, = struct.unpack_from('>I', data, pos + 4)
+    pos += 8
+    bytecode = data[pos:pos + code_length]
+    pos += code_length
+
+    exception_table = []
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        start, end, handler, catch_type = struct.unpack_from('>HHHH', data, pos)
+        exception_table.append((start, end, handler, catch_types.get(catch_type)))
+        pos += 8
+
+    line_numbers = []
+    count, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    for _ in range(count):
+        attribute, length = struct.unpack_from('>HI', data, pos)
+        if utf8.get(attribute) == 'LineNumberTable':
+            entries, = struct.unpack_from('>H', data, pos + 6)
+            for j in range(entries):
+                line_numbers.append(struct.unpack_from('>HH', data, pos + 8 + 4 * j))
+        pos += 6 + length
+
+    return bytecode, exception_table, line_numbers, refs
+
+# Size of the instructions that are not jumps, switches or `wide`
+OPCODE_SIZES = [1] * 256
+for (opcodes, size) in (((16, 18, 188, 169) + tuple(range(21, 26)) + tuple(range(54, 59)), 2),
+                        ((17, 19, 20, 132, 187, 189, 192, 193) + tuple(range(178, 185)), 3),
+                        ((197,), 4), ((185, 186), 5)):
+    for opcode in opcodes:
+        OPCODE_SIZES[opcode] = size
+
+OP_GOTO = 167
+OP_GOTO_W = 200
+OP_TABLESWITCH = 170
+OP_LOOKUPSWITCH = 171
+OP_WIDE = 196
+# Instructions ending a method and calling one
+RETURN_OPCODES = frozenset(list(range(172, 178)) + [191])
+INVOKE_OPCODES = frozenset(range(182, 187))
+# Subroutines, which JaCoCo does not support either
+SUBROUTINE_OPCODES = frozenset([168, 169, 201])
+
+def _decode_instructions(bytecode):
+    """
+    Yield an `(OFFSET, OPCODE, TARGETS)` tuple per instruction, where
+    `TARGETS` is None, the target offset of a jump, or the list of the
+    default and case target offsets of a switch.  `goto_w` is given as
+    `goto`, like ASM does.
+    """
+    pos = 0
+    while pos < len(bytecode):
+        opcode = bytecode[pos]
+
+        if opcode in SUBROUTINE_OPCODES:
+            raise ValueError("Subroutines are not supported")
+
+        elif 153 <= opcode <= 167 or opcode in (198, 199):
+            yield pos, opcode, pos + struct.unpack_from('>h', bytecode, pos + 1)[0]
+            pos += 3
+
+        elif opcode == OP_GOTO_W:
+            yield pos, OP_GOTO, pos + struct.unpack_from('>i', bytecode, pos + 1)[0]
+            pos += 5
+
+        elif opcode in (OP_TABLESWITCH, OP_LOOKUPSWITCH):
+            # Operands are 4-byte aligned
+            start = pos + 4 - pos % 4
+            if opcode == OP_TABLESWITCH:
+                default, low, high = struct.unpack_from('>iii', bytecode, start)
+                offsets = struct.unpack_from('>{0}i'.format(high - low + 1), bytecode, start + 12)
+                end = start + 12 + 4 * len(offsets)
+            else:
+                default, pairs = struct.unpack_from('>ii', bytecode, start)
+                offsets = struct.unpack_from('>{0}i'.format(2 * pairs), bytecode, start + 8)[1::2]
+                end = start + 8 + 8 * pairs
+            yield pos, opcode, [pos + default] + [pos + offset for offset in offsets]
+            pos = end
+
+        elif opcode == OP_WIDE:
+            yield pos, bytecode[pos + 1], None
+            pos += 6 if bytecode[pos + 1] == 132 else 4
+
+        else:
+            yield pos, opcode, None
+            pos += OPCODE_SIZES[opcode]
+
+class _Label(object):
+    """
+    What JaCoCo's `LabelInfo` records about a bytecode offset.
+    """
+    __slots__ = ('target', 'successor', 'multi_target', 'invocation_line', 'done', 'probe', 'instruction')
+
+    def __init__(self):
+        self.target = self.successor = self.multi_target = self.invocation_line = self.done = False
+        self.probe = None
+        self.instruction = None
+
+    def set_target(self):
+        if self.target or self.successor:
+            self.multi_target = True
+        else:
+            self.target = True
+
+    def set_successor(self):
+        self.successor = True
+        if self.target:
+            self.multi_target = True
+
+    def needs_probe(self):
+        return self.successor and (self.multi_target or self.invocation_line)
+
+class _Instruction(object):
+    """
+    An instruction of JaCoCo's coverage analysis: its branches and which
+    of them were executed, propagated back to the instructions before it.
+    """
+    __slots__ = ('line', 'branches', 'covered', 'predecessor', 'predecessor_branch')
+
+    def __init__(self, line):
+        self.line = line
+        self.branches = 0
+        self.covered = set()
+        self.predecessor = None
+        self.predecessor_branch = 0
+
+    def add_branch(self, target, branch):
+        self.branches += 1
+        target.predecessor = self
+        target.predecessor_branch = branch
+        if target.covered:
+            self.propagate(branch)
+
+    def add_probe(self, executed, branch):
+        self.branches += 1
+        if executed:
+            self.propagate(branch)
+
+    def propagate(self, branch):
+        instruction = self
+        while instruction is not None:
+            if instruction.covered:
+                instruction.covered.add(branch)
+                break
+            instruction.covered.add(branch)
+            branch = instruction.predecessor_branch
+            instruction = instruction.predecessor
+
+def analyze_method(code, probes, next_probe):
+    """
+    Replay how JaCoCo instruments a method and computes its coverage:
+    its `LabelFlowAnalyzer` finds the offsets needing probes, probe ids
+    are given in instruction order from `next_probe` (as its
+    `MethodProbesAdapter` does), and executed probes mark the
+    instructions leading to them as covered (its `MethodAnalyzer`).
+
+    Returns the list of `_Instruction` and the next free probe id.
+    """
+    bytecode, exception_table, line_numbers, _ = code
+    instructions = list(_decode_instructions(bytecode))
+
+    # Of several line numbers of the same offset, the last one counts
+    lines = dict(line_numbers)
+
+    # ASM gives a label to every offset some part of the method refers to
+    label_offsets = set(lines)
+    for (start, end, handler, _) in exception_table:
+        label_offsets.update((start, end, handler))
+    for (_, _, targets) in instructions:
+        if isinstance(targets, list):
+            label_offsets.update(targets)
+        elif targets is not None:
+            label_offsets.add(targets)
+    labels = dict((offset, _Label()) for offset in label_offsets)
+
+    # Offsets in the order ASM visits them: labels, then the instruction
+    events = sorted(set(labels).union(offset for (offset, _, _) in instructions))
+    at = dict((offset, (opcode, targets)) for (offset, opcode, targets) in instructions)
+
+    # Label flow analysis; try/catch blocks are visited first, last one first
+    for (start, _, handler, _) in reversed(exception_table):
+        labels[start].set_target()
+        labels[handler].set_target()
+
+    successor = False
+    first = True
+    line_start = None
+    for offset in events:
+        if offset in labels:
+            if first:
+                labels[offset].set_target()
+            if successor:
+                labels[offset].set_successor()
+        if offset in lines:
+            line_start = offset
+        if offset not in at:
+            continue
+
+        opcode, targets = at[offset]
+        first = False
+        if isinstance(targets, list):
+            for target in targets:
+                labels[target].done = False
+            for target in targets:
+                if not labels[target].done:
+                    labels[target].set_target()
+                    labels[target].done = True
+            successor = False
+        elif targets is not None:
+            labels[targets].set_target()
+            successor = opcode != OP_GOTO
+        elif opcode in RETURN_OPCODES:
+            successor = False
+        else:
+            successor = True
+            if opcode in INVOKE_OPCODES and line_start is not None:
+                labels[line_start].invocation_line = True
+
+    # Probe insertion and coverage analysis
+    def executed(probe):
+        return probes is not None and probe < len(probes) and bool(probes[probe])
+
+    result = []
+    jumps = []
+    pending = []
+    current = None
+    line = None
+    for offset in events:
+        label = labels.get(offset)
+        if label is not None:
+            if label.needs_probe():
+                current.add_probe(executed(next_probe), 0)
+                next_probe += 1
+                current = None
+            pending.append(label)
+            if not label.successor:
+                current = None
+        if offset in lines:
+            line = lines[offset]
+        if offset not in at:
+            continue
+
+        opcode, targets = at[offset]
+        instruction = _Instruction(line)
+        for label in pending:
+            label.instruction = instruction
+        del pending[:]
+        if current is not None:
+            current.add_branch(instruction, 0)
+        current = instruction
+        result.append(instruction)
+
+        if isinstance(targets, list):
+            # Probes for the targets reached from several places
+            for target in targets:
+                labels[target].probe = None
+            for target in targets:
+                if labels[target].multi_target and labels[target].probe is None:
+                    labels[target].probe = next_probe
+                    next_probe += 1
+            for target in targets:
+                labels[target].done = False
+            for (branch, target) in enumerate(targets):
+                if not labels[target].done:
+                    if labels[target].probe is None:
+                        jumps.append((instruction, target, branch))
+                    else:
+                        instruction.add_probe(executed(labels[target].probe), branch)
+                    labels[target].done = True
+        elif targets is not None:
+            if labels[targets].multi_target:
+                instruction.add_probe(executed(next_probe), 1)
+                next_probe += 1
+            else:
+                jumps.append((instruction, targets, 1))
+        elif opcode in RETURN_OPCODES:
+            instruction.add_probe(executed(next_probe), 0)
+            next_probe += 1
+
+    for (source, target, branch) in jumps:
+        source.add_branch(labels[target].instruction, branch)
+
+    return result, next_probe
+
+# Opcodes JaCoCo's filters look for, as ASM gives them (see `_MethodCode`)
+OP_LDC = 18
+OP_ILOAD = 21
+OP_ALOAD = 25
+OP_ISTORE = 54
+OP_ASTORE = 58
+OP_IFEQ = 153
+OP_IFNULL = 198
+OP_INVOKEVIRTUAL = 182
+OP_INVOKEINTERFACE = 185
+OP_ATHROW = 191
+OP_MONITOREXIT = 195
+# getstatic, putstatic, getfield and putfield
+FIELD_OPCODES = frozenset(range(178, 182))
+# iconst_m1 to iconst_5, bipush and sipush
+INT_CONST_OPCODES = frozenset(list(range(2, 9)) + [16, 17])
+
+class _MethodCode(object):
+    """
+    The instructions of a method the way ASM gives them to JaCoCo's
+    filters, as `(OFFSET, OPCODE, TARGETS, OPERAND)` tuples: loads and
+    stores with their local variable as `OPERAND` (`aload_1` is an
+    `aload` of 1), `ldc_w` and `ldc2_w` as `ldc`, and field accesses and
+    method calls with the constant pool index of the member as `OPERAND`.
+    """
+
+    def __init__(self, code):
+        bytecode, self.exception_table, _, self.refs = code
+
+        self.instructions = []
+        for (offset, opcode, targets) in _decode_instructions(bytecode):
+            operand = None
+            if bytecode[offset] == OP_WIDE:
+                operand, = struct.unpack_from('>H', bytecode, offset + 2)
+            elif 21 <= opcode <= 25 or 54 <= opcode <= 58:
+                operand = bytecode[offset + 1]
+            elif 26 <= opcode <= 45:
+                opcode, operand = 21 + (opcode - 26) // 4, (opcode - 26) % 4
+            elif 59 <= opcode <= 78:
+                opcode, operand = 54 + (opcode - 59) // 4, (opcode - 59) % 4
+            elif opcode in (19, 20):
+                opcode = OP_LDC
+            elif opcode in FIELD_OPCODES or opcode in INVOKE_OPCODES:
+                operand, = struct.unpack_from('>H', bytecode, offset + 1)
+            self.instructions.append((offset, opcode, targets, operand))
+        self._offsets = [offset for (offset, _, _, _) in self.instructions]
+
+    def index(self, offset):
+        """
+        Return the index of the first instruction at `offset` or after.
+        """
+        return bisect.bisect_left(self._offsets, offset)
+
+    def matcher(self, offset):
+        """
+        Return a `_Matcher` of the instructions from `offset` on.
+        """
+        return _Matcher(self, self.index(offset))
+
+class _Matcher(object):
+    """
+    Match the instructions of a `_MethodCode` one after the other, like
+    JaCoCo's `AbstractMatcher`: `cursor` is the index of the last one
+    matched, and None once one does not match.  A local variable gets a
+    name from the first instruction matched with it.
+    """
+
+    def __init__(self, method, index):
+        self.method = method
+        self.cursor = index - 1
+        self.vars = dict()
+
+    def _next(self, opcodes):
+        if self.cursor is not None and self.cursor + 1 < len(self.method.instructions) \
+                and self.method.instructions[self.cursor + 1][1] in opcodes:
+            self.cursor += 1
+            return self.method.instructions[self.cursor]
+        self.cursor = None
+        return None
+
+    def next_is(self, *opcodes):
+        self._next(opcodes)
+
+    def next_is_int(self):
+        self._next(INT_CONST_OPCODES)
+
+    def next_is_var(self, opcode, name):
+        instruction = self._next((opcode,))
+        if instruction is not None and self.vars.setdefault(name, instruction[3]) != instruction[3]:
+            self.cursor = None
+
+    def next_is_invoke(self, opcodes, owner, name, descriptor):
+        instruction = self._next(opcodes if isinstance(opcodes, tuple) else (opcodes,))
+        if instruction is None:
+            return
+        method_ref = self.method.refs.get(instruction[3], (None, None, None))
+        if method_ref[1:] != (name, descriptor) or owner not in (None, method_ref[0]):
+            self.cursor = None
+
+class _FilterOutput(object):
+    """
+    What JaCoCo's filters tell its coverage calculator about the
+    instructions of a method, by index: the ones to ignore, and the
+    ones merged into another one (their representative).
+    """
+
+    def __init__(self):
+        self.ignored = set()
+        self.merged = dict()
+
+    def ignore(self, first, last):
+        self.ignored.update(range(first, last + 1))
+
+    def merge(self, first, second):
+        first = self.representative(first)
+        second = self.representative(second)
+        if first != second:
+            self.merged[second] = first
+
+    def representative(self, index):
+        while index in self.merged:
+            index = self.merged[index]
+        return index
+
+def _filter_synchronized(method, output):
+    """
+    The handler javac and ecj add to a `synchronized` block, releasing
+    the monitor when the block throws.
+    """
+    for (start, _, handler, catch_type) in method.exception_table:
+        if catch_type is not None or start == handler:
+            continue
+
+        matcher = method.matcher(handler)
+        matcher.next_is(OP_ALOAD)
+        matcher.next_is(OP_MONITOREXIT)
+        matcher.next_is(OP_ATHROW)
+        if matcher.cursor is None:
+            matcher = method.matcher(handler)
+            matcher.next_is_var(OP_ASTORE, 'thrown')
+            matcher.next_is(OP_ALOAD)
+            matcher.next_is(OP_MONITOREXIT)
+            matcher.next_is_var(OP_ALOAD, 'thrown')
+            matcher.next_is(OP_ATHROW)
+        if matcher.cursor is not None:
+            output.ignore(method.index(handler), matcher.cursor)
+
+def _filter_finally(method, output):
+    """
+    The copies of a `finally` block: the compiler puts one at every exit
+    of the `try` block and one in a handler catching anything (between
+    storing and throwing again the exception).  The copies count once,
+    as the one of the handler, covered if any of them is.
+    """
+    instructions = method.instructions
+    handlers = []
+    for (_, _, handler, catch_type) in method.exception_table:
+        if catch_type is None and handler not in handlers:
+            handlers.append(handler)
+
+    for handler in handlers:
+        first = method.index(handler)
+        size = _finally_size(instructions, first)
+        if size <= 0:
+            continue
+
+        regions = [(method.index(start), method.index(end))
+                   for (start, end, other, _) in method.exception_table if other == handler]
+        inside = set()
+        for (start, end) in regions:
+            inside.update(range(start, end))
+
+        # The copies are where the regions are left
+        for (start, end) in regions:
+            continues = False
+            for (offset, opcode, targets, _) in instructions[start:end]:
+                if targets is not None and not isinstance(targets, list):
+                    target = method.index(targets)
+                    if target not in inside:
+                        _merge_finally(instructions, output, size, first, target)
+                    continues = opcode != OP_GOTO
+                else:
+                    continues = opcode not in RETURN_OPCODES
+            if continues and end not in inside:
+                _merge_finally(instructions, output, size, first, end)
+
+def _finally_size(instructions, first):
+    """
+    Return the number of instructions of the `finally` block in the
+    handler starting at `first`, or 0 if it is not one.
+    """
+    if first >= len(instructions) or instructions[first][1] != OP_ASTORE:
+        return 0
+    thrown = instructions[first][3]
+    last = first + 1
+    while last < len(instructions) and instructions[last][1:4:2] != (OP_ALOAD, thrown):
+        last += 1
+    if last + 1 >= len(instructions) or instructions[last + 1][1] != OP_ATHROW:
+        return 0
+    return last - first - 1
+
+def _merge_finally(instructions, output, size, first, copy):
+    """
+    Merge the `finally` block of the handler at `first` with the copy
+    starting at `copy`, if it is one.
+    """
+    if copy + size > len(instructions):
+        return
+    for i in range(size):
+        if instructions[first + 1 + i][1] != instructions[copy + i][1]:
+            return
+
+    output.ignore(first, first)
+    for i in range(size):
+        output.merge(first + 1 + i, copy + i)
+    output.ignore(first + size + 1, first + size + 2)
+
+    # The jump after a copy that did not run would make the last line
+    # of the block partly covered
+    if copy + size < len(instructions) and instructions[copy + size][1] == OP_GOTO:
+        output.ignore(copy + size, copy + size)
+
+def _filter_try_with_resources(method, output):
+    """
+    The closing of the resource of a try-with-resources, as javac 11 and
+    later compile it: at every normal exit of the `try` block, and in a
+    `Throwable` handler adding what closing throws to the suppressed
+    exceptions of what the block threw.
+    """
+    for (_, _, handler, catch_type) in method.exception_table:
+        if catch_type != 'java/lang/Throwable':
+            continue
+
+        # The resource is null checked unless it is created with `new`
+        for null_check in (True, False):
+            matcher = method.matcher(handler)
+            matcher.next_is_var(OP_ASTORE, 'thrown')
+            _next_is_close(matcher, null_check)
+            matcher.next_is(OP_GOTO)
+            matcher.next_is_var(OP_ASTORE, 'suppressed')
+            matcher.next_is_var(OP_ALOAD, 'thrown')
+            matcher.next_is_var(OP_ALOAD, 'suppressed')
+            matcher.next_is_invoke(OP_INVOKEVIRTUAL, 'java/lang/Throwable', 'addSuppressed',
+                                   '(Ljava/lang/Throwable;)V')
+            matcher.next_is_var(OP_ALOAD, 'thrown')
+            matcher.next_is(OP_ATHROW)
+            if matcher.cursor is None:
+                continue
+            output.ignore(method.index(handler), matcher.cursor)
+
+            for (_, end, other, _) in method.exception_table:
+                if other != handler:
+                    continue
+                close = method.matcher(end)
+                close.vars['resource'] = matcher.vars['resource']
+                _next_is_close(close, null_check)
+                if close.cursor is not None:
+                    output.ignore(method.index(end), close.cursor)
+            break
+
+def _next_is_close(matcher, null_check):
+    if null_check:
+        matcher.next_is_var(OP_ALOAD, 'resource')
+        matcher.next_is(OP_IFNULL)
+    matcher.next_is_var(OP_ALOAD, 'resource')
+    matcher.next_is_invoke((OP_INVOKEVIRTUAL, OP_INVOKEINTERFACE), None, 'close', '()V')
+
+def _filter_string_switch(method, output):
+    """
+    The first of the two switches javac compiles a switch on strings
+    to: on the hash code of the string, comparing it to the strings of
+    each hash code to find the index of its case, which the second
+    switch is on.  Only the branches of the second switch count.
+    """
+    instructions = method.instructions
+    for (i, (_, opcode, targets, _)) in enumerate(instructions):
+        if opcode not in (OP_TABLESWITCH, OP_LOOKUPSWITCH) or i < 2:
+            continue
+        matcher = _Matcher(method, i - 2)
+        matcher.next_is_var(OP_ALOAD, 'string')
+        matcher.next_is_invoke(OP_INVOKEVIRTUAL, 'java/lang/String', 'hashCode', '()I')
+        matcher.next_is(OP_TABLESWITCH, OP_LOOKUPSWITCH)
+        second = method.index(targets[0])
+        if matcher.cursor is None or not all(i < method.index(target) <= second for target in targets):
+            continue
+
+        while matcher.cursor is not None and matcher.cursor + 1 < second:
+            matcher.next_is_var(OP_ALOAD, 'string')
+            matcher.next_is(OP_LDC)
+            matcher.next_is_invoke(OP_INVOKEVIRTUAL, 'java/lang/String', 'equals', '(Ljava/lang/Object;)Z')
+            matcher.next_is(OP_IFEQ)
+            matcher.next_is_int()
+            matcher.next_is_var(OP_ISTORE, 'case')
+            # No jump after the last comparison
+            if matcher.cursor is not None and matcher.cursor + 1 < second \
+                    and instructions[matcher.cursor + 1][1] == OP_GOTO:
+                matcher.next_is(OP_GOTO)
+        matcher.next_is_var(OP_ILOAD, 'case')
+        matcher.next_is(OP_TABLESWITCH, OP_LOOKUPSWITCH)
+        if matcher.cursor is not None:
+            output.ignore(i, second - 1)
+
+# JaCoCo's filters of the generated code within methods, that are
+# applied here; `_unfiltered_code` tells of the others
+METHOD_FILTERS = (_filter_synchronized, _filter_finally, _filter_try_with_resources, _filter_string_switch)
+
+# Exceptions javac throws from the default case it adds to exhaustive
+# switches, which JaCoCo filters out
+SWITCH_EXCEPTIONS = frozenset(['java/lang/MatchException', 'java/lang/IncompatibleClassChangeError'])
+
+def _unfiltered_code(method, ignored):
+    """
+    Tell whether a method has code JaCoCo filters out that the filters
+    here do not recognize: try-with-resources compiled by javac 7 to 10
+    or ecj (a method calling `addSuppressed` itself is taken for one),
+    switches on strings compiled by ecj, `assert` statements and the
+    default case of exhaustive switches.
+    """
+    instructions = method.instructions
+    for (i, (_, opcode, _, operand)) in enumerate(instructions):
+        if i in ignored or (opcode not in INVOKE_OPCODES and opcode not in FIELD_OPCODES):
+            continue
+        owner, name, descriptor = method.refs.get(operand, (None, None, None))
+        if name in ('$closeResource', '$assertionsDisabled') \
+                or (owner, name) == ('java/lang/Throwable', 'addSuppressed'):
+            return True
+        if name == '<init>' and owner in SWITCH_EXCEPTIONS:
+            return True
+        if (owner, name, descriptor) == ('java/lang/String', 'hashCode', '()I') and i + 1 < len(instructions) \
+                and instructions[i + 1][1] in (OP_TABLESWITCH, OP_LOOKUPSWITCH) and i + 1 not in ignored:
+            return True
+    return False
+
+def filter_method(code, instructions):
+    """
+    Apply JaCoCo's filters of compiler generated code to the analyzed
+    `instructions` of a method (see `analyze_method`) and return
+    `(INSTRUCTIONS, RECOGNIZED)`: the instructions JaCoCo counts, and
+    False if the method has generated code that JaCoCo filters but the
+    filters here do not recognize (see `_unfiltered_code`).
+
+    As JaCoCo's `MethodCoverageCalculator` does, merged instructions
+    count once, as their representative, with the branches covered in
+    any of them.
+    """
+    method = _MethodCode(code)
+    output = _FilterOutput()
+    for method_filter in METHOD_FILTERS:
+        method_filter(method, output)
+
+    instructions = list(instructions)
+    ignored = set(output.ignored)
+    for index in output.merged:
+        representative = output.representative(index)
+        merged = _Instruction(instructions[representative].line)
+        merged.branches = instructions[representative].branches
+        merged.covered = instructions[representative].covered | instructions[index].covered
+        instructions[representative] = merged
+        ignored.add(index)
+
+    return ([instruction for (index, instruction) in enumerate(instructions) if index not in ignored],
+            not _unfiltered_code(method, ignored))
+
+# The `(NAME, DESCRIPTOR)` of the methods javac generates for records, and
+# their code: `aload_0`, (`aload_1`), `invokedynamic` of ObjectMethods, return
+RECORD_METHODS = {
+    ('toString', '()Ljava/lang/String;'): re.compile(rb'\A\x2a\xba..\x00\x00\xb0\Z', re.DOTALL),
+    ('hashCode', '()I'): re.compile(rb'\A\x2a\xba..\x00\x00\xac\Z', re.DOTALL),
+    ('equals', '(Ljava/lang/Object;)Z'): re.compile(rb'\A\x2a\x2b\xba..\x00\x00\xac\Z', re.DOTALL),
+}
+
+def _ignored_method(class_access, super_name, access, name, descriptor, code, annotations):
+    """
+    The methods JaCoCo's filters leave out of the report that can be
+    recognized from the class file alone: compiler generated methods
+    (but lambda bodies), `values()`/`valueOf()` and empty constructors
+    of enums, the generated `toString()`, `hashCode()` and `equals()` of
+    records, empty private no-argument constructors, and methods of a
+    class or annotated with an annotation named `*Generated*` (of class
+    or runtime retention, such as Lombok's `@lombok.Generated`), given
+    in `annotations`.
+    """
+    if access & (ACC_SYNTHETIC | ACC_BRIDGE) and not name.startswith('lambda$'):
+        return True
+    if any('Generated' in annotation for annotation in annotations):
+        return True
+    if class_access & ACC_ENUM:
+        if name == 'values' and descriptor.startswith('()'):
+            return True
+        if name == 'valueOf' and descriptor.startswith('(Ljava/lang/String;)'):
+            return True
+    # aload_0, aload_1, iload_2, invokespecial Enum(name, ordinal), return
+    if super_name == 'java/lang/Enum' and (name, descriptor) == ('<init>', '(Ljava/lang/String;I)V') \
+            and code is not None and len(code[0]) == 7 and code[0][:4] == b'\x2a\x2b\x1c\xb7' \
+            and code[0][6] == 0xb1:
+        return code[3].get(struct.unpack_from('>H', code[0], 4)[0]) == \
+            ('java/lang/Enum', '<init>', '(Ljava/lang/String;I)V')
+    if super_name == 'java/lang/Record' and (name, descriptor) in RECORD_METHODS and code is not None:
+        return RECORD_METHODS[name, descriptor].match(code[0]) is not None
+    # aload_0, invokespecial super(), return
+    if (name, descriptor) == ('<init>', '()V') and access & ACC_PRIVATE and code is not None:
+        bytecode = code[0]
+        return len(bytecode) == 5 and bytecode[0] == 0x2a and bytecode[1] == 0xb7 and bytecode[4] == 0xb1
+    return False
+
+def _analyze_methods(class_access, super_name, class_annotations, methods, probes):
+    """
+    Analyze the methods of a class with `probes`, and return the
+    `filter_method` result of the reported methods and the number of
+    probes.  None of the code of Kotlin classes is recognized, JaCoCo's
+    Kotlin filters are not applied here.
+    """
+    kotlin = KOTLIN_METADATA in class_annotations
+    analyzed = []
+    next_probe = 0
+    for (access, name, descriptor, code, annotations) in methods:
+        if code is None:
+            continue
+        instructions, next_probe = analyze_method(code, probes, next_probe)
+        if not _ignored_method(class_access, super_name, access, name, descriptor, code,
+                               class_annotations + annotations):
+            instructions, recognized = filter_method(code, instructions)
+            analyzed.append((instructions, recognized and not kotlin))
+    return analyzed, next_probe
+
+def analyze_class(data, execution_data, counters=None, ranges=None, unknown=None):
+    """
+    Add the `[MI, CI, MB, CB]` counters of every source line of the
+    class file `data` to `counters` (a dictionary by line number) and
+    return it, using the probes `execution_data` has for the class.
+
+    With a `ranges` list, the `(FIRST_LINE, LAST_LINE, CLASS, METHOD)`
+    line range of every reported method is appended to it (see
+    `MethodIndex`).  Lambda bodies are left out, so that their lines
+    count for the method they are written in.
+
+    With an `unknown` set, the lines of the methods whose generated code
+    is not recognized (see `filter_method`) are added to it instead of
+    `counters`, as they may be counted differently than by JaCoCo.
+    """
+    if counters is None:
+        counters = dict()
+
+    # JaCoCo does not report compiler generated classes and modules
+    class_access, class_name, super_name, _, methods, class_annotations = read_class(data)
+    if class_access & (ACC_SYNTHETIC | ACC_MODULE):
+        return counters
+
+    if ranges is not None:
+        for (access, name, descriptor, code, annotations) in methods:
+            if code is None or not code[2] or name.startswith('lambda$') \
+                    or _ignored_method(class_access, super_name, access, name, descriptor, code,
+                                       class_annotations + annotations):
+                continue
+            lines = [line for (_, line) in code[2]]
+            ranges.append((min(lines), max(lines), class_name.replace('/', '.'),
+                           method_label(class_name, name, descriptor)))
+
+    probes = execution_data.get(class_id(data))
+    analyzed, probe_count = _analyze_methods(class_access, super_name, class_annotations, methods, probes)
+
+    # Execution data of another build of the class cannot be used
+    if probes is not None and len(probes) != probe_count:
+        print("Execution data does not match a class, ignoring it")
+        analyzed, _ = _analyze_methods(class_access, super_name, class_annotations, methods, None)
+
+    for (instructions, recognized) in analyzed:
+        for instruction in instructions:
+            if instruction.line is None:
+                continue
+            if not recognized and unknown is not None:
+                unknown.add(instruction.line)
+                continue
+            line = counters.setdefault(instruction.line, [0, 0, 0, 0])
+            line[1 if instruction.covered else 0] += 1
+            if instruction.branches > 1:
+                line[2] += instruction.branches - len(instruction.covered)
+                line[3] += len(instruction.covered)
+    return counters
+
+def find_class_files(classes_dirs, src_path):
+    """
+    Return `(PACKAGE, CLASS_FILES)` for the changed source file
+    `src_path`: the class files compiled from it (by their SourceFile
+    attribute) in the package directory that matches the longest
+    trailing part of its path, or None.
+    """
+    parts = src_path.split('/')
+    for classes_dir in classes_dirs:
+        for i in range(len(parts)):
+            package_dir = os.path.join(classes_dir, *parts[i:-1])
+            if not os.path.isdir(package_dir):
+                continue
+
+            class_files = []
+            for name in sorted(os.listdir(package_dir)):
+                if not name.endswith('.class'):
+                    continue
+                class_path = os.path.join(package_dir, name)
+                with open(class_path, 'rb') as class_file:
+                    data = class_file.read()
+                try:
+                    if read_class(data)[3] == parts[-1]:
+                        class_files.append(data)
+                except (ValueError, struct.error):
+                    print("Could not read class->"+class_path)
+            if class_files:
+                return '/'.join(parts[i:-1]), class_files
+    return None
+
+def report_from_exec(diff_report, exec_paths, classes_dirs, gate=None, unknown=None):
+    """
+    Same as `report`, but compute the coverage of the changed files
+    straight from JaCoCo execution data (one or more `jacoco.exec`, or
+    an `ExecutionData`) and the compiled classes in `classes_dirs`
+    (such as `target/classes`), without a JaCoCo report.
+
+    Only the classes compiled from changed files are read and analyzed
+    (see `analyze_method`), so the cost follows the size of the diff.
+    Report entries get the instruction and branch counts of the changed
+    lines and their per-class and per-method rollups, like with a
+    `jacoco.xml`.  Changed lines of methods with compiler generated code
+    that JaCoCo filters but `filter_method` does not recognize are not
+    counted, but added to the `unknown` lines of the entry.
+    """
+    report = {}
+
+    if isinstance(classes_dirs, str):
+        classes_dirs = [classes_dirs]
+    if isinstance(exec_paths, ExecutionData):
+        execution_data = exec_paths
+    else:
+        with PROFILER.stage('exec_reading'):
+            execution_data = ExecutionData(exec_paths)
+
+    src_paths = [src_path for src_path in diff_report if src_path.endswith(('.java', '.kt'))]
+    if gate is not None:
+        gate.expect(sum(len(diff_report[src_path]) for src_path in src_paths))
+
+    for src_path in src_paths:
+        with PROFILER.stage('page_resolution', src_path):
+            found = find_class_files(classes_dirs, src_path)
+        if found is None:
+            print("No classes for->"+src_path)
+            continue
+        package, class_files = found
+
+        print("In parsing...->"+src_path)
+        with PROFILER.stage('class_analysis', src_path):
+            counters = dict()
+            ranges = []
+            unfiltered = set()
+            try:
+                for data in class_files:
+                    analyze_class(data, execution_data, counters, ranges, unfiltered)
+            except (ValueError, struct.error) as err:
+                print(err)
+                counters = dict()
+                ranges = []
+                unfiltered = set()
+            index = dict((line_num, _counters_entry(*counters[line_num]))
+                         for line_num in counters if line_num not in unfiltered)
+
+        path = package.replace('/', '.') if package else 'default'
+        javaname = src_path.split('/')[-1]
+        with PROFILER.stage('line_lookup', src_path):
+            counts = count_lines(index, diff_report[src_path])
+            if ranges:
+                counts['classes'] = rollup_lines(index, diff_report[src_path], MethodIndex(ranges))
+            unfiltered = sum(1 for line_num in diff_report[src_path] if line_num in unfiltered)
+        counts['link'] = path+"/"+javaname+".html"
+        if unknown is not None or unfiltered:
+            counts['unknown'] = (unknown.get(src_path, 0) if unknown is not None else 0) + unfiltered
+        report[path+javaname] = counts
+
+        if gate is not None and gate.add(counts, len(diff_report[src_path])):
+            gate.stopped_early = True
+            break
+
+    # Changed files without classes have no new lines to wait for
+    if gate is not None and not gate.stopped_early:
+        gate.remaining = 0
+    return report
+
+def _ranks(values):
+    """
+    Map each value to the position of its first occurrence in
+    `sorted(values)`, which the sortable columns use as cell ids.
+    """
+    ranks = dict()
+    for (position, value) in enumerate(sorted(values)):
+        ranks.setdefault(value, position)
+    return ranks
+
+def _percent(value):
+    return '{percent:.2%}'.format(percent=value)
+
+HTML_HEAD = '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'+\
+    '<html><head><meta http-equiv="Content-Type" content="text/html;charset=UTF-8" />\
+        <link rel="stylesheet" href=".resources/report.css" type="text/css" />\
+        <link rel="shortcut icon" href=".resources/report.gif" type="image/gif" />\
+        <title>code coverage</title><script type="text/javascript" src=".resources/sort.js"></script>\
+        </head><body onload="initialSort([{0}])">'.format("'coveragetable'")+\
+    '<div class="breadcrumb" id="breadcrumb"><span class="el_report">code coverage report</span></div><h1>Code Coverage on New Code Report</h1>'
+
+HTML_TABLE_HEAD = '<table class="coverage" cellspacing="0" id="coveragetable">'+\
+    '<thead><tr><td class="sortable" id="a" onclick="toggleSort(this)">File Name</td>\
+                 <td class="sortable" id="b" onclick="toggleSort(this)">New Lines</td>\
+                 <td class="sortable ctr1" id="c" onclick="toggleSort(this)">Covered</td>\
+                 <td class="sortable ctr2" id="d" onclick="toggleSort(this)">Cov.</td>\
+                 <td class="sortable ctr1" id="e" onclick="toggleSort(this)">No Covered</td>\
+                 <td class="sortable ctr2" id="f" onclick="toggleSort(this)">Cov.</td>\
+                 <td class="sortable ctr1" id="g" onclick="toggleSort(this)">Partical Covered</td>\
+                 <td class="sortable ctr2" id="h" onclick="toggleSort(this)">Cov.</td>\
+                 <td class="sortable ctr1" id="i" onclick="toggleSort(this)">Full Covered</td>\
+                 <td class="sortable ctr2" id="j" onclick="toggleSort(this)">Cov.</td></tr></thead>'
+
+HTML_ROW = '<tr><td id="a{ranks[0]}"><a href="{link}"class="el_package">{key}</a></td>'+\
+    '<td id="b{ranks[1]}">{new}</td>'+\
+    '<td class="bar" id="c{ranks[2]}"><img src=".resources/greenbar.gif" width="{green}" height="10" title="{covered}" alt="{covered}"/>'+\
+    '<img src=".resources/redbar.gif" width="{red}" height="10" title="{nc}" alt="{nc}"/></td>'+\
+    '<td class="ctr2" id="d{ranks[3]}">{covered_percent}</td>'+\
+    '<td class="ctr1" id="e{ranks[4]}">{nc}</td><td class="ctr2" id="f{ranks[5]}">{nc_percent}</td>'+\
+    '<td class="ctr1" id="g{ranks[6]}">{pc}</td><td class="ctr2" id="h{ranks[7]}">{pc_percent}</td>'+\
+    '<td class="ctr1" id="i{ranks[8]}">{fc}</td><td class="ctr2" id="j{ranks[9]}">{fc_percent}</td></tr>'
+
+# Tables of the class and method rollups, same columns as the files
+ROLLUP_TABLE_HEAD = '<h2>{title}</h2>'+HTML_TABLE_HEAD.replace('"coveragetable"', '"{table_id}"')\
+    .replace('>File Name<', '>{column}<')
+
+ROLLUP_ROW = HTML_ROW.replace('class="el_package"', 'class="{element}"')
+
+# Ids of the columns of each rollup table, instead of a..j: ids are
+# unique in the page, and sort.js takes the first character of a cell
+# id as its column (and of 'up-'/'dn-' hashes), the rest as its rank
+ROLLUP_COLUMNS = {'classtable': 'ABCDEFGHIJ', 'methodtable': 'KLMNOPQRST'}
+
+def _rollup_html(html, table_id):
+    """
+    Return `html`, the table head or row of a rollup table, with the
+    column ids of the table `table_id` (see `ROLLUP_COLUMNS`).
+    """
+    for (column, renamed) in zip('abcdefghij', ROLLUP_COLUMNS[table_id]):
+        html = html.replace(' id="{0}"'.format(column), ' id="{0}"'.format(renamed))
+        html = html.replace(' id="{0}{{ranks['.format(column), ' id="{0}{{ranks['.format(renamed))
+    return html
+
+HTML_FOOT = '<div class="footer"><span class="right">Code Coverage on new code Report</span></div>'+\
+    '</body></html>'
+
+def new_code_coverage(report):
+    """
+    Return the coverage of all new lines in `report` as a percentage
+    string, the same value `generateHtml` returns.
+    """
+    total_new=sum(report[key]['new'] for key in report)
+    total_nc=sum(report[key]['nc'] for key in report)
+    return _coverage_percent(total_new, total_nc)
+
+def _coverage_percent(new, nc):
+    if new > 0 :
+        return '{percent:.2%}'.format(percent=(new-nc)/float(new))
+    else:
+        return '100%'
+
+def iter_rollups(report):
+    """
+    Yield the `(REPORT_KEY, CLASS_COUNTS)` of every class rollup in
+    `report` (see `rollup_lines`), file by file.
+    """
+    for key in report:
+        for class_counts in report[key].get('classes', ()):
+            yield key, class_counts
+
+"""
+covert the report to a html file, more friendly to user than a pain txt
+"""
+def generateHtml(report, jacoco_html_path, filename="coverageOnNewCode.html"):
+    """
+    Prepare the data for generate HTML.
+
+    The metrics of every row and the sort ranks of every column are
+    computed once up front, then the page is written out row by row.
+    Reports with class and method rollups get a table of each after
+    the files.
+    """
+    with PROFILER.stage('html_rendering'):
+        return _generate_html(report, jacoco_html_path, filename)
+
+def _generate_html(report, jacoco_html_path, filename):
+    total_new=0
+    total_nc=0
+    total_pc=0
+    total_fc=0
+
+    for key in report:
+        total_new+=report[key]['new']
+        total_nc+=report[key]['nc']
+        total_pc+=report[key]['pc']
+        total_fc+=report[key]['fc']
+
+    # Class and method rollups, linked to their first line
+    classes = []
+    methods = []
+    for (key, class_counts) in iter_rollups(report):
+        link = report[key]['link']
+        classes.append((class_counts['class'], link+'#L'+str(class_counts['methods'][0]['line']), class_counts))
+        simple_name = class_counts['class'].split('.')[-1]
+        for method_counts in class_counts['methods']:
+            methods.append((simple_name+'.'+method_counts['method'], link+'#L'+str(method_counts['line']),
+                            method_counts))
+
+    with open(jacoco_html_path+"/"+filename, 'w') as file:
+        file.write(HTML_HEAD)
+        file.write(HTML_TABLE_HEAD)
+        _write_rows(file, [(key, report[key]['link'], report[key]) for key in report], HTML_ROW)
+
+        file.write('<tfoot><tr><td>'+' Total'+'</td><td>'+str(total_new)+\
+        '</td><td class="bar"><img  src=".resources/greenbar.gif" width="'+str(float(total_fc+total_pc)/float(total_new)*100 if total_new else 0)+\
+        '" height="10" title="'+str(total_fc+total_pc)+'" alt="'+str(total_fc+total_pc)+\
+        '"/><img src=".resources/redbar.gif" width="'+str(float(total_nc)/float(total_new)*100 if total_new else 0)+\
+        '" height="10" title="'+str(total_nc)+'" alt="'+str(total_nc)+'"/>'\
+        '</td><td class="ctr2">'+_percent((total_fc+total_pc)/float(total_new) if total_new else 0)+\
+        '</td><td class="ctr1">'+str(total_nc)+'</td><td class="ctr2">'+_percent(total_nc/float(total_new) if total_new else 0)+\
+        '</td><td class="ctr1">'+str(total_pc)+'</td><td class="ctr2">'+_percent(total_pc/float(total_new) if total_new else 0)+\
+        '</td><td class="ctr1">'+str(total_fc)+'</td><td class="ctr2">'+_percent(total_fc/float(total_new) if total_new else 0)+\
+        '</td></tr></tfoot></table>')
+
+        if classes:
+            for (title, table_id, column, element, entries) in (
+                    ('Classes', 'classtable', 'Class Name', 'el_class', classes),
+                    ('Methods', 'methodtable', 'Method Name', 'el_method', methods)):
+                file.write(_rollup_html(ROLLUP_TABLE_HEAD, table_id).format(
+                    title=title, table_id=table_id, column=column))
+                _write_rows(file, entries, _rollup_html(ROLLUP_ROW, table_id).replace('{element}', element))
+                file.write('</table>')
+        file.write(HTML_FOOT)
+
+    return new_code_coverage(report)
+
+def _write_rows(file, entries, row_html):
+    """
+    Write a table row with `row_html` for each `(NAME, LINK, COUNTS)`
+    entry.  The ten sortable column values (a..j) of every row and the
+    sort ranks of every column are computed up front.
+    """
+    rows = []
+    for (name, _, counts) in entries:
+        new=counts['new']
+        nc=counts['nc']
+        pc=counts['pc']
+        fc=counts['fc']
+        rows.append((name, new, new-nc, (new-nc)/float(new) if new else 0, nc, nc/float(new) if new else 0,
+                     pc, pc/float(new) if new else 0, fc, fc/float(new) if new else 0))
+
+    column_ranks = [_ranks([row[column] for row in rows]) for column in range(10)]
+
+    for (row, (_, link, _)) in zip(rows, entries):
+        key, new, covered, covered_ratio, nc, nc_ratio, pc, pc_ratio, fc, fc_ratio = row
+        file.write(row_html.format(
+            ranks=[column_ranks[column][value] for (column, value) in enumerate(row)],
+            link=link, key=key, new=new, covered=covered, nc=nc, pc=pc, fc=fc,
+            green=str((fc+pc)/float(new)*100 if new else 0),
+            red=str(nc/float(new)*100 if new else 0),
+            covered_percent=_percent(covered_ratio), nc_percent=_percent(nc_ratio),
+            pc_percent=_percent(pc_ratio), fc_percent=_percent(fc_ratio)))
+
+def toHtml(report, jacoco_html_path):
+    html='<html><body><table>'
+    table='<tr><th>file name</th><th>new lines</th><th>no covered</th><th>partical covered</th><th>full covered</th><th>link</th></tr>'
     total_new=0
     total_nc=0
     total_pc=0
@@ -551,26 +4040,482 @@ def toHtml(report, jacoco_html_path):
         file.write(html)
     return total_coverage
     
+class _CoverageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answer `POST` requests carrying a `git diff` in their body with the
+    JSON result of `CoverageServer.evaluate`, or `{'error': MESSAGE}`:
+    400 for an invalid diff, 503 while the report is being regenerated
+    and 500 for anything else.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        diff_str = self.rfile.read(length).decode('utf-8', 'replace')
+
+        retry_after = None
+        try:
+            result = self.server.evaluate(diff_str)
+            status = 200
+        except GitDiffError as err:
+            result = {'error': str(err)}
+            status = 400
+        except OSError as err:
+            # Pages went missing, the report is being regenerated
+            result = {'error': 'Report is being regenerated: {0}'.format(err)}
+            status = 503
+            retry_after = '5'
+        except Exception as err:
+            result = {'error': '{0}: {1}'.format(type(err).__name__, err)}
+            status = 500
+
+        body = json.dumps(result, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', retry_after)
+        self.end_headers()
+        self.wfile.write(body)
+
+class CoverageServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server answering new-code coverage queries against
+    JaCoCo HTML reports kept warm in memory.
+
+    The report directories are scanned once and page indexes stay in
+    a `MemoryIndexCache` bounded by `max_bytes`.  Before each query,
+    regenerated report directories are scanned again and pages that
+    changed are parsed again.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, jacoco_html_paths, port, host='127.0.0.1', max_bytes=512 * 1024 * 1024, cache=None, shards=False):
+        HTTPServer.__init__(self, (host, port), _CoverageRequestHandler)
+        self.report_index = ReportIndex(jacoco_html_paths, shards)
+        self.cache = MemoryIndexCache(cache, max_bytes)
+        self._refresh_lock = threading.Lock()
+
+    def evaluate(self, diff_str):
+        """
+        Return `{'coverage': TOTAL_COVERAGE, 'files': REPORT}` for the
+        `git diff` output `diff_str`.
+        """
+        self._refresh()
+        try:
+            cc_report=self._evaluate(diff_str)
+        except OSError:
+            # A page is gone although the report looks unchanged (e.g. it
+            # is being regenerated): scan everything again and retry once
+            self._refresh(force=True)
+            cc_report=self._evaluate(diff_str)
+        return {'coverage': new_code_coverage(cc_report), 'files': cc_report}
+
+    def _refresh(self, force=False):
+        with self._refresh_lock:
+            for root in self.report_index.refresh(force):
+                print("Reloaded->"+root)
+
+    def _evaluate(self, diff_str):
+        gdr=GitDiffReporter(diff_lines=diff_str.splitlines())
+        return report(gdr.iter_lines_changed(), self.report_index, 1, self.cache)
+
+def query_coverage_server(gitdiff_file, port, host='127.0.0.1'):
+    """
+    Send a diff file to a running `CoverageServer` and return its answer,
+    which is `{'error': MESSAGE}` if the server could not evaluate it.
+    """
+    with open(gitdiff_file, 'rb') as diff_file:
+        data = diff_file.read()
+    url = 'http://{0}:{1}/'.format(host, port)
+    try:
+        response = urlopen(url, data)
+    except HTTPError as err:
+        response = err
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+def _split_report_paths(jacoco_html_path):
+    """
+    Return the list of report paths given as `jacoco_html_path` (one
+    path or several), and the directory the new-code report goes to.
+    """
+    if isinstance(jacoco_html_path, str):
+        jacoco_html_paths=[jacoco_html_path]
+    else:
+        jacoco_html_paths=list(jacoco_html_path)
+
+    output_path=jacoco_html_paths[0]
+    if os.path.isfile(output_path):
+        # A jacoco.xml was given, write the report next to it
+        output_path=os.path.dirname(os.path.abspath(output_path))
+    return jacoco_html_paths, output_path
+
+def _result_store(incremental, jacoco_html_paths):
+    """
+    Return the `ResultStore` of `incremental`, if given.  Only the
+    results of HTML report directories are stored.
+
+    Raises a ValueError for a jacoco.xml, jacoco.exec or snapshot.
+    """
+    if not incremental:
+        return None
+    if any(os.path.isfile(path) for path in jacoco_html_paths):
+        raise ValueError('--incremental needs JaCoCo HTML report directories')
+    return ResultStore(incremental)
+
+def _diff_reporter(gitdiff_file):
+    """
+    Return a `GitDiffReporter` for a diff file, or `gitdiff_file` itself
+    if it already is one (e.g. running `git diff` itself).
+    """
+    if isinstance(gitdiff_file, GitDiffReporter):
+        return gitdiff_file
+    return GitDiffReporter(gitdiff_file)
+
 """
 main function
 """    
-def jacoco_on_new_code(gitdiff_file='/Users/mli/work/git/test/gitdiff.txt',jacoco_html_path='/Users/mli/work/git/test/target/site/jacoco/'):
-    gdr=GitDiffReporter(gitdiff_file)
-    cc_report=report(gdr._git_diff(), jacoco_html_path)
-    total_coverage=(generateHtml(cc_report,jacoco_html_path))
+def jacoco_on_new_code(gitdiff_file='/Users/mli/work/git/test/gitdiff.txt',jacoco_html_path='/Users/mli/work/git/test/target/site/jacoco/',jobs=1,cache_dir=None,cache_size=256,stale_diff=None,shards=False,incremental=None,classes_dirs=None,prefetch=0):
+    gdr=_diff_reporter(gitdiff_file)
+    cache=IndexCache(cache_dir, cache_size*1024*1024) if cache_dir else None
+    jacoco_html_paths, output_path=_split_report_paths(jacoco_html_path)
+    store=_result_store(incremental, jacoco_html_paths)
+    diff_report, unknown=_changed_lines(gdr, jacoco_html_paths, stale_diff)
+    if ExecutionData.is_exec(jacoco_html_paths[0]):
+        cc_report=report_from_exec(diff_report, jacoco_html_paths, classes_dirs, unknown=unknown)
+    elif _is_xml_report(jacoco_html_paths[0]):
+        cc_report=report_from_xml(diff_report, jacoco_html_paths[0], unknown=unknown)
+    else:
+        cc_report=report(diff_report, jacoco_html_paths, jobs, cache, unknown=unknown, shards=shards, store=store,
+                         prefetch=prefetch)
+    if store is not None:
+        store.save()
+        print("Unchanged files: {0}".format(store.reused))
+    total_coverage=(generateHtml(cc_report,output_path))
     print(total_coverage)
+    if unknown:
+        print("Changed lines without coverage information: {0}".format(sum(unknown.values())))
     return total_coverage
 
+def _changed_lines(gdr, jacoco_html_paths, stale_diff=None):
+    """
+    Return the `(DIFF_REPORT, UNKNOWN)` of `_stale_diff_report` for the
+    diff of `gdr`.  An HTML report without a stale diff gets the changed
+    files as they are read instead (see `iter_lines_changed`), so that
+    its pages are looked up while the diff is still being read.
+    """
+    if stale_diff is None and not ExecutionData.is_exec(jacoco_html_paths[0]) \
+            and not _is_xml_report(jacoco_html_paths[0]):
+        return gdr.iter_lines_changed(), None
+    return _stale_diff_report(gdr._git_diff(), stale_diff)
+
+def _stale_diff_report(diff_report, stale_diff=None):
+    """
+    Return `(DIFF_REPORT, UNKNOWN)`: `diff_report` moved onto the sources
+    of a stale report with the diff file `stale_diff` (see
+    `StaleReportMap`), or unchanged with `UNKNOWN` None without one.
+    """
+    if stale_diff is None:
+        return diff_report, None
+    return StaleReportMap(stale_diff).translate(diff_report)
+
+def coverage_summary(report, gate=None, stale=False):
+    """
+    Return a compact summary of `report`: the new-code coverage, line
+    counts and, with a `CoverageGate`, the threshold and its outcome.
+    Reports with class and method rollups also get them, each with its
+    own coverage.
+
+    The lines of unknown coverage are given whenever the report is
+    `stale` (or has some), and with a gate `unknown_policy` tells how
+    they were taken: `worst_case` (see `CoverageGate`), which leaves
+    `passed` null when they decide the outcome.
+    """
+    summary={
+        'coverage': new_code_coverage(report),
+        'files': len(report),
+    }
+    for name in ('new', 'nc', 'pc', 'fc'):
+        summary[name]=sum(report[key][name] for key in report)
+    if stale or any('unknown' in report[key] for key in report):
+        summary['unknown']=sum(report[key].get('unknown', 0) for key in report)
+    if any('classes' in report[key] for key in report):
+        summary['classes']=[]
+        for (_, class_counts) in iter_rollups(report):
+            rollup=dict(class_counts, coverage=_coverage_percent(class_counts['new'], class_counts['nc']))
+            rollup['methods']=[dict(method_counts, coverage=_coverage_percent(method_counts['new'], method_counts['nc']))
+                               for method_counts in class_counts['methods']]
+            summary['classes'].append(rollup)
+
+    if gate is not None:
+        summary['min_coverage']=gate.min_coverage
+        summary['passed']=gate.decided()
+        summary['complete']=not gate.stopped_early
+        if 'unknown' in summary:
+            summary['unknown_policy']='worst_case'
+
+    return summary
+
+def jacoco_on_new_code_summary(gitdiff_file, jacoco_html_path, min_coverage=None, early_exit=False, jobs=1, cache_dir=None, cache_size=256, stale_diff=None, shards=False, incremental=None, classes_dirs=None, prefetch=0):
+    """
+    Same as `jacoco_on_new_code` without writing the HTML report, and
+    return `coverage_summary` of the result.
+
+    With `min_coverage` (in percent) the summary tells whether it is
+    reached, and with `early_exit` files are only evaluated until the
+    outcome is certain.  With a `stale_diff`, the changed lines of
+    unknown coverage can leave it undecided (see `CoverageGate`).
+    """
+    gdr=_diff_reporter(gitdiff_file)
+    cache=IndexCache(cache_dir, cache_size*1024*1024) if cache_dir else None
+    gate=CoverageGate(min_coverage) if min_coverage is not None else None
+    jacoco_html_paths, output_path=_split_report_paths(jacoco_html_path)
+    store=_result_store(incremental, jacoco_html_paths)
+    diff_report, unknown=_changed_lines(gdr, jacoco_html_paths, stale_diff)
+    if ExecutionData.is_exec(jacoco_html_paths[0]):
+        cc_report=report_from_exec(diff_report, jacoco_html_paths, classes_dirs, gate if early_exit else None, unknown)
+    elif _is_xml_report(jacoco_html_paths[0]):
+        cc_report=report_from_xml(diff_report, jacoco_html_paths[0], gate if early_exit else None, unknown)
+    else:
+        cc_report=report(diff_report, jacoco_html_paths, jobs, cache, gate if early_exit else None, unknown, shards,
+                         store, prefetch)
+    if store is not None:
+        store.save()
+
+    if gate is not None and not early_exit:
+        for key in cc_report:
+            gate.add(cc_report[key])
+    return coverage_summary(cc_report, gate, unknown is not None)
+
+def _batch_diff_files(gitdiff_files):
+    """
+    Return the diff files of a batch, given as a list or a directory.
+    """
+    if isinstance(gitdiff_files, str):
+        return [os.path.join(gitdiff_files, name) for name in sorted(os.listdir(gitdiff_files))
+                if os.path.isfile(os.path.join(gitdiff_files, name))]
+    return list(gitdiff_files)
+
+def jacoco_on_new_code_batch(gitdiff_files, jacoco_html_path, jobs=1, cache_dir=None, cache_size=256, html=False, shards=False,
+                             classes_dirs=None, prefetch=0):
+    """
+    Compute the new-code coverage of many diffs (a list of diff files
+    or a directory of them) against the same JaCoCo report, in one
+    process.
+
+    The report is only read once: pages are indexed the first time a
+    diff needs them and kept in memory for the following diffs, and a
+    `jacoco.xml` is read in a single pass for the files of all diffs.
+
+    Returns a list of `(GITDIFF_FILE, TOTAL_COVERAGE)` tuples.  With
+    `html`, the report of each diff is also written to the report
+    directory as `coverageOnNewCode-<diff file name>.html`.
+
+    Worker processes do not share the in-memory indexes, so `jobs`
+    other than 1 need a `cache_dir` for report directories, or every
+    diff would parse every page again: a ValueError otherwise.
+    """
+    gitdiff_files=_batch_diff_files(gitdiff_files)
+    jacoco_html_paths, output_path=_split_report_paths(jacoco_html_path)
+    if jobs != 1 and not cache_dir and not os.path.isfile(jacoco_html_paths[0]):
+        raise ValueError('--jobs with a directory of diffs needs --cache-dir')
+    cache=IndexCache(cache_dir, cache_size*1024*1024) if cache_dir else None
+
+    if _is_xml_report(jacoco_html_paths[0]):
+        diff_reports=[GitDiffReporter(gitdiff_file)._git_diff() for gitdiff_file in gitdiff_files]
+        src_paths=set()
+        for diff_report in diff_reports:
+            src_paths.update(diff_report.keys())
+        sourcefiles=list(iter_xml_sourcefiles(jacoco_html_paths[0], src_paths))
+
+        def evaluate(diff_report):
+            cc_report={}
+            for (src_path, key, link, index, methods) in sourcefiles:
+                if src_path in diff_report:
+                    counts=count_lines(index, diff_report[src_path])
+                    if methods is not None:
+                        counts['classes']=rollup_lines(index, diff_report[src_path], methods)
+                    counts['link']=link
+                    cc_report[key]=counts
+            return cc_report
+
+        cc_reports=(evaluate(diff_report) for diff_report in diff_reports)
+    elif ExecutionData.is_exec(jacoco_html_paths[0]):
+        execution_data=ExecutionData(jacoco_html_paths)
+        cc_reports=(report_from_exec(GitDiffReporter(gitdiff_file)._git_diff(), execution_data, classes_dirs)
+                    for gitdiff_file in gitdiff_files)
+    elif _snapshot_report(jacoco_html_paths) is not None:
+        snapshot=CoverageSnapshot(jacoco_html_paths[0])
+        cc_reports=(report(GitDiffReporter(gitdiff_file)._git_diff(), snapshot)
+                    for gitdiff_file in gitdiff_files)
+    else:
+        report_index=ReportIndex(jacoco_html_paths, shards)
+        memory=MemoryIndexCache(cache)
+        cc_reports=(report(GitDiffReporter(gitdiff_file).iter_lines_changed(), report_index, jobs, memory, prefetch=prefetch)
+                    for gitdiff_file in gitdiff_files)
+
+    results=[]
+    for (gitdiff_file, cc_report) in zip(gitdiff_files, cc_reports):
+        if html:
+            filename="coverageOnNewCode-"+os.path.basename(gitdiff_file)+".html"
+            coverage=generateHtml(cc_report, output_path, filename)
+        else:
+            coverage=new_code_coverage(cc_report)
+        print(gitdiff_file+": "+coverage)
+        results.append((gitdiff_file, coverage))
+    return results
+
     
 if __name__ == '__main__':
-    arguments = sys.argv
-    if len(arguments) == 3:
-        jacoco_on_new_code(arguments[1],arguments[2])
-    else:
-        print('usage:')
-        print('python '+arguments[0]+' gitdiff_file jacoco_html_path')
-        print('e.g.')
-        print('python '+arguments[0]+' /Users/mli/work/git/test/gitdiff.txt /Users/mli/work/git/test/target/site/jacoco/')
-            
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [options] gitdiff_file jacoco_html_path [jacoco_html_path ...]\n'
+        '       %(prog)s --serve PORT [options] jacoco_html_path [jacoco_html_path ...]\n'
+        '       %(prog)s --compare-branch BRANCH [options] jacoco_html_path [jacoco_html_path ...]\n'
+        '       %(prog)s --connect PORT gitdiff_file\n'
+        '       %(prog)s --export-snapshot FILE [options] jacoco_html_path [jacoco_html_path ...]',
+        description='Report the JaCoCo coverage of the lines changed in a git diff.',
+        epilog='e.g.\n'
+        '  python %(prog)s /Users/mli/work/git/test/gitdiff.txt /Users/mli/work/git/test/target/site/jacoco/\n'
+        '  python %(prog)s /Users/mli/work/git/test/gitdiff.txt /Users/mli/work/git/test/target/site/jacoco/jacoco.xml\n'
+        '  python %(prog)s /Users/mli/work/git/test/gitdiff.txt module-a/target/site/jacoco/ module-b/target/site/jacoco/\n'
+        '  python %(prog)s --serve 8642 /Users/mli/work/git/test/target/site/jacoco/\n'
+        '  python %(prog)s --connect 8642 /Users/mli/work/git/test/gitdiff.txt',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='output of `git diff` (or a directory of them to evaluate as a batch), '
+                        'followed by the JaCoCo HTML report directory (one per module), a jacoco.xml file, '
+                        'a snapshot file or jacoco.exec files (with --classes)')
+    parser.add_argument('--compare-branch', metavar='BRANCH',
+                        help='run `git diff BRANCH...HEAD` instead of reading a gitdiff_file')
+    parser.add_argument('--staged', action='store_true',
+                        help='with --compare-branch, also include staged changes')
+    parser.add_argument('--unstaged', action='store_true',
+                        help='with --compare-branch, also include unstaged changes')
+    parser.add_argument('--repo', metavar='DIR',
+                        help='with --compare-branch, the git repository (default: the current directory)')
+    parser.add_argument('--classes', action='append', metavar='DIR',
+                        help='with jacoco.exec files, a directory of compiled classes such as target/classes '
+                             '(can be given once per module)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes evaluating files (0 means one per CPU)')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help='with a single job, read the next N report pages ahead on threads '
+                             '(for reports on slow storage)')
+    parser.add_argument('--cache-dir',
+                        help='directory caching parsed report pages between runs')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='size limit of the cache directory in MB (default: 256)')
+    parser.add_argument('--html', action='store_true',
+                        help='in batch mode, also write an HTML report for every diff')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='keep the reports loaded and answer diffs POSTed to http://127.0.0.1:PORT/')
+    parser.add_argument('--memory', type=int, default=512,
+                        help='with --serve, memory limit of the loaded pages in MB (default: 512)')
+    parser.add_argument('--connect', type=int, metavar='PORT',
+                        help='send the diff to a server started with --serve')
+    parser.add_argument('--export-snapshot', metavar='FILE',
+                        help='convert the reports into a compact snapshot FILE to use instead of them')
+    parser.add_argument('--summary-only', action='store_true',
+                        help='print a JSON summary instead of writing the HTML report')
+    parser.add_argument('--min-coverage', type=float, metavar='PERCENT',
+                        help='summary only; exit with status 1 if the new-code coverage is below PERCENT')
+    parser.add_argument('--early-exit', action='store_true',
+                        help='with --min-coverage, stop evaluating files once the outcome is certain')
+    parser.add_argument('--shards', action='store_true',
+                        help='the report directories are test shards: merge them line by line')
+    parser.add_argument('--stale-diff', metavar='FILE',
+                        help='diff from the commit the coverage report was built at to the current one, '
+                             'to use a stale report')
+    parser.add_argument('--incremental', metavar='FILE',
+                        help='keep the results of every file in FILE and only evaluate again the files '
+                             'whose changed lines or report page changed since the last run')
+    parser.add_argument('--parser', default='auto', choices=['auto', 'expat', 'etree', 'lxml'],
+                        help='backend reading the report pages (default: the fastest available)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the time and allocations of every stage and file to FILE as JSON')
+    arguments = parser.parse_args()
+    try:
+        set_parser_backend(arguments.parser)
+    except ValueError as err:
+        parser.error(str(err))
+    if arguments.profile:
+        start_profiling()
+    cache = IndexCache(arguments.cache_dir, arguments.cache_size*1024*1024) if arguments.cache_dir else None
+
+    if arguments.serve is not None:
+        if any(os.path.isfile(path) for path in arguments.paths):
+            parser.error('--serve needs JaCoCo HTML report directories')
+        server = CoverageServer(arguments.paths, arguments.serve, max_bytes=arguments.memory*1024*1024, cache=cache,
+                                shards=arguments.shards)
+        print('Serving on http://127.0.0.1:{0}/'.format(arguments.serve))
+        server.serve_forever()
+
+    elif arguments.export_snapshot is not None:
+        if len(arguments.paths) > 1 and any(os.path.isfile(path) for path in arguments.paths):
+            parser.error('only report directories can be given more than once')
+        files = export_snapshot(arguments.paths, arguments.export_snapshot, arguments.shards)
+        print('{0} files written to {1}'.format(files, arguments.export_snapshot))
 
+    elif arguments.connect is not None:
+        if len(arguments.paths) != 1:
+            parser.error('--connect takes a single gitdiff_file')
+        answer = query_coverage_server(arguments.paths[0], arguments.connect)
+        if 'error' in answer:
+            sys.exit(answer['error'])
+        print(answer['coverage'])
 
+    else:
+        if arguments.compare_branch is not None:
+            gitdiff_file = GitDiffReporter(compare_branch=arguments.compare_branch,
+                                           git_diff=GitDiffTool(arguments.repo),
+                                           staged=arguments.staged, unstaged=arguments.unstaged)
+            jacoco_html_paths = arguments.paths
+        elif len(arguments.paths) < 2:
+            parser.error('need a gitdiff_file and at least one jacoco_html_path')
+        else:
+            gitdiff_file, jacoco_html_paths = arguments.paths[0], arguments.paths[1:]
+        is_exec = ExecutionData.is_exec(jacoco_html_paths[0])
+        if is_exec and not arguments.classes:
+            parser.error('jacoco.exec files need --classes')
+        if len(jacoco_html_paths) > 1 and any(os.path.isfile(path) for path in jacoco_html_paths) and \
+                not all(ExecutionData.is_exec(path) for path in jacoco_html_paths):
+            parser.error('only report directories and jacoco.exec files can be given more than once')
+        summary_only = arguments.summary_only or arguments.min_coverage is not None
+        if arguments.early_exit and arguments.min_coverage is None:
+            parser.error('--early-exit needs --min-coverage')
+        is_batch = arguments.compare_branch is None and os.path.isdir(gitdiff_file)
+        if arguments.incremental and (is_batch or any(os.path.isfile(path) for path in jacoco_html_paths)):
+            parser.error('--incremental takes a single gitdiff_file and JaCoCo HTML report directories')
+        if summary_only and is_batch:
+            parser.error('--summary-only and --min-coverage take a single gitdiff_file')
+        if is_batch and arguments.jobs != 1 and not arguments.cache_dir and not os.path.isfile(jacoco_html_paths[0]):
+            parser.error('--jobs with a directory of diffs needs --cache-dir')
+
+        # A failing `git diff` (unknown branch, not a repository) or a
+        # malformed diff file is a usage error, not a crash
+        try:
+            if summary_only:
+                summary = jacoco_on_new_code_summary(gitdiff_file, jacoco_html_paths, arguments.min_coverage,
+                                                     arguments.early_exit, arguments.jobs,
+                                                     arguments.cache_dir, arguments.cache_size, arguments.stale_diff,
+                                                     arguments.shards, arguments.incremental, arguments.classes,
+                                                     arguments.prefetch)
+                print(json.dumps(summary, sort_keys=True))
+            elif is_batch:
+                jacoco_on_new_code_batch(gitdiff_file, jacoco_html_paths, arguments.jobs,
+                                         arguments.cache_dir, arguments.cache_size, arguments.html, arguments.shards,
+                                         arguments.classes, arguments.prefetch)
+            else:
+                jacoco_on_new_code(gitdiff_file, jacoco_html_paths, arguments.jobs,
+                                   arguments.cache_dir, arguments.cache_size, arguments.stale_diff,
+                                   arguments.shards, arguments.incremental, arguments.classes, arguments.prefetch)
+        except GitDiffError as err:
+            sys.exit(str(err))
+        if arguments.profile:
+            PROFILER.write(arguments.profile)
+        # An outcome left open by lines of unknown coverage does not pass
+        if arguments.min_coverage is not None and summary.get('passed') is not True:
+            sys.exit(1)
@@ -0,0 +1,276 @@
+"""
+The class analysis must count the lines of compiler generated code the
+way JaCoCo's filters do.
+
+The class files in `fixtures/classes` are javac builds from the guava,
+antlr and smali jars (see `fixtures/README.md`), and
+`fixtures/jacoco.exec` has the probes of one run of each (see
+`PROBES`).  The expected counters of each line were worked out from the
+bytecode and JaCoCo's filters; no JaCoCo report could be made for them
+here.  The code JaCoCo filters but the analysis does not recognize must
+be counted as unknown, see `ClassBuilder` for the classes testing it.
+"""
+from __future__ import unicode_literals
+import os
+import struct
+import unittest
+
+import coverage_on_new_code as cc
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CLASSES = os.path.join(FIXTURES, 'classes')
+EXEC = os.path.join(FIXTURES, 'jacoco.exec')
+
+# Class -> (number of probes, probes hit)
+PROBES = {
+    'com/google/common/eventbus/Subscriber$SynchronizedSubscriber': (5, [0, 1, 3]),
+    'com/google/common/util/concurrent/MoreExecutors$DirectExecutorService': (46, [2, 4]),
+    'org/antlr/runtime/ANTLRFileStream': (14, [4, 5, 8, 9, 10, 12]),
+    'com/android/tools/smali/dexlib2/dexbacked/ZipDexContainer': (64, [39, 40, 43]),
+    'com/google/common/io/Files': (141, list(range(94, 105)) + list(range(106, 125))),
+}
+
+
+def read_fixture(class_name):
+    with open(os.path.join(CLASSES, class_name + '.class'), 'rb') as class_file:
+        return class_file.read()
+
+
+class ClassBuilder(object):
+    """
+    Write a class file with methods of a single line, for the code that
+    none of the fixtures has.
+    """
+
+    def __init__(self):
+        self._pool = []
+        self._index = dict()
+
+    def _add(self, key, entry):
+        if key not in self._index:
+            self._pool.append(entry)
+            self._index[key] = len(self._pool)
+        return self._index[key]
+
+    def utf8(self, text):
+        encoded = text.encode('utf-8')
+        return self._add(('utf8', text), struct.pack('>BH', 1, len(encoded)) + encoded)
+
+    def klass(self, name):
+        return self._add(('class', name), struct.pack('>BH', 7, self.utf8(name)))
+
+    def member(self, tag, owner, name, descriptor):
+        """
+        Return the index of a field (9), method (10) or invokedynamic
+        (18, of bootstrap method 0) constant.
+        """
+        name_and_type = self._add(('nat', name, descriptor),
+                                  struct.pack('>BHH', 12, self.utf8(name), self.utf8(descriptor)))
+        first = 0 if tag == 18 else self.klass(owner)
+        return self._add((tag, owner, name, descriptor), struct.pack('>BHH', tag, first, name_and_type))
+
+    def build(self, access, name, super_name, methods, annotations=()):
+        """
+        Return the class file of `methods`, `(ACCESS, NAME, DESCRIPTOR,
+        BYTECODE)` tuples whose code is on line 10.
+        """
+        header = struct.pack('>HHH', access, self.klass(name), self.klass(super_name))
+        body = struct.pack('>HH', 0, 0) + struct.pack('>H', len(methods))
+        for (method_access, method_name, descriptor, bytecode) in methods:
+            lines = struct.pack('>HIHHH', self.utf8('LineNumberTable'), 6, 1, 0, 10)
+            code = struct.pack('>HHI', 4, 4, len(bytecode)) + bytecode + struct.pack('>HH', 0, 1) + lines
+            body += struct.pack('>HHHH', method_access, self.utf8(method_name), self.utf8(descriptor), 1)
+            body += struct.pack('>HI', self.utf8('Code'), len(code)) + code
+        if annotations:
+            annotation_types = b''.join(struct.pack('>HH', self.utf8(annotation), 0) for annotation in annotations)
+            body += struct.pack('>HHIH', 1, self.utf8('RuntimeVisibleAnnotations'), 2 + len(annotation_types),
+                                len(annotations)) + annotation_types
+        else:
+            body += struct.pack('>H', 0)
+        pool = b''.join(self._pool)
+        return struct.pack('>IHHH', 0xCAFEBABE, 0, 52, len(self._pool) + 1) + pool + header + body
+
+
+class ClassAnalysisTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.execution_data = cc.ExecutionData(EXEC)
+
+    def assert_lines(self, class_name, expected):
+        """
+        Assert that the `[MI, CI, MB, CB]` counters of the lines in
+        `expected` are the given ones, None for lines without code.
+        """
+        counters = cc.analyze_class(read_fixture(class_name), self.execution_data)
+        self.assertEqual(dict((line_num, counters.get(line_num)) for line_num in expected), expected)
+
+    def test_execution_data(self):
+        for (class_name, (count, hit)) in PROBES.items():
+            with self.subTest(class_name=class_name):
+                probes = self.execution_data.get(cc.class_id(read_fixture(class_name)))
+                self.assertEqual(probes, bytearray(1 if i in hit else 0 for i in range(count)))
+
+    def test_execution_data_merged(self):
+        # Every file is only read for the classes asked for
+        execution_data = cc.ExecutionData([EXEC, EXEC])
+        self.assertEqual(execution_data._probes, {})
+        class_name = 'org/antlr/runtime/ANTLRFileStream'
+        probes = execution_data.get(cc.class_id(read_fixture(class_name)))
+        self.assertEqual(probes, self.execution_data.get(cc.class_id(read_fixture(class_name))))
+        self.assertEqual(list(execution_data._probes.values()), [probes])
+        self.assertIsNone(execution_data.get(0))
+
+    def test_synchronized(self):
+        # synchronized (this) { invokeSubscriberMethod(event); } returning
+        # normally: the handler releasing the monitor is not counted
+        self.assert_lines('com/google/common/eventbus/Subscriber$SynchronizedSubscriber', {
+            141: [0, 4, 0, 0],
+            142: [0, 3, 0, 0],
+            143: [0, 3, 0, 0],
+            144: [0, 1, 0, 0],
+        })
+
+    def test_finally_thrown(self):
+        # try { command.run(); } finally { endTask(); } with run() throwing:
+        # the copy of the handler covers the finally block
+        self.assert_lines('com/google/common/util/concurrent/MoreExecutors$DirectExecutorService', {
+            260: [0, 2, 0, 0],
+            262: [2, 0, 0, 0],
+            264: [0, 2, 0, 0],
+            265: None,
+            266: [1, 0, 0, 0],
+        })
+
+    def test_finally_returning(self):
+        # The copy after the try block covers it, and the jump over the
+        # handler is not counted
+        self.assert_lines('org/antlr/runtime/ANTLRFileStream', {
+            60: [0, 2, 1, 1],
+            64: [0, 5, 0, 0],
+            67: [0, 4, 0, 0],
+            68: [0, 6, 0, 0],
+            71: [0, 2, 0, 0],
+            72: None,
+            73: [0, 1, 0, 0],
+        })
+
+    def test_try_with_resources(self):
+        # try (ZipFile zipFile = getZipFile()) { return true; } closing the
+        # file: neither the close nor its Throwable handler are counted
+        self.assert_lines('com/android/tools/smali/dexlib2/dexbacked/ZipDexContainer', {
+            151: [0, 3, 0, 0],
+            152: [0, 4, 0, 0],
+            153: [1, 0, 0, 0],
+            154: [2, 0, 0, 0],
+        })
+
+    def test_string_switch(self):
+        # switch (component) { case ".": ... case "..": ... default: ... }
+        # never reaching ".": only the second switch has branches
+        self.assert_lines('com/google/common/io/Files', {
+            756: [0, 8, 1, 2],
+            758: [1, 0, 0, 0],
+            760: [0, 13, 0, 4],
+            767: [0, 4, 0, 0],
+        })
+
+    def test_report_from_exec(self):
+        diff_report = {'src/main/java/com/google/common/io/Files.java': [756, 757, 758]}
+        report = cc.report_from_exec(diff_report, EXEC, CLASSES)
+        counts = report['com.google.common.ioFiles.java']
+        self.assertEqual((counts['new'], counts['fc'], counts['pc'], counts['nc']), (2, 0, 1, 1))
+        self.assertEqual((counts['mi'], counts['ci'], counts['mb'], counts['cb']), (1, 8, 1, 2))
+        self.assertNotIn('unknown', counts)
+
+    def test_annotations(self):
+        _, _, _, _, _, annotations = cc.read_class(
+            read_fixture('com/google/common/util/concurrent/MoreExecutors$DirectExecutorService'))
+        self.assertEqual(annotations, ['Lcom/google/common/annotations/GwtIncompatible;'])
+
+    def test_generated(self):
+        code = (b'\xb1', [], [(0, 10)], {})
+        self.assertFalse(cc._ignored_method(0, 'java/lang/Object', 0, 'run', '()V', code, ['Ljava/lang/Deprecated;']))
+        self.assertTrue(cc._ignored_method(0, 'java/lang/Object', 0, 'run', '()V', code, ['Llombok/Generated;']))
+        self.assertTrue(cc._ignored_method(0, 'java/lang/Object', 0, 'run', '()V', code,
+                                           ['Lorg/immutables/value/Generated;']))
+
+    def analyze(self, data):
+        """
+        Return the counters and the unknown lines of class `data`, run
+        without probes.
+        """
+        unknown = set()
+        counters = cc.analyze_class(data, self.execution_data, None, None, unknown)
+        return counters, unknown
+
+    def test_enum_constructor(self):
+        builder = ClassBuilder()
+        constructor = builder.member(10, 'java/lang/Enum', '<init>', '(Ljava/lang/String;I)V')
+        empty = b'\x2a\x2b\x1c\xb7' + struct.pack('>H', constructor) + b'\xb1'
+        data = builder.build(cc.ACC_ENUM, 'Color', 'java/lang/Enum', [
+            (cc.ACC_PRIVATE, '<init>', '(Ljava/lang/String;I)V', empty),
+        ])
+        self.assertEqual(self.analyze(data), ({}, set()))
+
+        # Doing more, or with more arguments
+        data = builder.build(cc.ACC_ENUM, 'Color', 'java/lang/Enum', [
+            (cc.ACC_PRIVATE, '<init>', '(Ljava/lang/String;I)V', empty[:-1] + b'\x00\xb1'),
+        ])
+        self.assertEqual(self.analyze(data), ({10: [6, 0, 0, 0]}, set()))
+        data = builder.build(cc.ACC_ENUM, 'Color', 'java/lang/Enum', [
+            (cc.ACC_PRIVATE, '<init>', '(Ljava/lang/String;II)V', empty),
+        ])
+        self.assertEqual(self.analyze(data), ({10: [5, 0, 0, 0]}, set()))
+
+    def test_record_methods(self):
+        builder = ClassBuilder()
+        object_methods = struct.pack('>H', builder.member(18, None, 'toString', '(LPoint;)Ljava/lang/String;'))
+        field = struct.pack('>H', builder.member(9, 'Point', 'x', 'I'))
+        methods = [
+            (1, 'toString', '()Ljava/lang/String;', b'\x2a\xba' + object_methods + b'\x00\x00\xb0'),
+            (1, 'hashCode', '()I', b'\x2a\xba' + object_methods + b'\x00\x00\xac'),
+            (1, 'equals', '(Ljava/lang/Object;)Z', b'\x2a\x2b\xba' + object_methods + b'\x00\x00\xac'),
+        ]
+        self.assertEqual(self.analyze(builder.build(0, 'Point', 'java/lang/Record', methods)), ({}, set()))
+
+        # Written in the record, or generated in a class that is not one
+        written = [(1, 'hashCode', '()I', b'\x2a\xb4' + field + b'\xac')]
+        self.assertEqual(self.analyze(builder.build(0, 'Point', 'java/lang/Record', written)),
+                         ({10: [3, 0, 0, 0]}, set()))
+        self.assertEqual(self.analyze(builder.build(0, 'Point', 'java/lang/Object', methods)),
+                         ({10: [10, 0, 0, 0]}, set()))
+
+    def test_unknown_code(self):
+        builder = ClassBuilder()
+        assertions = struct.pack('>H', builder.member(9, 'Foo', '$assertionsDisabled', 'Z'))
+        match_exception = struct.pack('>H', builder.member(10, 'java/lang/MatchException', '<init>',
+                                                           '(Ljava/lang/String;Ljava/lang/Throwable;)V'))
+        # getstatic $assertionsDisabled, pop, return
+        data = builder.build(0, 'Foo', 'java/lang/Object', [(1, 'run', '()V', b'\xb2' + assertions + b'\x57\xb1')])
+        self.assertEqual(self.analyze(data), ({}, set([10])))
+        # aconst_null, aconst_null, invokespecial MatchException(message, cause), return
+        data = builder.build(0, 'Foo', 'java/lang/Object',
+                             [(1, 'run', '()V', b'\x01\x01\xb7' + match_exception + b'\xb1')])
+        self.assertEqual(self.analyze(data), ({}, set([10])))
+
+    def test_kotlin(self):
+        data = ClassBuilder().build(0, 'FooKt', 'java/lang/Object', [(1, 'run', '()V', b'\xb1')],
+                                    ['Lkotlin/Metadata;'])
+        self.assertEqual(self.analyze(data), ({}, set([10])))
+        self.assertEqual(cc.analyze_class(data, self.execution_data), {10: [1, 0, 0, 0]})
+
+    def test_unrecognized(self):
+        # A try-with-resources as javac 9 and 10 compile it
+        bytecode = b'\x2a\x2b' + struct.pack('>BH', 184, 2) + b'\xb1'
+        method_refs = {2: ('Foo', '$closeResource', '(Ljava/lang/Throwable;Ljava/lang/AutoCloseable;)V')}
+        code = (bytecode, [], [(0, 10)], method_refs)
+        instructions, _ = cc.analyze_method(code, None, 0)
+        self.assertEqual(cc.filter_method(code, instructions), (instructions, False))
+
+        code = (bytecode, [], [(0, 10)], {2: ('Foo', 'close', '(Ljava/lang/Throwable;Ljava/lang/AutoCloseable;)V')})
+        self.assertEqual(cc.filter_method(code, instructions), (instructions, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Deciding the new-code coverage gate early with `CoverageGate`.
+"""
+from __future__ import unicode_literals
+import itertools
+import unittest
+
+import coverage_on_new_code as cc
+
+
+def gate(min_coverage, new=0, nc=0, unknown=0, remaining=0):
+    result = cc.CoverageGate(min_coverage)
+    result.expect(remaining)
+    result.add({'new': new, 'nc': nc, 'unknown': unknown})
+    return result
+
+
+def outcomes(result):
+    """
+    Return the set of outcomes the gate can still end with, going
+    through every way the open lines can turn out.
+    """
+    covered = result.new - result.nc
+    open_lines = result.remaining + result.unknown
+    passed = set()
+    for executable in range(open_lines + 1):
+        for newly_covered in range(executable + 1):
+            total = result.new + executable
+            passed.add(total == 0 or (covered + newly_covered) * 100 >= result.min_coverage * total)
+    return passed
+
+
+class CoverageGateTest(unittest.TestCase):
+
+    def test_pass(self):
+        self.assertIs(gate(80, new=10, nc=2).decided(), True)
+        # Even if the 2 lines left are not covered
+        self.assertIs(gate(80, new=10, nc=0, remaining=2).decided(), True)
+
+    def test_fail(self):
+        self.assertIs(gate(80, new=10, nc=3).decided(), False)
+        # Even if the 2 lines left are covered
+        self.assertIs(gate(80, new=10, nc=5, remaining=2).decided(), False)
+
+    def test_undecided(self):
+        self.assertIsNone(gate(80, new=10, nc=2, remaining=2).decided())
+
+    def test_no_new_lines(self):
+        # No executable changed lines are reported as 100%
+        self.assertIs(gate(80).decided(), True)
+        self.assertIsNone(gate(80, remaining=3).decided())
+
+    def test_unknown(self):
+        # Unknown lines are open, like lines left to evaluate, but
+        # stay open once nothing is left
+        self.assertIsNone(gate(80, new=10, nc=2, unknown=2).decided())
+        self.assertIs(gate(80, new=10, nc=0, unknown=2).decided(), True)
+        self.assertIs(gate(80, new=10, nc=5, unknown=2).decided(), False)
+
+    def test_remaining_reaches_zero(self):
+        result = gate(80, remaining=10)
+        self.assertFalse(result.add({'new': 4, 'nc': 1}, 4))
+        self.assertIsNone(result.decided())
+        self.assertFalse(result.add({'new': 6, 'nc': 1}, 6))
+        self.assertEqual(result.remaining, 0)
+        self.assertIs(result.decided(), True)
+
+    def test_add_stops_early(self):
+        result = gate(50, remaining=10)
+        self.assertTrue(result.add({'new': 6, 'nc': 0}, 6))
+        self.assertIs(result.decided(), True)
+
+        result = gate(50, remaining=10)
+        self.assertTrue(result.add({'new': 8, 'nc': 7}, 8))
+        self.assertIs(result.decided(), False)
+
+    def test_exhaustive(self):
+        for (min_coverage, new, remaining, unknown) in itertools.product((0, 50, 80, 100), range(5), range(4),
+                                                                         range(3)):
+            for nc in range(new + 1):
+                result = gate(min_coverage, new, nc, unknown, remaining)
+                passed = outcomes(result)
+                expected = passed.pop() if len(passed) == 1 else None
+                self.assertIs(result.decided(), expected, (min_coverage, new, nc, remaining, unknown))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Sets of changed line numbers stored as ranges with `LineRanges`.
+"""
+from __future__ import unicode_literals
+import random
+import unittest
+
+import coverage_on_new_code as cc
+
+
+def random_lines(rand):
+    return set(rand.randrange(1, 40) for _ in range(rand.randrange(25)))
+
+
+class LineRangesTest(unittest.TestCase):
+
+    def test_add_range(self):
+        lines = cc.LineRanges()
+        lines.add_range(10, 12)
+        lines.add_range(20, 20)
+        # Touching the last range extends it
+        lines.add_range(21, 22)
+        self.assertEqual(lines.ranges(), [(10, 12), (20, 22)])
+
+        # Before, between and across existing ranges
+        lines.add_range(1, 2)
+        lines.add_range(14, 15)
+        self.assertEqual(lines.ranges(), [(1, 2), (10, 12), (14, 15), (20, 22)])
+        lines.add_range(13, 13)
+        self.assertEqual(lines.ranges(), [(1, 2), (10, 15), (20, 22)])
+        lines.add_range(3, 19)
+        self.assertEqual(lines.ranges(), [(1, 22)])
+
+        # Inside an existing range
+        lines.add_range(5, 6)
+        self.assertEqual(lines.ranges(), [(1, 22)])
+
+    def test_subtract(self):
+        lines = cc.LineRanges([(1, 10), (20, 30)])
+        removed = cc.LineRanges([(0, 1), (5, 6), (10, 21), (30, 40)])
+        self.assertEqual(lines.subtract(removed).ranges(), [(2, 4), (7, 9), (22, 29)])
+        self.assertEqual(lines.subtract(cc.LineRanges()), lines)
+        self.assertFalse(lines.subtract(lines))
+
+    def test_union(self):
+        lines = cc.LineRanges([(1, 3), (10, 12)])
+        other = cc.LineRanges([(4, 5), (11, 20), (30, 30)])
+        self.assertEqual(lines.union(other).ranges(), [(1, 5), (10, 20), (30, 30)])
+        self.assertEqual(lines.union(cc.LineRanges()), lines)
+
+    def test_last(self):
+        self.assertIsNone(cc.LineRanges().last())
+        self.assertEqual(cc.LineRanges([(7, 9), (1, 2)]).last(), 9)
+
+    def test_random_sets(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            first, second = random_lines(rand), random_lines(rand)
+            lines = cc.LineRanges()
+            for line in rand.sample(sorted(first), len(first)):
+                lines.add(line)
+            other = cc.LineRanges.from_lines(second)
+
+            self.assertEqual(list(lines), sorted(first))
+            self.assertEqual(len(lines), len(first))
+            self.assertEqual(lines.last(), max(first) if first else None)
+            for line in range(42):
+                self.assertEqual(line in lines, line in first)
+            self.assertEqual(list(lines.union(other)), sorted(first | second))
+            self.assertEqual(list(lines.subtract(other)), sorted(first - second))
+
+            # Ranges never overlap nor touch
+            ranges = lines.ranges()
+            for ((_, end), (start, _)) in zip(ranges, ranges[1:]):
+                self.assertGreater(start, end + 1)
+
+    def test_random_ranges(self):
+        rand = random.Random(1)
+        for _ in range(500):
+            lines = cc.LineRanges()
+            expected = set()
+            for _ in range(rand.randrange(8)):
+                start = rand.randrange(1, 40)
+                end = start + rand.randrange(6)
+                lines.add_range(start, end)
+                expected.update(range(start, end + 1))
+            self.assertEqual(list(lines), sorted(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
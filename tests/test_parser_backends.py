@@ -0,0 +1,215 @@
+"""
+Every available parser backend must read a report page the same way.
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import coverage_on_new_code as cc
+
+PAGE_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd"><html xmlns="http://www.w3.org/1999/xhtml" lang="en">'
+    '<head><meta http-equiv="Content-Type" content="text/html;charset=UTF-8"/><title>Foo.java</title></head>'
+    '<body><div class="breadcrumb" id="breadcrumb"><a href="../index.html" class="el_report">demo</a></div>'
+    '<h1>Foo.java</h1><pre class="source lang-java linenums">'
+)
+PAGE_TAIL = '</pre></body></html>'
+
+
+def page_lines(count, first=1):
+    """
+    Return `count` source lines as JaCoCo writes them, from line `first`.
+    """
+    spans = []
+    for line_num in range(first, first + count):
+        if line_num % 3 == 0:
+            spans.append('<span class="pc bpc" id="L{0}" title="1 of 2 branches missed.">'
+                         'if (a &lt; b &amp;&amp; c)</span>\n'.format(line_num))
+        else:
+            spans.append('<span class="fc" id="L{0}">x = &quot;y&quot;;</span>\n'.format(line_num))
+    return ''.join(spans)
+
+
+def line_entries(count, first=1):
+    """
+    Return the entries of the lines of `page_lines`.
+    """
+    return [(line_num, ('pc', '1 of 2 branches missed.') if line_num % 3 == 0 else ('fc', None))
+            for line_num in range(first, first + count)]
+
+
+class ParserBackendsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        cc.set_parser_backend()
+
+    def _page(self, content):
+        path = os.path.join(self.tmp_dir, 'Foo.java.html')
+        with open(path, 'wb') as page:
+            page.write(content.encode('utf-8'))
+        return path
+
+    def _read(self, backend, path, max_line=None):
+        """
+        Return the entries read by `backend` and whether it then
+        raised an `ET.ParseError`.
+        """
+        entries = []
+        try:
+            for entry in cc.PARSER_BACKENDS[backend](path, max_line):
+                entries.append(entry)
+        except ET.ParseError:
+            return entries, True
+        return entries, False
+
+    def assert_read(self, content, expected, malformed=False, max_line=None):
+        """
+        Assert that every backend reads the `expected` entries from a
+        page of `content`, then raises if it is `malformed`.
+        """
+        path = self._page(content)
+        for backend in cc.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(self._read(backend, path, max_line), (expected, malformed))
+
+    def test_backends(self):
+        self.assertIn('expat', cc.PARSER_BACKENDS)
+        self.assertIn('etree', cc.PARSER_BACKENDS)
+        self.assertEqual('lxml' in cc.PARSER_BACKENDS, cc.lxml_etree is not None)
+
+    def test_page(self):
+        self.assert_read(PAGE_HEAD + page_lines(30) + PAGE_TAIL, line_entries(30))
+
+    def test_lines_without_coverage(self):
+        content = (PAGE_HEAD + '<span class="fc" id="L1">a</span>\nline 2\n\n'
+                   + '<span class="nc bnc" id="L4" title="All 2 branches missed.">b</span>\n' + PAGE_TAIL)
+        self.assert_read(content, [(1, ('fc', None)), (4, ('nc', 'All 2 branches missed.'))])
+
+    def test_entities(self):
+        content = (PAGE_HEAD
+                   + '<span class="pc bpc" id="L1" title="&lt;1&gt; of 2 &amp; &quot;b&quot; &apos;c&apos;">'
+                   + '&lt;T&gt; &amp;</span>\n'
+                   + '<span class="fc" id="L2" title="&#233;&#xE9; &#x263A;">&#39;c&#39;</span>\n'
+                   + '<span class="nc" id="L3">été</span>\n' + PAGE_TAIL)
+        self.assert_read(content, [
+            (1, ('pc', '<1> of 2 & "b" \'c\'')),
+            (2, ('fc', 'éé ☺')),
+            (3, ('nc', None)),
+        ])
+
+    def test_xhtml_entities(self):
+        # Declared by the XHTML DTD, which is not read
+        content = (PAGE_HEAD + '<span class="fc" id="L1" title="a&nbsp;b&copy;">x&nbsp;=&nbsp;1;</span>\n'
+                   + '<span class="nc" id="L2">&copy;</span>\n' + PAGE_TAIL)
+        self.assert_read(content, [(1, ('fc', 'ab')), (2, ('nc', None))])
+
+    def test_undeclared_entity_in_text(self):
+        path = self._page(PAGE_HEAD + '<span class="fc" id="L1">&foo;</span>\n' + PAGE_TAIL)
+        for backend in cc.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(self._read(backend, path), ([(1, ('fc', None))], backend == 'etree'))
+
+    def test_spans_not_lines(self):
+        content = (PAGE_HEAD + '<span class="fc" id="L1">a</span>\n'
+                   + '<span class="keyword">int</span><span id="X2" class="fc">b</span>'
+                   + '<span class="fc" id="L">c</span><span class="fc" id="L3x">d</span>\n'
+                   + '<span id="L4">e</span>\n<span class="" id="L5">f</span>\n' + PAGE_TAIL)
+        self.assert_read(content, [(1, ('fc', None)), (4, (None, None)), (5, (None, None))])
+
+    def test_nested_spans(self):
+        # In the order of the start tags, the outer span first
+        content = (PAGE_HEAD + '<span class="fc" id="L1"><span class="keyword">int</span> '
+                   + '<span class="nc" id="L9">x</span></span>\n'
+                   + '<span class="pc" id="L2"><span><span class="fc" id="L3">y</span></span></span>\n'
+                   + PAGE_TAIL)
+        self.assert_read(content, [(1, ('fc', None)), (9, ('nc', None)), (2, ('pc', None)), (3, ('fc', None))])
+
+    def test_nested_spans_max_line(self):
+        # The inner span is after `max_line` but comes after the outer one
+        content = (PAGE_HEAD + '<span class="fc" id="L1"><span class="nc" id="L9">x</span></span>\n'
+                   + '<span class="pc" id="L2">y</span>\n' + PAGE_TAIL)
+        self.assert_read(content, [(1, ('fc', None))], max_line=1)
+
+    def test_max_line(self):
+        content = PAGE_HEAD + page_lines(30) + PAGE_TAIL
+        for max_line in (0, 1, 2, 15, 29, 30, 31, 1000):
+            with self.subTest(max_line=max_line):
+                self.assert_read(content, line_entries(min(max_line, 30)), max_line=max_line)
+
+    def test_max_line_stops_reading(self):
+        # Reading stops before the malformed end of the page
+        content = PAGE_HEAD + page_lines(20) + '<span class="nc" id="L21">a</div>'
+        self.assert_read(content, line_entries(10), max_line=10)
+        self.assert_read(content, line_entries(20), max_line=20)
+        self.assert_read(content, line_entries(20) + [(21, ('nc', None))], max_line=21, malformed=True)
+
+    def test_max_line_large_page(self):
+        # Stops in the first of several chunks of the page
+        content = PAGE_HEAD + page_lines(20000) + PAGE_TAIL
+        self.assertGreater(len(content), 4 * cc.EXPAT_CHUNK_SIZE)
+        self.assert_read(content, line_entries(100), max_line=100)
+        self.assert_read(content, line_entries(20000))
+
+    def test_truncated_page(self):
+        content = PAGE_HEAD + page_lines(20) + PAGE_TAIL
+        cut = content.index('<span class="fc" id="L8"')
+        self.assert_read(content[:cut], line_entries(7), malformed=True)
+        self.assert_read(content[:cut + len('<span class="fc" id="L8"')], line_entries(7), malformed=True)
+        self.assert_read(content[:cut + len('<span class="fc" id="L8">')], line_entries(8), malformed=True)
+        self.assert_read(content[:-len('</html>')], line_entries(20), malformed=True)
+
+    def test_truncated_large_page(self):
+        # The entries before the end are read, whatever the chunks
+        content = PAGE_HEAD + page_lines(20000) + PAGE_TAIL
+        cut = content.index('<span class="fc" id="L13334"')
+        self.assertGreater(cut, 4 * cc.EXPAT_CHUNK_SIZE)
+        self.assert_read(content[:cut], line_entries(13333), malformed=True)
+
+    def test_malformed_page(self):
+        lines = PAGE_HEAD + page_lines(2)
+        # The start tag of line 3 is read before the error
+        for content in (
+            lines + '<span class="nc" id="L3">a</div>' + PAGE_TAIL,
+            lines + '<span class="nc" id="L3">a &amp b</span>' + PAGE_TAIL,
+        ):
+            with self.subTest(content=content[len(lines):]):
+                self.assert_read(content, line_entries(2) + [(3, ('nc', None))], malformed=True)
+        # The start tag of line 3 is the error
+        for content in (
+            lines + '<span class="nc" id="L3" title="a < b">a</span>' + PAGE_TAIL,
+            lines + '<span class="nc" id="L3" id="L4">a</span>' + PAGE_TAIL,
+        ):
+            with self.subTest(content=content[len(lines):]):
+                self.assert_read(content, line_entries(2), malformed=True)
+
+    def test_content_after_page(self):
+        self.assert_read(PAGE_HEAD + page_lines(2) + PAGE_TAIL + '<html/>', line_entries(2), malformed=True)
+
+    def test_empty_page(self):
+        self.assert_read('', [], malformed=True)
+        self.assert_read(PAGE_HEAD[:100], [], malformed=True)
+
+    def test_index_source_page(self):
+        path = self._page(PAGE_HEAD + page_lines(30) + PAGE_TAIL)
+        for backend in cc.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                cc.set_parser_backend(backend)
+                self.assertEqual(cc.index_source_page(path), dict(line_entries(30)))
+                self.assertEqual(cc.index_source_page(path, 5), dict(line_entries(5)))
+
+    def test_set_parser_backend(self):
+        cc.set_parser_backend('auto')
+        self.assertEqual(cc._parser_backend, next(iter(cc.PARSER_BACKENDS)))
+        self.assertRaises(ValueError, cc.set_parser_backend, 'sax')
+
+
+if __name__ == '__main__':
+    unittest.main()
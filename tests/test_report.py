@@ -0,0 +1,123 @@
+"""
+Evaluating a diff against a JaCoCo HTML report with `report`.
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+import coverage_on_new_code as cc
+
+PAGE_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?><html xmlns="http://www.w3.org/1999/xhtml" lang="en">'
+    '<head><title>{0}</title></head><body><pre class="source lang-java linenums">'
+)
+PAGE_TAIL = '</pre></body></html>'
+
+# Status of the lines of every page, from line 1
+PAGE_LINES = ['fc', 'fc', 'nc', None, 'pc', 'fc', 'nc', 'fc']
+
+FILES = 15
+
+
+def write_report(root, files=FILES):
+    """
+    Write a JaCoCo HTML report of `files` classes `com.foo.BarN` and
+    return the diff of all their lines.
+    """
+    os.makedirs(os.path.join(root, 'com.foo'))
+    with open(os.path.join(root, 'index.html'), 'w') as index:
+        index.write('<html/>')
+
+    diff_report = dict()
+    for i in range(files):
+        name = 'Bar{0}.java'.format(i)
+        spans = []
+        for (line_num, status) in enumerate(PAGE_LINES, 1):
+            if status is None:
+                spans.append('x\n')
+            else:
+                spans.append('<span class="{0}" id="L{1}">x</span>\n'.format(status, line_num))
+        with open(os.path.join(root, 'com.foo', name + '.html'), 'w') as page:
+            page.write(PAGE_HEAD.format(name) + ''.join(spans) + PAGE_TAIL)
+        diff_report['src/main/java/com/foo/' + name] = list(range(1, len(PAGE_LINES) + 1))
+    return diff_report
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'jacoco')
+        self.diff_report = write_report(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        cc.PROFILER = cc.Profiler()
+
+    def test_report(self):
+        report = cc.report(self.diff_report, self.root)
+        self.assertEqual(len(report), FILES)
+        self.assertEqual(report['com.fooBar0.java'],
+                         {'link': 'com.foo/Bar0.java.html', 'nc': 2, 'pc': 1, 'fc': 4, 'new': 7})
+
+    def test_profile(self):
+        for (jobs, prefetch) in ((1, 0), (1, 4), (2, 0)):
+            with self.subTest(jobs=jobs, prefetch=prefetch):
+                profiler = cc.start_profiling(trace_allocations=False)
+                report = cc.report(self.diff_report, self.root, jobs=jobs, prefetch=prefetch)
+                self.assertEqual(len(report), FILES)
+
+                profile = profiler.to_dict()
+                stages = profile['stages']
+                self.assertEqual(stages['page_resolution']['calls'], FILES + 1)
+                self.assertEqual(stages['page_parsing']['calls'], FILES)
+                self.assertEqual(stages['line_lookup']['calls'], FILES)
+
+                # Every stage of a file is profiled under its diff path
+                files = set(entry['file'] for entry in profile['files'])
+                self.assertEqual(files, set(self.diff_report))
+
+    def test_store_repeated_file(self):
+        # A file named twice, evaluated ahead of storing its results
+        changes = sorted(self.diff_report.items()) * 2
+        for (jobs, prefetch) in ((1, 0), (1, 4), (2, 0)):
+            with self.subTest(jobs=jobs, prefetch=prefetch):
+                path = os.path.join(self.tmp_dir, 'results-{0}-{1}.json'.format(jobs, prefetch))
+                store = cc.ResultStore(path)
+                report = cc.report(changes, self.root, jobs=jobs, prefetch=prefetch, store=store)
+                store.save()
+                self.assertEqual(len(report), FILES)
+
+                store = cc.ResultStore(path)
+                self.assertEqual(cc.report(changes, self.root, store=store), report)
+                self.assertEqual(store.reused, 2 * FILES)
+
+    def test_incremental_other_inputs(self):
+        path = os.path.join(self.tmp_dir, 'jacoco.xml')
+        with open(path, 'w') as report:
+            report.write('<report/>')
+        with self.assertRaises(ValueError):
+            cc._result_store(os.path.join(self.tmp_dir, 'results.json'), [path])
+        self.assertIsNone(cc._result_store(None, [path]))
+
+    def test_batch_jobs(self):
+        diffs = os.path.join(self.tmp_dir, 'diffs')
+        os.makedirs(diffs)
+        with open(os.path.join(diffs, 'bar0.diff'), 'w') as diff:
+            diff.write('diff --git a/src/main/java/com/foo/Bar0.java b/src/main/java/com/foo/Bar0.java\n'
+                       '--- a/src/main/java/com/foo/Bar0.java\n'
+                       '+++ b/src/main/java/com/foo/Bar0.java\n'
+                       '@@ -0,0 +1,8 @@\n' + '+x\n' * len(PAGE_LINES))
+
+        # The workers only share the parsed pages through the disk cache
+        with self.assertRaises(ValueError):
+            cc.jacoco_on_new_code_batch(diffs, self.root, jobs=2)
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.assertEqual(cc.jacoco_on_new_code_batch(diffs, self.root, jobs=2, cache_dir=cache_dir),
+                         cc.jacoco_on_new_code_batch(diffs, self.root))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+Translating changed lines to the sources of an older report with
+`StaleReportMap`.
+"""
+from __future__ import unicode_literals
+import difflib
+import random
+import unittest
+
+import coverage_on_new_code as cc
+
+
+def git_diff(files, context=3):
+    """
+    Return the lines of a git-style diff of `files`, a list of
+    `(PATH, OLD_LINES, NEW_LINES)` tuples.
+    """
+    diff_lines = []
+    for (path, old_lines, new_lines) in files:
+        diff_lines.append('diff --git a/{0} b/{0}\n'.format(path))
+        diff_lines.extend(difflib.unified_diff([line + '\n' for line in old_lines],
+                                               [line + '\n' for line in new_lines],
+                                               'a/' + path, 'b/' + path, n=context))
+    return diff_lines
+
+
+def expected_old_lines(old_lines, new_lines):
+    """
+    Return the old line number of every new line (from 1), or None for
+    the lines that changed.
+    """
+    expected = [None] * len(new_lines)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for (old_start, new_start, size) in matcher.get_matching_blocks():
+        for i in range(size):
+            expected[new_start + i] = old_start + i + 1
+    return expected
+
+
+class StaleReportMapTest(unittest.TestCase):
+
+    def assertOldLines(self, stale, path, expected):
+        self.assertEqual([stale.old_line(path, line_num) for line_num in range(1, len(expected) + 1)], expected)
+
+    def test_insertion(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Foo.java b/Foo.java\n',
+            '--- a/Foo.java\n',
+            '+++ b/Foo.java\n',
+            '@@ -2,0 +3,2 @@\n',
+            '+x\n',
+            '+y\n',
+        ])
+        self.assertOldLines(stale, 'Foo.java', [1, 2, None, None, 3, 4])
+
+    def test_deletion(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Foo.java b/Foo.java\n',
+            '--- a/Foo.java\n',
+            '+++ b/Foo.java\n',
+            '@@ -3,2 +2,0 @@\n',
+            '-x\n',
+            '-y\n',
+        ])
+        self.assertOldLines(stale, 'Foo.java', [1, 2, 5, 6])
+
+    def test_modification(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Foo.java b/Foo.java\n',
+            '--- a/Foo.java\n',
+            '+++ b/Foo.java\n',
+            '@@ -1,4 +1,5 @@\n',
+            ' a\n',
+            '-b\n',
+            '+B\n',
+            '+C\n',
+            ' c\n',
+            ' d\n',
+        ])
+        self.assertOldLines(stale, 'Foo.java', [1, None, None, 3, 4, 5])
+
+    def test_new_file(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Foo.java b/Foo.java\n',
+            'new file mode 100644\n',
+            '--- /dev/null\n',
+            '+++ b/Foo.java\n',
+            '@@ -0,0 +1,2 @@\n',
+            '+a\n',
+            '+b\n',
+        ])
+        self.assertOldLines(stale, 'Foo.java', [None, None])
+
+    def test_deleted_file(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Gone.java b/Gone.java\n',
+            'deleted file mode 100644\n',
+            '--- a/Gone.java\n',
+            '+++ /dev/null\n',
+            '@@ -1,2 +0,0 @@\n',
+            '-a\n',
+            '-b\n',
+            'diff --git a/Foo.java b/Foo.java\n',
+            '--- a/Foo.java\n',
+            '+++ b/Foo.java\n',
+            '@@ -1 +1 @@\n',
+            '-a\n',
+            '+A\n',
+        ])
+        # The hunk of the deleted file does not leak into the next one
+        self.assertOldLines(stale, 'Foo.java', [None, 2, 3])
+        self.assertEqual(stale.old_path('Gone.java'), 'Gone.java')
+
+    def test_rename(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Old.java b/New.java\n',
+            'similarity index 90%\n',
+            'rename from Old.java\n',
+            'rename to New.java\n',
+            '--- a/Old.java\n',
+            '+++ b/New.java\n',
+            '@@ -1,0 +2 @@\n',
+            '+x\n',
+        ])
+        self.assertEqual(stale.old_path('New.java'), 'Old.java')
+        self.assertOldLines(stale, 'New.java', [1, None, 2, 3])
+
+    def test_pure_rename_and_copy(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Old.java b/New.java\n',
+            'similarity index 100%\n',
+            'rename from Old.java\n',
+            'rename to New.java\n',
+            'diff --git a/Foo.java b/Bar.java\n',
+            'similarity index 100%\n',
+            'copy from Foo.java\n',
+            'copy to Bar.java\n',
+        ])
+        self.assertEqual(stale.old_path('New.java'), 'Old.java')
+        self.assertEqual(stale.old_path('Bar.java'), 'Foo.java')
+        self.assertOldLines(stale, 'New.java', [1, 2, 3])
+        self.assertOldLines(stale, 'Bar.java', [1, 2, 3])
+
+    def test_no_newline(self):
+        stale = cc.StaleReportMap(diff_lines=[
+            'diff --git a/Foo.java b/Foo.java\n',
+            '--- a/Foo.java\n',
+            '+++ b/Foo.java\n',
+            '@@ -1,2 +1,3 @@\n',
+            ' a\n',
+            '-b\n',
+            '\\ No newline at end of file\n',
+            '+b\n',
+            '+c\n',
+            '\\ No newline at end of file\n',
+        ])
+        self.assertOldLines(stale, 'Foo.java', [1, None, None])
+
+    def test_unchanged_file(self):
+        stale = cc.StaleReportMap(diff_lines=[])
+        self.assertEqual(stale.old_path('Foo.java'), 'Foo.java')
+        self.assertEqual(stale.old_line('Foo.java', 7), 7)
+
+    def test_bad_hunk(self):
+        with self.assertRaises(cc.GitDiffError):
+            cc.StaleReportMap(diff_lines=[
+                '--- a/Foo.java\n',
+                '+++ b/Foo.java\n',
+                '@@ -x +y @@\n',
+            ])
+
+    def test_random_diffs(self):
+        rand = random.Random(0)
+        for _ in range(300):
+            old_lines = [rand.choice('abcde') for _ in range(rand.randrange(12))]
+            new_lines = list(old_lines)
+            for _ in range(rand.randrange(1, 4)):
+                position = rand.randrange(len(new_lines) + 1)
+                if rand.random() < 0.5:
+                    new_lines[position:position] = [rand.choice('ABC') for _ in range(rand.randrange(1, 3))]
+                else:
+                    del new_lines[position:position + rand.randrange(1, 3)]
+            # An extra file sharing the diff, after the one checked
+            other = ('Other.java', ['a'], ['b'])
+
+            for context in (0, 3):
+                stale = cc.StaleReportMap(diff_lines=git_diff([('Foo.java', old_lines, new_lines), other],
+                                                              context))
+                self.assertOldLines(stale, 'Foo.java', expected_old_lines(old_lines, new_lines))
+
+
+if __name__ == '__main__':
+    unittest.main()